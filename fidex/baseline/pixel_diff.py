@@ -5,13 +5,15 @@ import os
 import itertools
 import pandas as pd
 
+from fidex.fidelity_check import screenshot_diff
+
 
 # total = 1920 * 1080 * 3 # resolution * channels
 
 # Merge multiple images into one
 # images: list of images path
 def merge_images(images, direction='vertical'):
-    images = [cv2.imread(image) for image in images]
+    images = [screenshot_diff.imread(image) for image in images]
     if direction == 'horizontal':
         return np.hstack(images)
     elif direction == 'vertical':
@@ -20,26 +22,20 @@ def merge_images(images, direction='vertical'):
         raise ValueError('direction must be either horizontal or vertical')
 
 def score(live, archive):
-    diff = live - archive
-    total = live.shape[0]*live.shape[1]*live.shape[2]
-    same = np.count_nonzero(diff == 0)
-    return same / total
+    return screenshot_diff.similarity(live, archive)
 
 def diff(live_img, archive_img, directory_prefix='test', return_diff_img=False):
     if not os.path.exists(live_img) or not os.path.exists(archive_img):
         return 0
-    img1 = cv2.imread(live_img)
-    img2 = cv2.imread(archive_img)
-    # print(img1.shape, img2.shape)
-    height = min(img1.shape[0], img2.shape[0])
-    width = min([img1.shape[1], img2.shape[1]])
-    img1 = img1[:height,:width,:]
-    img2 = img2[:height,:width,:]
-    
-    diff_score = score(img1, img2)
+    diff_score, imgdiff = screenshot_diff.compare(live_img, archive_img, with_diff=True)
     # print(f"{diff_score:.4f}")
 
-    imgdiff = np.absolute(img1 - img2)
+    if imgdiff is None:
+        # Same images. Identical files were not decoded by compare, so only decode one for the shape
+        if screenshot_diff.same_file(live_img, archive_img):
+            imgdiff = np.zeros_like(screenshot_diff.imread(live_img))
+        else:
+            imgdiff = screenshot_diff.diff_image(screenshot_diff.imread(live_img), screenshot_diff.imread(archive_img))
     if return_diff_img:
         return diff_score, imgdiff
     cv2.imwrite(f'{directory_prefix}_diff.png', imgdiff)
@@ -59,6 +59,11 @@ class Config:
     def chrome_data_dir(self):
         return self.config.get('chrome_data_dir', '.')
     
+    @cached_property
+    def noise_rules(self):
+        """Extra noise rules of the meaningful check (see fidelity_check.check_meaningful.NOISE_RULES)"""
+        return self.config.get('noise_rules', [])
+
     @property
     def archive_dir(self):
         return self.config.get('archive_dir', '.')
@@ -72,4 +77,20 @@ class Config:
         self._separate_collection = value
 
 config_path = os.path.join(_FILEDIR, 'config.json') if not os.environ.get('FIDEX_CONFIG') else os.environ.get('FIDEX_CONFIG')
-CONFIG = Config(config_path)
\ No newline at end of file
+_config = None
+
+def load_config() -> "Config | None":
+    """The config of config_path, None if the file is missing (never raises for that, unlike importing CONFIG)"""
+    global _config
+    if _config is None and os.path.exists(config_path):
+        _config = Config(config_path)
+    return _config
+
+def __getattr__(name):
+    # * CONFIG is loaded on first access, so this module imports even without a config file
+    if name == 'CONFIG':
+        config = load_config()
+        if config is None:
+            raise FileNotFoundError(f'No config file at {config_path}')
+        return config
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
\ No newline at end of file
@@ -7,7 +7,7 @@ from dataclasses import dataclass
 from subprocess import call
 
 from fidex.record_replay import autorun
-from fidex.fidelity_check import fidelity_detect, layout_tree, js_writes
+from fidex.fidelity_check import check_meaningful, fidelity_detect, layout_tree, js_writes, result_cache
 from fidex.error_pinpoint import js_exceptions, js_initiators
 from fidex.utils import url_utils, common, execution, logger
 from fidex.config import CONFIG
@@ -167,11 +167,9 @@ class Pinpointer:
                         else f'{self.right_prefix}_{stage.split("_")[1]}'
         if not hasattr(self, 'left_info'):
             self.left_info = fidelity_detect.LoadInfo(self.dirr, left_stage)
-            self.left_info.read_info()
             self.left_info.gen_xpath_map()
         if not hasattr(self, 'right_info'):
             self.right_info = fidelity_detect.LoadInfo(self.dirr, right_stage)
-            self.right_info.read_info()
             self.right_info.gen_xpath_map()
         
     def pinpoint_common(self) -> "List[js_exceptions.JSExcep]":
@@ -285,8 +283,27 @@ class Pinpointer:
         return [], None
 
 
-def pinpoint_issue(dirr, idx=0, left_prefix='live', right_prefix='archive', meaningful=True) -> PinpointResult:
-    fidelity_result = fidelity_detect.fidelity_issue_all(dirr, left_prefix, right_prefix, screenshot=False, meaningful=meaningful)
+def pinpoint_issue(dirr, idx=0, left_prefix='live', right_prefix='archive', meaningful=True, cache=False) -> PinpointResult:
+    """
+    Args:
+        cache (bool): Reuse the result of a previous call if the artifacts of both prefixes, metadata.json,
+                      the options and the code are unchanged (see fidelity_check.result_cache)
+    """
+    if not cache:
+        return _pinpoint_issue(dirr, idx, left_prefix, right_prefix, meaningful)
+    options = dict(meaningful=meaningful, replayweb=CONFIG.replayweb)
+    name = result_cache.entry_name(f'pinpoint_{left_prefix}_{right_prefix}', **options)
+    key = result_cache.cache_key(dirr, [left_prefix, right_prefix], extra_files=['metadata.json'],
+                                 noise_rules=check_meaningful.config_rules(), **options)
+    result = result_cache.lookup(dirr, name, key)
+    if result is None:
+        result = _pinpoint_issue(dirr, idx, left_prefix, right_prefix, meaningful, cache=True)
+        result_cache.store(dirr, name, key, result)
+    return result
+
+def _pinpoint_issue(dirr, idx=0, left_prefix='live', right_prefix='archive', meaningful=True, cache=False) -> PinpointResult:
+    fidelity_result = fidelity_detect.fidelity_issue_all(dirr, left_prefix, right_prefix, screenshot=False, meaningful=meaningful,
+                                                         cache=cache)
     if not fidelity_result.info['diff']:
         return PinpointResult(fidelity_result=fidelity_result, 
                               mut_fidelity_result=None,
@@ -1,8 +1,126 @@
+import bisect
+import functools
 import re
 from bs4 import BeautifulSoup
 
+from fidex.config import load_config
+from fidex.fidelity_check import instrument
 from fidex.utils import common, url_utils
 
+# * Noise rules of the element filters (_from_recaptcha, _from_ads ...). Each rule marks the elements it matches
+#   for its filter, by kind:
+#     text: pattern is in the lowercased text of the element
+#     text_regex: pattern (a regex) is found in the lowercased text of the element
+#     class: pattern is in the classes of the element's (first) tag, joined by spaces
+#     class_id: pattern is one of the words (split by spaces, - and _) of the classes and id of the tag
+#     src: pattern is in the src of the tag
+#   A filter drops a branch if (see each _from_* function)
+#     recaptcha: an element of the branch, or the iframe the branch is in, is marked
+#     recaptcha_background: the branch is a single marked element
+#     youtube: an element of the branch (the parent for text nodes) is marked
+#     vimeo: the iframe the branch is in is marked
+#     ads, dynamic: an element of the branch is marked. Also filtered out as sub-branches
+#   More rules can be added with "noise_rules" in the config, e.g.
+#     {"name": "ads_sponsored", "filter": "ads", "kind": "class_id", "pattern": "sponsored"}
+NOISE_RULES = [
+    {'name': 'recaptcha', 'filter': 'recaptcha', 'kind': 'text', 'pattern': 'recaptcha'},
+    {'name': 'recaptcha_background', 'filter': 'recaptcha_background', 'kind': 'text_regex',
+     'pattern': r'<div style="width: 100%; height: 100%; position: fixed; top: 0px; left: 0px; z-index: \d+; '
+                r'background-color: rgb\(255, 255, 255\);\ opacity:\ 0\.\d+;">'},
+    {'name': 'youtube_ytp', 'filter': 'youtube', 'kind': 'class', 'pattern': 'ytp'},
+    {'name': 'vimeo_player', 'filter': 'vimeo', 'kind': 'text', 'pattern': 'player.vimeo.com'},
+    *({'name': f'ads_{ad}', 'filter': 'ads', 'kind': 'class_id', 'pattern': ad}
+      for ad in ['adsbygoogle', 'ad', 'ads', 'advertisement', 'infinite', 'gpt']),
+    {'name': 'ads_yadro_counter', 'filter': 'ads', 'kind': 'src', 'pattern': 'counter.yadro.ru/hit'},
+    {'name': 'dynamic_progress', 'filter': 'dynamic', 'kind': 'class_id', 'pattern': 'progress'},
+]
+NOISE_FILTERS = {'recaptcha', 'recaptcha_background', 'youtube', 'vimeo', 'ads', 'dynamic'}
+_TEXT_KINDS = {'text', 'text_regex'}
+_TAG_KINDS = {'class', 'class_id', 'src'}
+
+# * Number of branches (or elements of them) filtered by each rule
+NOISE_RULE_HITS = {}
+
+
+def noise_rule_hits() -> dict:
+    return dict(NOISE_RULE_HITS)
+
+
+def clear_noise_rule_hits():
+    NOISE_RULE_HITS.clear()
+
+
+class _NoiseRules:
+    """
+    Rules compiled into one regex for the text and one for the tag, matching wherever any rule may match.
+    Most elements match none of them, so they are classified without checking each rule nor parsing the tag
+    """
+    def __init__(self, rules):
+        for rule in rules:
+            if rule['kind'] not in _TEXT_KINDS | _TAG_KINDS or rule['filter'] not in NOISE_FILTERS:
+                raise ValueError(f'Invalid noise rule {rule}')
+        self.text_rules = [r for r in rules if r['kind'] in _TEXT_KINDS]
+        self.tag_rules = [r for r in rules if r['kind'] in _TAG_KINDS]
+        self.regexes = {r['name']: re.compile(r['pattern']) for r in self.text_rules if r['kind'] == 'text_regex'}
+        # * Regexes with groups (e.g. backreferences) can't be combined, and are always checked
+        combined = [re.escape(r['pattern']) if r['kind'] == 'text' else r['pattern'] for r in self.text_rules
+                    if r['kind'] == 'text' or self.regexes[r['name']].groups == 0]
+        self.any_text = re.compile('|'.join(f'(?:{p})' for p in combined)) if combined else None
+        self.always_text = len(combined) < len(self.text_rules)
+        # * Attribute values are in the text, unless written with character references (&...;).
+        #   Classes joined by spaces may also match patterns with whitespaces anywhere
+        if any(r['kind'] == 'class' and re.search(r'\s', r['pattern']) for r in self.tag_rules):
+            self.any_tag = None
+        else:
+            self.any_tag = re.compile('|'.join([re.escape(r['pattern']) for r in self.tag_rules] + ['&']))
+
+    def _match_text(self, rule, lower_text) -> bool:
+        if rule['kind'] == 'text':
+            return rule['pattern'] in lower_text
+        return self.regexes[rule['name']].search(lower_text) is not None
+
+    def _match_tag(self, rule, tag, class_ids) -> bool:
+        if rule['kind'] == 'class':
+            return rule['pattern'] in ' '.join(tag.attrs.get('class', ''))
+        if rule['kind'] == 'class_id':
+            return rule['pattern'] in class_ids
+        return rule['pattern'] in tag.attrs.get('src', '')
+
+    def classify(self, element) -> dict:
+        """{filter: [names of the rules of the filter matching element]}"""
+        matched = {}
+        text = element['text']
+        lower_text = text.lower()
+        if self.always_text or (self.any_text is not None and self.any_text.search(lower_text)):
+            for rule in self.text_rules:
+                if self._match_text(rule, lower_text):
+                    matched.setdefault(rule['filter'], []).append(rule['name'])
+        if self.tag_rules and (self.any_tag is None or self.any_tag.search(text)):
+            tag = BeautifulSoup(text, 'html.parser').find()
+            if tag is not None:
+                class_ids = []
+                if tag.attrs.get('class', ''):
+                    class_ids += tag.attrs.get('class', '')
+                if tag.attrs.get('id', ''):
+                    class_ids.append(tag.attrs.get('id', ''))
+                class_ids = [c for cl in class_ids for c in re.split(r'[ \-_]+', cl)]
+                for rule in self.tag_rules:
+                    if self._match_tag(rule, tag, class_ids):
+                        matched.setdefault(rule['filter'], []).append(rule['name'])
+        return matched
+
+
+def config_rules() -> list:
+    """Noise rules added in the config ("noise_rules"), none if there is no config file"""
+    config = load_config()
+    return config.noise_rules if config is not None else []
+
+
+@functools.lru_cache(maxsize=None)
+def _noise_rules() -> _NoiseRules:
+    return _NoiseRules(NOISE_RULES + config_rules())
+
+
 def _ignore_tag(branch):
     ignore_list = ['ruffle-embed', 'rs-progress-bar', 'br']
     for xpath in branch:
@@ -34,112 +152,72 @@ def _visible(branch, xpaths_map):
             break
     return any_visible
 
-def _from_recaptcha(branch, xpaths_map):
-        xpath = branch[0]
-        # * Check parent
-        paths = xpath.split('/')
-        iframe_idx = -1
-        for i, p in enumerate(paths):
-            if p.startswith('iframe'):
-                iframe_idx = i
-                break
-        iframe_path = paths[:iframe_idx+1]
-        iframe_element = xpaths_map.get('/'.join(iframe_path), None)
-        if iframe_element is not None:
-            if 'recaptcha' in iframe_element['text'].lower():
-                return True
-        # * Check children
-        for br in branch:
-            element = xpaths_map[br]
-            if 'recaptcha' in element['text'].lower():
-                return True
-        # * Check background
-        if len(branch) == 1:
-            element = xpaths_map[xpath]
-            recaptcha_background = re.compile('<div style="width: 100%; height: 100%; position: fixed; top: 0px; left: 0px; z-index: \d+; background-color: rgb\\(255, 255, 255\\);\\ opacity:\\ 0\\.\d+;">')
-            if recaptcha_background.search(element['text'].lower()):
-                return True
-        return False
+def _iframe_xpath(xpath) -> str:
+    """xpath of the outermost iframe xpath is in ('' if not in any)"""
+    paths = xpath.split('/')
+    iframe_idx = -1
+    for i, p in enumerate(paths):
+        if p.startswith('iframe'):
+            iframe_idx = i
+            break
+    return '/'.join(paths[:iframe_idx+1])
+
+def _hit(rules) -> bool:
+    """Count a branch (or element) filtered by rules"""
+    for name in rules:
+        NOISE_RULE_HITS[name] = NOISE_RULE_HITS.get(name, 0) + 1
+        instrument.count(f'rule_{name}')
+    return True
 
-def _from_youtube(branch, xpaths_map):
-    parsed_xpath = set()
+def _from_recaptcha(branch, xpaths_map, page: "_PageIndex"=None):
+    page = page or _PageIndex(xpaths_map)
+    xpath = branch[0]
+    # * Check parent
+    iframe_xpath = _iframe_xpath(xpath)
+    if iframe_xpath in xpaths_map and 'recaptcha' in page.noise(iframe_xpath):
+        return _hit(page.noise(iframe_xpath)['recaptcha'])
+    # * Check children
+    for br in branch:
+        if 'recaptcha' in page.noise(br):
+            return _hit(page.noise(br)['recaptcha'])
+    # * Check background
+    if len(branch) == 1 and 'recaptcha_background' in page.noise(xpath):
+        return _hit(page.noise(xpath)['recaptcha_background'])
+    return False
+
+def _from_youtube(branch, xpaths_map, page: "_PageIndex"=None):
+    page = page or _PageIndex(xpaths_map)
     for br in branch:
         actual_br = br
-        if actual_br in parsed_xpath:
-            continue
         element = xpaths_map[actual_br]
         while common.tagname_from_xpath(element['xpath']) == '#text' and len(actual_br.split('/')) > 1:
             actual_br = '/'.join(actual_br.split('/')[:-1])
             element = xpaths_map[actual_br]
-        parsed_xpath.add(actual_br)
-        element_tag = BeautifulSoup(element['text'], 'html.parser')
-        if element_tag.find() is None:
-            continue
-        # First element's class name includes "ytp"
-        if 'ytp' in ' '.join(element_tag.find().attrs.get('class', '')):
-            return True
+        if 'youtube' in page.noise(actual_br):
+            return _hit(page.noise(actual_br)['youtube'])
     return False
 
-def _from_vimeo(branch, xpaths_map):
-    xpath = branch[0]
+def _from_vimeo(branch, xpaths_map, page: "_PageIndex"=None):
+    page = page or _PageIndex(xpaths_map)
     # * Check parent
-    paths = xpath.split('/')
-    iframe_idx = -1
-    for i, p in enumerate(paths):
-        if p.startswith('iframe'):
-            iframe_idx = i
-            break
-    iframe_path = paths[:iframe_idx+1]
-    iframe_element = xpaths_map.get('/'.join(iframe_path), None)
-    if iframe_element is not None:
-        if 'player.vimeo.com' in iframe_element['text'].lower():
-            return True
+    iframe_xpath = _iframe_xpath(branch[0])
+    if iframe_xpath in xpaths_map and 'vimeo' in page.noise(iframe_xpath):
+        return _hit(page.noise(iframe_xpath)['vimeo'])
+    return False
 
-def _from_ads(branch, xpaths_map):
+def _from_ads(branch, xpaths_map, page: "_PageIndex"=None):
+    page = page or _PageIndex(xpaths_map)
     for br in branch:
-        element = xpaths_map[br]
-        element_tag = BeautifulSoup(element['text'], 'html.parser')
-        # if element_tag is pure text continue
-        if element_tag.find() is None:
-            continue
-        # First element's class name includes ad related
-        ad_class = ['adsbygoogle', 'ad', 'ads', 'advertisement', 'infinite', 'gpt']
-        ad_class_ids = []
-        if element_tag.find().attrs.get('class', ''):
-            ad_class_ids += element_tag.find().attrs.get('class', '')
-        if element_tag.find().attrs.get('id', ''):
-            ad_class_ids.append(element_tag.find().attrs.get('id', ''))
-        # ad_classlist = ' '.join(ad_classlist)
-        ad_class_ids = [c for cl in ad_class_ids for c in re.split(r'[ \-_]+', cl)]
-        for ad in ad_class:
-            if ad in ad_class_ids:
-                return True
-        
-        ad_src = ['counter.yadro.ru/hit']
-        src = element_tag.find().attrs.get('src', '')
-        for ad in ad_src:
-            if ad in src:
-                return True
+        if 'ads' in page.noise(br):
+            return _hit(page.noise(br)['ads'])
     return False
 
-def _from_dynamic(branch, xpaths_map):
+def _from_dynamic(branch, xpaths_map, page: "_PageIndex"=None):
     """Dynamic elements should be matched in matching phase. Here just to tackle some corner cases"""
+    page = page or _PageIndex(xpaths_map)
     for br in branch:
-        element = xpaths_map[br]
-        element_tag = BeautifulSoup(element['text'], 'html.parser')
-        if element_tag.find() is None:
-            continue
-        # First element's class name includes ad related
-        dynamic_class = ['progress']
-        dynamic_class_ids = []
-        if element_tag.find().attrs.get('class', ''):
-            dynamic_class_ids += element_tag.find().attrs.get('class', '')
-        if element_tag.find().attrs.get('id', ''):
-            dynamic_class_ids.append(element_tag.find().attrs.get('id', ''))
-        dynamic_class_ids = [c for cl in dynamic_class_ids for c in re.split(r'[ \-_]+', cl)]
-        for dynamic in dynamic_class:
-            if dynamic in dynamic_class_ids:
-                return True
+        if 'dynamic' in page.noise(br):
+            return _hit(page.noise(br)['dynamic'])
     return False
 
 def _from_lazyload_image(branch, xpaths_map, other_invisible_img_srcs: set):
@@ -165,79 +243,143 @@ def _from_lazyload_image(branch, xpaths_map, other_invisible_img_srcs: set):
     return False
 
 
-def branch_meaningful(branch, xpaths_map: dict=None) -> bool:
+def branch_meaningful(branch, xpaths_map: dict=None, page: "_PageIndex"=None) -> bool:
+    """
+    Args:
+        page: _PageIndex of xpaths_map, if already built for the page
+    """
+    page = page or _PageIndex(xpaths_map)
     if not _visible(branch, xpaths_map):
         return False
     if _ignore_tag(branch):
         return False
-    if _from_recaptcha(branch, xpaths_map):
+    if _from_recaptcha(branch, xpaths_map, page):
         return False
-    if _from_youtube(branch, xpaths_map):
+    if _from_youtube(branch, xpaths_map, page):
         return False
-    if _from_vimeo(branch, xpaths_map):
+    if _from_vimeo(branch, xpaths_map, page):
         return False
-    if _from_ads(branch, xpaths_map):
+    if _from_ads(branch, xpaths_map, page):
         return False
-    if _from_dynamic(branch, xpaths_map):
+    if _from_dynamic(branch, xpaths_map, page):
         return False
     return True
 
-def _remove_unnecessary_elements(branch, xpaths_map, other_xpaths_map: dict):
-    """Throw away sub-branches, not the whole branch"""
-    # * Construct invisible img srcs
+class _XPathIndex:
+    """
+    Sorted xpaths. Strings starting with an xpath immediately follow it in sorted order,
+    so descendants (b.startswith(xpath)) and ancestors are found by binary search instead of scanning all xpaths
+    """
+    def __init__(self, xpaths=()):
+        self.xpaths = sorted(set(xpaths))
+
+    def has_descendant(self, xpath) -> bool:
+        """If any xpath other than xpath itself starts with xpath"""
+        idx = bisect.bisect_right(self.xpaths, xpath)
+        return idx < len(self.xpaths) and self.xpaths[idx].startswith(xpath)
+
+    def under(self, xpath) -> bool:
+        """If xpath starts with any of the xpaths. Only for indexes built by add_root"""
+        idx = bisect.bisect_right(self.xpaths, xpath)
+        return idx > 0 and xpath.startswith(self.xpaths[idx - 1])
+
+    def add_root(self, xpath):
+        """Add xpath and drop the xpaths starting with it, so that no xpath starts with another one (see under)"""
+        lo = hi = bisect.bisect_left(self.xpaths, xpath)
+        while hi < len(self.xpaths) and self.xpaths[hi].startswith(xpath):
+            hi += 1
+        self.xpaths[lo:hi] = [xpath]
+
+
+def _invisible_img_srcs(xpaths_map) -> set:
+    """Sources of the invisible img elements of a page"""
     invisible_img_srcs = set()
-    for xpath, obj in other_xpaths_map.items():
-        if not _visible([xpath], other_xpaths_map) and common.tagname_from_xpath(xpath) == 'img':
+    for xpath, obj in xpaths_map.items():
+        # * Tag first, so that only img elements are parsed by _visible
+        if common.tagname_from_xpath(xpath) == 'img' and not _visible([xpath], xpaths_map):
             img_tag = BeautifulSoup(obj['text'], 'html.parser').find('img')
             srcs = common.get_img_src(img_tag)
             if 'currentSrc' in obj.get('extraAttr', {}):
                 srcs.add(url_utils.url_norm(obj['extraAttr']['currentSrc'], 
                                             ignore_scheme=True, trim_www=True, trim_slash=True, archive=True))
             invisible_img_srcs.update(srcs)
+    return invisible_img_srcs
 
+
+class _PageIndex:
+    """
+    Data derived from the elements of a page, computed at most once
+    and shared by all the unique branches checked in meaningful_diff
+    """
+    def __init__(self, xpaths_map):
+        self.xpaths_map = xpaths_map
+        self._invisible_img_srcs = None
+        # xpath -> noise filters matched by the element (see _NoiseRules.classify)
+        self._noise = {}
+        # other page -> {xpath: if the element is filtered by _remove_unnecessary_elements}
+        self._unnecessary = {}
+
+    @functools.cached_property
+    def xpaths(self) -> _XPathIndex:
+        return _XPathIndex(self.xpaths_map)
+
+    def noise(self, xpath) -> dict:
+        if xpath not in self._noise:
+            self._noise[xpath] = _noise_rules().classify(self.xpaths_map[xpath])
+        return self._noise[xpath]
+
+    @property
+    def invisible_img_srcs(self) -> set:
+        if self._invisible_img_srcs is None:
+            self._invisible_img_srcs = _invisible_img_srcs(self.xpaths_map)
+        return self._invisible_img_srcs
+
+    def unnecessary(self, xpath, other_page: "_PageIndex") -> bool:
+        """If the element is from ads, dynamic or recaptcha, or a lazy loaded image invisible on other_page"""
+        unnecessary = self._unnecessary.setdefault(other_page, {})
+        if xpath not in unnecessary:
+            unnecessary[xpath] = _from_ads([xpath], self.xpaths_map, self) \
+              or _from_dynamic([xpath], self.xpaths_map, self) \
+              or _from_recaptcha([xpath], self.xpaths_map, self) \
+              or _from_lazyload_image([xpath], self.xpaths_map, other_page.invisible_img_srcs)
+        return unnecessary[xpath]
+
+
+def _remove_unnecessary_elements(branch, page: _PageIndex, other_page: _PageIndex):
+    """Throw away sub-branches, not the whole branch"""
     new_branch = []
-    filtered_branch = []
+    filtered_branch = _XPathIndex()
     for br in branch:
-        in_filter_branch = False
-        for fbr in filtered_branch:
-            if br.startswith(fbr):
-                in_filter_branch = True
-                break
-        if in_filter_branch:
+        if filtered_branch.under(br):
             continue
-        if _from_ads([br], xpaths_map) \
-          or _from_dynamic([br], xpaths_map) \
-          or _from_recaptcha([br], xpaths_map) \
-          or _from_lazyload_image([br], xpaths_map, invisible_img_srcs):
-            filtered_branch.append(br)
+        if page.unnecessary(br, other_page):
+            filtered_branch.add_root(br)
             continue
         new_branch.append(br)
     return new_branch
 
-def _remove_wrapping_elements(branch, xpaths_map):
+def _remove_wrapping_elements(branch, xpaths_map, xpaths_index: _XPathIndex=None):
+    """
+    Args:
+        xpaths_index: Index of xpaths_map, if already built for the page
+    """
+    if xpaths_index is None:
+        xpaths_index = _XPathIndex(xpaths_map)
     removed = 1 # dummy first
     cur_branch = branch
     while removed > 0:
         removed = 0
         new_branch = []
+        branch_index = _XPathIndex(cur_branch)
         for br in cur_branch:
-            has_child = False
-            has_xpathmap_child = False
-            for b in cur_branch:
-                if b != br and b.startswith(br):
-                    has_child = True
-                    break
-            if has_child:
+            if branch_index.has_descendant(br):
                 new_branch.append(br)
                 continue
             # Check if xpaths_map has any br's children
             # If so, this mean the br is just a wrapping element, where all the children are matched or ignored
-            for b in xpaths_map:
-                if b != br and b.startswith(br):
-                    has_xpathmap_child = True
-                    removed += 1
-                    break
-            if not has_xpathmap_child:
+            if xpaths_index.has_descendant(br):
+                removed += 1
+            else:
                 new_branch.append(br)
         cur_branch = new_branch
     return cur_branch
@@ -285,21 +427,22 @@ def meaningful_diff(left_element, left_unique, right_element, right_unique) -> (
     """
     left_xpaths_map = {e['xpath']: e for e in left_element}
     right_xpaths_map = {e['xpath']: e for e in right_element}
+    left_page, right_page = _PageIndex(left_xpaths_map), _PageIndex(right_xpaths_map)
 
     new_left_unique = []
     for branch in left_unique:
-        if not branch_meaningful(branch, left_xpaths_map):
+        if not branch_meaningful(branch, left_xpaths_map, left_page):
             continue
-        branch = _remove_unnecessary_elements(branch, left_xpaths_map, right_xpaths_map)
-        branch = _remove_wrapping_elements(branch, left_xpaths_map)
+        branch = _remove_unnecessary_elements(branch, left_page, right_page)
+        branch = _remove_wrapping_elements(branch, left_xpaths_map, left_page.xpaths)
         new_left_unique.append(branch) if len(branch) > 0 else None
     
     new_right_unique = []
     for branch in right_unique:
-        if not branch_meaningful(branch, right_xpaths_map):
+        if not branch_meaningful(branch, right_xpaths_map, right_page):
             continue
-        branch = _remove_unnecessary_elements(branch, right_xpaths_map, left_xpaths_map)
-        branch = _remove_wrapping_elements(branch, right_xpaths_map)
+        branch = _remove_unnecessary_elements(branch, right_page, left_page)
+        branch = _remove_wrapping_elements(branch, right_xpaths_map, right_page.xpaths)
         new_right_unique.append(branch) if len(branch) > 0 else None
 
     return new_left_unique, new_right_unique
\ No newline at end of file
@@ -10,25 +10,21 @@ import cv2
 import numpy as np
 
 from fidex.utils import url_utils, common
-from fidex.fidelity_check import layout_tree, events
+from fidex.fidelity_check import instrument, layout_tree, events, screenshot_diff
 import warnings
 warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
 
-def compare_screenshot(live_img, archive_img):
+def compare_screenshot(live_img, archive_img, with_diff=True):
+    """
+    Returns:
+        (similarity, diff image if the screenshots differ and with_diff else None). See screenshot_diff
+    """
     if not os.path.exists(live_img) or not os.path.exists(archive_img):
         return 1, None
-    img1 = cv2.imread(live_img)
-    img2 = cv2.imread(archive_img)
-    if img1 is None or img2 is None:
+    simi, diff = screenshot_diff.compare(live_img, archive_img, with_diff=with_diff)
+    if simi is None:
         return 1, None
-    height = min(img1.shape[0], img2.shape[0])
-    width = min([img1.shape[1], img2.shape[1]])
-    img1 = img1[:height,:width,:]
-    img2 = img2[:height,:width,:]
-    diff = img1 - img2
-    total = img1.shape[0]*img1.shape[1]*img1.shape[2]
-    same = np.count_nonzero(diff == 0)
-    return same / total, diff
+    return simi, diff
 
 
 def _html_2_xpath(html, element):
@@ -103,20 +99,50 @@ def xpaths_2_text(xpaths, xpath_map):
         text += '  ' * element['depth'] + element['text'] + '\n'
     return text
 
+class DiffSession:
+    """
+    Layout trees of one stage (left vs right), built once and shared by every diff variant (js_comp, layout_order)
+    Per element data (features, fingerprints) and the listed trees are cached on the way.
+    """
+    def __init__(self, left_info: "fidelity_detect.LoadInfo", right_info: "fidelity_detect.LoadInfo"):
+        # Currently we assue left element is always the live page and right element is the archive/proxy page
+        self.left_info = left_info
+        self.right_info = right_info
+        with instrument.step('tree_build'):
+            self.left_layout = layout_tree.build_layout_tree(left_info.elements, left_info.writes, left_info.write_stacks)
+            self.right_layout = layout_tree.build_layout_tree(right_info.elements, right_info.writes, right_info.write_stacks)
+        self.listed = {}
+
+    def _reset(self, js_comp):
+        """Clear the tags left by previous diffs, as if the trees were just built with js_comp"""
+        for layout in [self.left_layout, self.right_layout]:
+            for node in layout.all_nodes.values():
+                node.js_comp = js_comp
+                node.__dict__.pop('dynamic_matched', None)
+                node.__dict__.pop('new_writes', None)
+
+    def diff(self, js_comp=True, budget=None) -> (list, list):
+        """
+        Args:
+            budget (myers.Budget): Optional limits of each layout diff. If exceeded, the unique elements are partial
+        """
+        self._reset(js_comp)
+        # * The layout ordered pass sees the dynamic matches of the first pass, same as on freshly built trees
+        for layout_order in [False, True]:
+            left_unique, right_unique = layout_tree.diff_layout_tree_xpath(self.left_layout, self.right_layout,
+                                                                           layout_order=layout_order, js_comp=js_comp,
+                                                                           listed=self.listed, budget=budget)
+            if len(left_unique) == 0 and len(right_unique) == 0:
+                break
+            if budget is not None and budget.exceeded:
+                break
+        
+        left_unique = _merge_xpaths(left_unique)
+        right_unique = _merge_xpaths(right_unique)
+        return left_unique, right_unique
+
 def diff(left_info: "fidelity_detect.LoadInfo", right_info: "fidelity_detect.LoadInfo", js_comp=True) -> (list, list):
-    # Currently we assue left element is always the live page and right element is the archive/proxy page
-    left_layout = layout_tree.build_layout_tree(left_info.elements, left_info.writes, left_info.write_stacks, js_comp=js_comp)
-    right_layout = layout_tree.build_layout_tree(right_info.elements, right_info.writes, right_info.write_stacks, js_comp=js_comp)
-
-    for layout_order in [False, True]:
-        left_unique, right_unique = layout_tree.diff_layout_tree_xpath(left_layout, right_layout,
-                                                                       layout_order=layout_order, js_comp=js_comp)
-        if len(left_unique) == 0 and len(right_unique) == 0:
-            break
-    
-    left_unique = _merge_xpaths(left_unique)
-    right_unique = _merge_xpaths(right_unique)
-    return left_unique, right_unique
+    return DiffSession(left_info, right_info).diff(js_comp=js_comp)
 
 def diff_interaction(left_info: "fidelity_detect.LoadInfo", right_info: "fidelity_detect.LoadInfo") -> (list, list, list, list):
     """Compare events from left and right'
@@ -266,6 +292,70 @@ def filter_dynamism(left_unique, left_writes,
     new_right_unique = right_unique
     return new_left_unique, new_right_unique
 
+class _CropGrid:
+    """
+    Crops ([top, bottom, left, right]) bucketed by horizontal bands of the page, so that only crops in the same bands
+    are candidates of an intersection. Inverted crops (top > bottom) are bucketed by [bottom, top],
+    which still covers every crop they intersect. Crops with infinite bounds (no dimension) never intersect.
+    """
+    BAND = 256
+
+    def __init__(self, crops):
+        self.bands = defaultdict(list)
+        for idx, crop in enumerate(crops):
+            for band in self._bands(crop):
+                self.bands[band].append(idx)
+
+    def _bands(self, crop):
+        if not all(np.isfinite(c) for c in crop[:2]):
+            return range(0)
+        low, high = min(crop[0], crop[1]), max(crop[0], crop[1])
+        return range(int(low // self.BAND), int(high // self.BAND) + 1)
+
+    def candidates(self, crop) -> "list[int]":
+        """Indexes of the crops that may intersect crop, ascending"""
+        idxs = set()
+        for band in self._bands(crop):
+            idxs.update(self.bands.get(band, ()))
+        return sorted(idxs)
+
+
+class _Remaining:
+    """Items removed by their current position, with a Fenwick tree of the remaining ones (O(log n) each)"""
+    def __init__(self, items):
+        self.items = items
+        self.size = len(items)
+        self.alive = [True] * self.size
+        self.tree = [0] * (self.size + 1)
+        for i in range(1, self.size + 1):
+            self.tree[i] += 1
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.count = self.size
+
+    def pop(self, pos):
+        """Remove the item currently at pos"""
+        # Find the smallest original index with pos + 1 remaining items up to it
+        idx, remaining = 0, pos + 1
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = idx + step
+            if nxt <= self.size and self.tree[nxt] < remaining:
+                idx = nxt
+                remaining -= self.tree[nxt]
+            step >>= 1
+        self.alive[idx] = False
+        self.count -= 1
+        i = idx + 1
+        while i <= self.size:
+            self.tree[i] -= 1
+            i += i & -i
+
+    def to_list(self) -> list:
+        return [item for item, alive in zip(self.items, self.alive) if alive]
+
+
 def filter_same_visual_part(left_img, left_unique, left_elements, 
                             right_img, right_unique, right_elements):
     """
@@ -297,8 +387,8 @@ def filter_same_visual_part(left_img, left_unique, left_elements,
         for xpath in branch:
             crop_area = update_crop(crop_area, xpaths_map[xpath], img_dimen)
         return crop_area
-    img1 = cv2.imread(left_img)
-    img2 = cv2.imread(right_img)
+    img1 = screenshot_diff.imread(left_img)
+    img2 = screenshot_diff.imread(right_img)
     if img1 is None or img2 is None:
         return left_unique, right_unique
     img1_dimen = img1.shape[:2]
@@ -310,10 +400,17 @@ def filter_same_visual_part(left_img, left_unique, left_elements,
     for right_br in right_unique:
         right_crops.append(branch_crop(right_br, right_xpaths_map, img2_dimen))
     
-    new_left_unique, new_right_unique = [], []
+    # ! A matched right branch is removed from right_unique, but right_crops is not, so the j-th remaining branch is
+    # ! compared with (and only the first len(right_unique) of) the original crops. Kept as is for the same results
+    # * Only crops in the same bands are checked, in the same order as scanning all of them
+    right_grid = _CropGrid(right_crops)
+    remaining = _Remaining(right_unique)
+    new_left_unique = []
     for i in range(len(left_unique)):
         matched_crop = False
-        for j in range(len(right_unique)):
+        for j in right_grid.candidates(left_crops[i]):
+            if j >= remaining.count:
+                break
             left_crpo, right_crop = left_crops[i], right_crops[j]
             if not crop_intersect(left_crpo, right_crop):
                 continue
@@ -322,18 +419,23 @@ def filter_same_visual_part(left_img, left_unique, left_elements,
             merged_crop = [int(c) for c in merged_crop]
             left_crop = img1[merged_crop[0]:merged_crop[1], merged_crop[2]:merged_crop[3], :]
             right_crop = img2[merged_crop[0]:merged_crop[1], merged_crop[2]:merged_crop[3], :]
-            diff = left_crop - right_crop
-            if np.count_nonzero(diff == 0) == diff.shape[0]*diff.shape[1]*diff.shape[2]:
+            if np.array_equal(left_crop, right_crop):
                 matched_crop = True
-                right_unique = right_unique[:j] + right_unique[j+1:]
+                remaining.pop(j)
                 break
         if not matched_crop:
             new_left_unique.append(left_unique[i])
-    new_right_unique = right_unique
+    new_right_unique = remaining.to_list()
     return new_left_unique, new_right_unique
 
 def extract_text(elements) -> str:
-    SKIPPED_NODES = [
+    """
+    Text nodes of the page, except those under skipped nodes (script, style, header ...)
+
+    Args:
+        elements (Iterable): Elements in DOM order, e.g. a loaded DOM or dom_delta.iter_elements
+    """
+    SKIPPED_NODES = {
       "SCRIPT",
       "STYLE",
       "HEADER",
@@ -341,20 +443,19 @@ def extract_text(elements) -> str:
       "BANNER-DIV",
       "NOSCRIPT",
       "TITLE",
-    ]
-    skip_prefix = set()
+    }
+    # * Descendants of a node follow it in DOM order, so only the outermost skipped node seen last needs to be kept
+    skip_root = None
     extracted_text = []
     for element in elements:
-        tag = common.tagname_from_xpath(element['xpath'])
+        xpath = element['xpath']
+        if skip_root is not None:
+            if xpath.startswith(skip_root):
+                continue
+            skip_root = None
+        tag = common.tagname_from_xpath(xpath)
         if tag.upper() in SKIPPED_NODES:
-            skip_prefix.add(element['xpath'])
-            continue
-        under_skip = False
-        for prefix in skip_prefix:
-            if element['xpath'].startswith(prefix):
-                under_skip = True
-                break
-        if under_skip:
+            skip_root = xpath
             continue
         if tag != '#text':
             continue
@@ -0,0 +1,281 @@
+"""
+Interaction stage DOMs ({base}_{i}_dom.json) stored as deltas against the onload DOM ({base}_dom.json)
+
+Most elements of an interaction stage are unchanged from onload. A delta ({base}_{i}_dom.delta.json) keeps
+    - base_source: (mtime, size) of the onload json file it was computed against
+    - ops: the stage elements in order, as either [start, length] (a run of unchanged onload elements)
+           or an element object (added or changed element). Removed elements are simply not referenced.
+Loading a delta only parses the added / changed elements, and unchanged elements are the same objects as the
+onload DOM's (onload DOMs with deltas are kept in a small cache for that).
+
+Use load / exists instead of sidecar.load / sidecar.exists for dom files, so all three formats are handled.
+A delta is only valid as long as its onload dom is unchanged: deltas left over from a previous recording
+(the onload dom rewritten since) don't exist for exists, and fail to load.
+iter_elements streams a dom file instead, for a single pass over its elements (e.g. extracting the text).
+
+Convert a collection: python -m fidex.fidelity_check.dom_delta [--remove] <dirr> [<dirr> ...]
+The stage json files (and their sidecars) are only removed with --remove, and the onload doms must then be kept.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+from collections import OrderedDict
+
+from fidex.fidelity_check import sidecar
+
+VERSION = 1
+SUFFIX = '.delta.json'
+BASE_CACHE_SIZE = 4
+STREAM_CHUNK = 1 << 16
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# * (abspath, source signature) -> onload elements
+_bases = OrderedDict()
+
+
+def delta_path(json_path) -> str:
+    return json_path[:-len('.json')] + SUFFIX
+
+
+def base_path(json_path) -> "str | None":
+    """Onload dom of an interaction stage dom, None if json_path is not one"""
+    dirr, filename = os.path.split(json_path)
+    prefix = filename[:-len('_dom.json')]
+    if not filename.endswith('_dom.json') or '_' not in prefix:
+        return None
+    return os.path.join(dirr, f"{prefix.split('_')[0]}_dom.json")
+
+
+def _source_signature(json_path) -> "list | None":
+    """(mtime, size) of json_path, or of the json its sidecar was converted from if only the sidecar is kept"""
+    if os.path.exists(json_path):
+        stat = os.stat(json_path)
+        return [stat.st_mtime_ns, stat.st_size]
+    meta = sidecar.sidecar_meta(json_path)
+    return meta['source'] if meta is not None else None
+
+
+def _has_deltas(json_path) -> bool:
+    prefix = os.path.basename(json_path)[:-len('_dom.json')]
+    return len(glob.glob(f'{glob.escape(os.path.dirname(json_path))}/{glob.escape(prefix)}_*_dom{SUFFIX}')) > 0
+
+
+def _load_base(json_path) -> list:
+    signature = _source_signature(json_path)
+    if signature is None:
+        raise FileNotFoundError(json_path)
+    key = (os.path.abspath(json_path), tuple(signature))
+    if key in _bases:
+        _bases.move_to_end(key)
+        return _bases[key]
+    elements = sidecar.load(json_path)
+    _bases[key] = elements
+    while len(_bases) > BASE_CACHE_SIZE:
+        _bases.popitem(last=False)
+    return elements
+
+
+def encode(elements, base_elements) -> list:
+    """ops of elements against base_elements (see module doc)"""
+    xpath_idxs = {}
+    for i, e in enumerate(base_elements):
+        xpath_idxs.setdefault(e['xpath'], []).append(i)
+    ops = []
+    prev = None
+    for e in elements:
+        # * Extending the current run first keeps runs long
+        if prev is not None and prev + 1 < len(base_elements) and base_elements[prev + 1] == e:
+            idx = prev + 1
+        else:
+            # * Equal element with the same xpath, the first one after the current run if xpath is duplicated
+            candidates = [i for i in xpath_idxs.get(e['xpath'], []) if base_elements[i] == e]
+            later = [i for i in candidates if prev is None or i > prev]
+            idx = later[0] if later else (candidates[0] if candidates else None)
+        if idx is None:
+            ops.append(e)
+        elif prev is not None and idx == prev + 1 and isinstance(ops[-1], list):
+            ops[-1][1] += 1
+        else:
+            ops.append([idx, 1])
+        prev = idx
+    return ops
+
+
+def decode(ops, base_elements) -> list:
+    elements = []
+    for op in ops:
+        if isinstance(op, list):
+            elements += base_elements[op[0]:op[0] + op[1]]
+        else:
+            elements.append(op)
+    return elements
+
+
+def write_delta(json_path, remove=False) -> bool:
+    """
+    Write the delta of an interaction stage dom
+
+    Args:
+        remove: Remove json_path (and its sidecar) once the delta is written.
+                The stage can then only be loaded as long as its onload dom is kept unchanged
+
+    Returns:
+        bool: If written. False if json_path is not an interaction stage dom, its onload dom is missing,
+              or the delta does not load back to the same content (e.g. 1 vs. 1.0)
+    """
+    base = base_path(json_path)
+    if base is None or not sidecar.exists(base) or not sidecar.exists(json_path):
+        return False
+    elements = sidecar.load(json_path)
+    base_elements = sidecar.load(base)
+    ops = encode(elements, base_elements)
+    if json.dumps(decode(ops, base_elements)) != json.dumps(elements):
+        return False
+    path = delta_path(json_path)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    json.dump({'version': VERSION, 'base_source': _source_signature(base), 'ops': ops}, open(tmp_path, 'w'))
+    os.replace(tmp_path, path)
+    if remove:
+        if os.path.exists(json_path):
+            os.remove(json_path)
+        if os.path.exists(sidecar.sidecar_path(json_path)):
+            shutil.rmtree(sidecar.sidecar_path(json_path))
+    return True
+
+
+def _valid_delta(delta: dict, base) -> bool:
+    """If delta was computed against the current onload dom base (False if base is gone)"""
+    return delta.get('version') == VERSION and list(delta['base_source']) == _source_signature(base)
+
+
+def read_delta(json_path):
+    """
+    Load json_path from its delta
+
+    Returns:
+        Same content as json.load(open(json_path)), or None if there is no delta
+    Raises:
+        ValueError: If the onload dom changed (or is gone) since the delta was written
+    """
+    path = delta_path(json_path)
+    base = base_path(json_path)
+    if base is None or not os.path.exists(path):
+        return None
+    delta = json.load(open(path))
+    if not _valid_delta(delta, base):
+        raise ValueError(f'{path} is not a delta of the current {base}')
+    return decode(delta['ops'], _load_base(base))
+
+
+def exists(json_path) -> bool:
+    """If json_path can be loaded, either from the json file, its sidecar or a valid delta (see read_delta)"""
+    if sidecar.exists(json_path):
+        return True
+    path = delta_path(json_path)
+    base = base_path(json_path)
+    return base is not None and os.path.exists(path) and _valid_delta(json.load(open(path)), base)
+
+
+def load(json_path):
+    """Load a dom file, from its sidecar or delta if the json file is not kept"""
+    if sidecar.exists(json_path):
+        if base_path(json_path) is None and _has_deltas(json_path):
+            # * Onload dom of stages with deltas, shared with them
+            return list(_load_base(json_path))
+        return sidecar.load(json_path)
+    obj = read_delta(json_path)
+    if obj is None:
+        raise FileNotFoundError(json_path)
+    return obj
+
+
+def _iter_json_array(path, chunk_size=STREAM_CHUNK):
+    """Items of a json array file, decoded one at a time (same values as json.load)"""
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buf, pos, eof = '', 0, False
+
+        def read_more() -> bool:
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            return not eof
+
+        def next_char() -> str:
+            """Skip whitespaces, '' at the end of the file"""
+            nonlocal pos
+            while True:
+                pos = _WHITESPACE.match(buf, pos).end()
+                if pos < len(buf):
+                    return buf[pos]
+                if not read_more():
+                    return ''
+
+        if next_char() != '[':
+            raise ValueError(f'{path} is not a json array')
+        pos += 1
+        if next_char() == ']':
+            return
+        while True:
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                    # * A value ending at the end of the buffer (e.g. a number) may continue in the next chunk
+                    if end < len(buf) or eof:
+                        break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                read_more()
+            pos = end
+            yield item
+            c = next_char()
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError(f'{path} is not a json array')
+            pos += 1
+            next_char()
+
+
+def iter_elements(json_path):
+    """
+    Elements of a dom file, streamed from the json file if it is kept, so the whole element list is never built.
+    Otherwise loaded from its sidecar or delta (see load)
+    """
+    if os.path.exists(json_path):
+        return _iter_json_array(json_path)
+    return iter(load(json_path))
+
+
+def convert(dirr, remove=False) -> int:
+    """
+    Write deltas for all interaction stage doms under dirr (e.g. a collection)
+
+    Args:
+        remove: Remove the converted stage json files (see write_delta)
+
+    Returns:
+        int: Number of deltas written
+    """
+    written = 0
+    for root, _, filenames in os.walk(dirr):
+        for filename in sorted(filenames):
+            if filename.endswith('_dom.json'):
+                written += write_delta(os.path.join(root, filename), remove=remove)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Store interaction stage doms as deltas against the onload dom')
+    parser.add_argument('dirrs', nargs='+', help='Directories to convert (e.g. collections)')
+    parser.add_argument('--remove', action='store_true',
+                        help='Remove the stage json files (and sidecars) once converted, keep the onload doms then')
+    args = parser.parse_args()
+    for dirr in args.dirrs:
+        print(f'{dirr}: {convert(dirr, remove=args.remove)} deltas written')
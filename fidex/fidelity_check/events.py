@@ -1,5 +1,9 @@
 from functools import cached_property
-from collections import namedtuple
+
+from fidex.fidelity_check import myers
+
+# How often diff_events aligned with the hash join, or fell back to Myers
+ALIGN_STATS = {'hash_join': 0, 'myers': 0}
 
 class Event:
     def __init__(self, evt: dict):
@@ -26,48 +30,88 @@ class Event:
             return True
         return False
 
-def diff_events(left_seq: "List[Event]", right_seq: "List[Event]") -> "List[Event]":
+def _match_pairs(left_seq: "List[Event]", right_seq: "List[Event]") -> list:
     """
-    Same as _myer_diff from layout_tree.py
+    (left idx, right idx) of all equal events, by looking up right events by xpath and selector
+    Sorted by left idx, then by decreasing right idx so that pairs of the same left event never chain (see _unique_lis)
     """
-    Frontier = namedtuple('Frontier', ['x', 'left_diff', 'right_diff', 'left_common', 'right_common'])
-
-    frontier = {1: Frontier(0, [], [], [], [])}
+    by_xpath, by_element = {}, {}
+    for j, evt in enumerate(right_seq):
+        by_xpath.setdefault(evt.xpath, []).append(j)
+        if evt.has_class_or_id:
+            by_element.setdefault(evt.element, []).append(j)
+    pairs = []
+    for i, evt in enumerate(left_seq):
+        candidates = set(by_xpath.get(evt.xpath, ()))
+        if evt.has_class_or_id:
+            candidates.update(by_element.get(evt.element, ()))
+        pairs += [(i, j) for j in sorted(candidates, reverse=True)]
+    return pairs
 
-    L = len(left_seq)
-    R = len(right_seq)
-    for d in range(0, L + R + 1):
-        for k in range(-d, d + 1, 2):
-            go_down = (k == -d or 
-                    (k != d and frontier[k - 1].x < frontier[k + 1].x))
 
-            if go_down:
-                x, left_diff, right_diff, left_common, right_common = frontier[k + 1]
-            else:
-                x, left_diff, right_diff, left_common, right_common = frontier[k - 1]
-                x += 1
+def _unique_lis(pairs: list, size: int) -> "list | None":
+    """
+    Longest chain of pairs increasing in both idx (Hunt-Szymanski: LIS on right idx < size), None if there are several.
+    A Fenwick tree over right idx keeps, for each prefix, the longest chain ending there (length, count capped at 2, last pair)
+    """
+    length, count, last = [0] * (size + 1), [1] * (size + 1), [-1] * (size + 1)
+    prev = [-1] * len(pairs)
+    best_len, best_count, best = 0, 1, -1
+    for p, (_, j) in enumerate(pairs):
+        # * Longest chain over right idx < j
+        cur_len, cur_count, cur_last = 0, 1, -1
+        pos = j
+        while pos > 0:
+            if length[pos] > cur_len:
+                cur_len, cur_count, cur_last = length[pos], count[pos], last[pos]
+            elif length[pos] == cur_len and cur_len > 0:
+                cur_count = min(cur_count + count[pos], 2)
+            pos -= pos & -pos
+        prev[p] = cur_last
+        cur_len += 1
+        if cur_len > best_len:
+            best_len, best_count, best = cur_len, cur_count, p
+        elif cur_len == best_len:
+            best_count = min(best_count + cur_count, 2)
+        pos = j + 1
+        while pos <= size:
+            if cur_len > length[pos]:
+                length[pos], count[pos], last[pos] = cur_len, cur_count, p
+            elif cur_len == length[pos]:
+                count[pos] = min(count[pos] + cur_count, 2)
+            pos += pos & -pos
+    if best_count > 1:
+        return None
+    lis = []
+    while best >= 0:
+        lis.append(pairs[best])
+        best = prev[best]
+    lis.reverse()
+    return lis
 
-            left_diff, right_diff= left_diff.copy(), right_diff.copy()
-            left_common, right_common = left_common.copy(), right_common.copy()
-            y = x - k
 
-            if 1 <= y <= R and go_down:
-                right_diff.append((right_seq[y-1]))
-            elif 1 <= x <= L:
-                left_diff.append(left_seq[x-1])
+def diff_events(left_seq: "List[Event]", right_seq: "List[Event]") -> "List[Event]":
+    """
+    Same as _myer_diff from layout_tree.py
 
-            while x < L and y < R and left_seq[x] == right_seq[y]:
-                left_e, right_e = left_seq[x], right_seq[y]
-                left_common.append(left_e)
-                right_common.append(right_e)
-                x += 1
-                y += 1
+    Equal events are joined through hash indexes on xpath and selector, and the common events are the longest
+    order-preserving chain of these pairs (LIS on right idx). If that chain is unique, it is the only longest
+    common subsequence, so it is the one Myers finds. Otherwise (ties, e.g. reordered events) the alignment
+    falls back to Myers to keep its choice.
 
-            if x >= L and y >= R:
-                return left_diff, right_diff, left_common, right_common
-            else:
-                frontier[k] = Frontier(x, left_diff, right_diff, left_common, right_common)
-    assert False, 'Could not find edit script'
+    Returns:
+        (List[Event], List[Event], List[Event], List[Event]): left_unique, right_unique, left_common, right_common
+    """
+    lis = _unique_lis(_match_pairs(left_seq, right_seq), len(right_seq))
+    if lis is None:
+        ALIGN_STATS['myers'] += 1
+        return myers.myers_diff(left_seq, right_seq)
+    ALIGN_STATS['hash_join'] += 1
+    left_common = {i for i, _ in lis}
+    right_common = {j for _, j in lis}
+    return [evt for i, evt in enumerate(left_seq) if i not in left_common], \
+           [evt for j, evt in enumerate(right_seq) if j not in right_common], \
+           [left_seq[i] for i, _ in lis], [right_seq[j] for _, j in lis]
 
 
 def load_events(events: list) -> "List[Event]":
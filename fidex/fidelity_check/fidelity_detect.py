@@ -2,12 +2,16 @@ import json
 import time
 import os
 import logging
+import atexit
 import cv2
 import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
 from Levenshtein import distance
 
-from fidex.fidelity_check import check_utils, check_meaningful
+from fidex.fidelity_check import check_utils, check_meaningful, dom_delta, instrument, myers, result_cache, sidecar
 from fidex.utils import common, logger, url_utils
 
 def to_python_type(obj):
@@ -24,16 +28,45 @@ def dedeup_elements(layout):
             new_elements.append(element)
     return new_elements
 
+# * Process-local cache of parsed (elements, writes, write_stacks) by (dirr, prefix, file signatures)
+LOAD_CACHE_SIZE = 16
+_load_cache = OrderedDict()
+LOAD_CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def _file_signature(path):
+    if not os.path.exists(path) and os.path.exists(sidecar.sidecar_path(path)):
+        # * Only the sidecar is kept
+        path = f'{sidecar.sidecar_path(path)}/meta.json'
+    elif not os.path.exists(path) and os.path.exists(dom_delta.delta_path(path)):
+        # * Interaction stage dom stored as a delta
+        path = dom_delta.delta_path(path)
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def load_cache_info() -> dict:
+    return {**LOAD_CACHE_STATS, 'size': len(_load_cache), 'maxsize': LOAD_CACHE_SIZE}
+
+def clear_load_cache():
+    _load_cache.clear()
+    for k in LOAD_CACHE_STATS:
+        LOAD_CACHE_STATS[k] = 0
+
 class LoadInfo:
+    """
+    Parsed dom, writes and write stacks of a prefix.
+    elements, writes and write_stacks are tuples shared by all LoadInfo of the same (unchanged) files,
+    so they should not be modified
+    """
     def __init__(self, dirr, prefix):
         self.dirr = dirr
         self.prefix = prefix
         self.base, self.stage = self.prefix.split('_') if '_' in self.prefix else (self.prefix, 'onload')
-        self.read_info()
+        with instrument.step('load'):
+            self.read_info()
 
     @staticmethod
     def read_write_stacks(dirr, base):
-        write_stacks = json.load(open(f"{dirr}/{base}_writeStacks.json"))
+        write_stacks = sidecar.load(f"{dirr}/{base}_writeStacks.json")
         write_stacks_flattered = []
         for obj in write_stacks:
             stackInfo, wids = obj['stackInfo'], obj['wids']
@@ -45,13 +78,28 @@ class LoadInfo:
         return sorted(write_stacks_flattered, key=lambda x: int(x['wid'].split(':')[0]))
     
     def read_info(self):
-        self.elements = json.load(open(f"{self.dirr}/{self.prefix}_dom.json"))
+        paths = [f"{self.dirr}/{self.prefix}_dom.json", f"{self.dirr}/{self.base}_writes.json",
+                 f"{self.dirr}/{self.base}_writeStacks.json"]
+        # * Files rewritten in place (e.g. re-recorded) get new signatures, so stale entries are never hit
+        key = (os.path.abspath(self.dirr), self.prefix, tuple(_file_signature(p) for p in paths))
+        if key in _load_cache:
+            LOAD_CACHE_STATS['hits'] += 1
+            _load_cache.move_to_end(key)
+            self.elements, self.writes, self.write_stacks = _load_cache[key]
+            return
+        LOAD_CACHE_STATS['misses'] += 1
+        # * Compact sidecars (see sidecar.py) are used instead of the json if present, and stage deltas (see dom_delta.py)
+        self.elements = dom_delta.load(paths[0])
         
-        self.elements = dedeup_elements(self.elements)
-        self.writes = json.load(open(f"{self.dirr}/{self.base}_writes.json"))
+        self.elements = tuple(dedeup_elements(self.elements))
+        self.writes = sidecar.load(paths[1])
         # Filter writes based on stages
-        self.writes = [w for w in self.writes if common.stage_nolater(w['currentStage'], self.stage)]
-        self.write_stacks = LoadInfo.read_write_stacks(self.dirr, self.base)
+        self.writes = tuple(w for w in self.writes if common.stage_nolater(w['currentStage'], self.stage))
+        self.write_stacks = tuple(LoadInfo.read_write_stacks(self.dirr, self.base))
+        _load_cache[key] = (self.elements, self.writes, self.write_stacks)
+        while len(_load_cache) > LOAD_CACHE_SIZE:
+            _load_cache.popitem(last=False)
+            LOAD_CACHE_STATS['evictions'] += 1
     
     def read_events(self, available=True) -> list:
         if not os.path.exists(f"{self.dirr}/{self.base}_events.json"):
@@ -71,27 +119,40 @@ class LoadInfo:
     def available_events(self):
         events = []
         for e in self.events:
-            if not os.path.exists(f"{self.dirr}/{self.base}_{e['idx']}_dom.json"):
+            if not dom_delta.exists(f"{self.dirr}/{self.base}_{e['idx']}_dom.json"):
                 continue
             events.append(e)
         self.events = events
 
 
 def fidelity_issue(dirr, left_prefix='live', right_prefix='archive', 
-                   meaningful=True, js_comp=True) -> (bool, (list, list)):
-    """Returns: (if fidelity issue, detailed unique elements in live and archive)"""
-    left_info = LoadInfo(dirr, left_prefix)
-    right_info = LoadInfo(dirr, right_prefix)
+                   meaningful=True, js_comp=True, session=None, budget=None) -> (bool, (list, list)):
+    """
+    Args:
+        session (check_utils.DiffSession): Loaded pages and trees of left_prefix and right_prefix to reuse
+        budget (myers.Budget): Optional limits of the layout diff. Once exceeded, it is a fidelity issue
+                               and the unique elements are partial. Leave None for the full diff (e.g. pinpointing)
+    
+    Returns: (if fidelity issue, detailed unique elements in live and archive)
+    """
+    if session is None:
+        session = check_utils.DiffSession(LoadInfo(dirr, left_prefix), LoadInfo(dirr, right_prefix))
+    left_info, right_info = session.left_info, session.right_info
 
-    left_unique, right_unique = check_utils.diff(left_info, right_info, js_comp=js_comp)
+    left_unique, right_unique = session.diff(js_comp=js_comp, budget=budget)
+    if budget is not None and budget.exceeded:
+        # * Already differs, skip filtering the partial unique elements
+        return True, (left_unique, right_unique)
     if meaningful:
-        left_unique, right_unique = check_meaningful.meaningful_diff(left_info.elements, left_unique, right_info.elements, right_unique)
+        with instrument.step('meaningful_filter'):
+            left_unique, right_unique = check_meaningful.meaningful_diff(left_info.elements, left_unique, right_info.elements, right_unique)
     # * Same visual part
     if len(left_unique) + len(right_unique) > 0:
         if os.path.exists(f"{dirr}/{left_prefix}.jpg") and os.path.exists(f"{dirr}/{right_prefix}.jpg"):
             left_img, right_img = f"{dirr}/{left_prefix}.jpg", f"{dirr}/{right_prefix}.jpg"
-            left_unique, right_unique = check_utils.filter_same_visual_part(left_img, left_unique, left_info.elements,
-                                                                            right_img, right_unique, right_info.elements)
+            with instrument.step('visual_filter'):
+                left_unique, right_unique = check_utils.filter_same_visual_part(left_img, left_unique, left_info.elements,
+                                                                                right_img, right_unique, right_info.elements)
         else:
             logging.warning("Warning: diff layout tree but no screenshots found")
     return len(left_unique) > 0, (left_unique, right_unique)
@@ -129,10 +190,8 @@ def fidelity_issue_text(dirr, left_prefix='live', right_prefix='archive') -> (bo
     Returns:
         (if fidelity issue, similarity score between left and right text)
     """
-    left_dom = json.load(open(f"{dirr}/{left_prefix}_dom.json"))
-    right_dom = json.load(open(f"{dirr}/{right_prefix}_dom.json"))
-    left_text = check_utils.extract_text(left_dom)
-    right_text = check_utils.extract_text(right_dom)
+    left_text = check_utils.extract_text(dom_delta.iter_elements(f"{dirr}/{left_prefix}_dom.json"))
+    right_text = check_utils.extract_text(dom_delta.iter_elements(f"{dirr}/{right_prefix}_dom.json"))
     lev_dist = distance(left_text, right_text)
     max_len = max(len(left_text), len(right_text))
     if max_len == 0:
@@ -153,10 +212,68 @@ class FidelityResult:
         self.archive_unique = d['archive_unique']
         self.more_errs = d.get('more_errs', None)
 
+def check_stage(dirr, left_stage, right_stage, checks: set, left_prefix='live', right_prefix='archive',
+                meaningful=True, diff_budget=None, profile=False) -> dict:
+    """
+    Run the checks of a stage (onload or interaction_{idx}) without changing any state, 
+    so stages can be checked in any order (or in parallel) and merged in order by FidelityDetector.merge_stage
+
+    Args:
+        checks (set): Checks to run, of 'fidex', 'layout', 'screenshot', 'more_errs' and 'html_text'
+        diff_budget (dict): Optional kwargs of myers.Budget for fidex and layout
+        profile (bool): Also return the instrument record (step times and counters) of the stage as 'profile'
+
+    Returns:
+        dict: {check: result} for each check run
+    """
+    if profile:
+        with instrument.record() as recorder:
+            results = check_stage(dirr, left_stage, right_stage, checks, left_prefix=left_prefix, right_prefix=right_prefix,
+                                  meaningful=meaningful, diff_budget=diff_budget)
+        results['profile'] = recorder.to_dict()
+        return results
+    left = left_prefix if left_stage == 'onload' else f'{left_prefix}_{left_stage.split("_")[1]}'
+    right = right_prefix if right_stage == 'onload' else f'{right_prefix}_{right_stage.split("_")[1]}'
+    results = {}
+    # * fidex_check and layout_check share the loaded pages and trees
+    session = None
+    if 'fidex' in checks or 'layout' in checks:
+        session = check_utils.DiffSession(LoadInfo(dirr, left), LoadInfo(dirr, right))
+        instrument.count('left_elements', len(session.left_info.elements))
+        instrument.count('right_elements', len(session.right_info.elements))
+    for check, js_comp in [('fidex', True), ('layout', False)]:
+        if check not in checks:
+            continue
+        budget = myers.Budget(**diff_budget) if diff_budget is not None else None
+        with instrument.step(f'{check}_check'):
+            diff, uniques = fidelity_issue(dirr, left, right, meaningful=meaningful, js_comp=js_comp, session=session, budget=budget)
+        budget_exceeded = budget.exceeded if budget is not None else None
+        results[check] = (diff, uniques, budget_exceeded) if check == 'fidex' else (diff, budget_exceeded)
+    if 'screenshot' in checks:
+        with instrument.step('screenshot_check'):
+            s_simi, s_diff_array = fidelity_issue_screenshot(dirr, left, right)
+        # Diff image is only written if different
+        results['screenshot'] = (s_simi, s_diff_array if s_simi < 1 else None)
+    if 'more_errs' in checks:
+        with instrument.step('more_errs_check'):
+            results['more_errs'] = fidelity_issue_more_errs(dirr, left, right, left_stage)
+    if 'html_text' in checks:
+        with instrument.step('html_text_check'):
+            results['html_text'] = fidelity_issue_text(dirr, left, right)
+    return results
+
+
 class FidelityDetector:
     def __init__(self, dirr, left_prefix='live', right_prefix='archive', 
                  fidex_check=True, layout_check=False, screenshot=False, more_errs=False, html_text=False, 
-                 meaningful=True):
+                 meaningful=True, diff_budget=None, profile=None):
+        """
+        Args:
+            diff_budget (dict): Optional kwargs of myers.Budget (max_d, timeout) for fidex_check and layout_check.
+                                Only tells whether a stage differs, unique elements can be partial once exceeded
+            profile (bool | str): Record step times and counters of each stage (see instrument) into info['profile'].
+                                  If a path, the record is also appended to that JSONL file
+        """
         self.dirr = dirr
         self.left_prefix = left_prefix
         self.right_prefix = right_prefix
@@ -166,6 +283,13 @@ class FidelityDetector:
         self.more_errs = more_errs
         self.html_text = html_text
         self.meaningful = meaningful
+        self.diff_budget = diff_budget
+        # Number of layout diffs run / out of budget
+        self.diff_budget_stats = {'bounded': 0, 'exceeded': 0}
+        self.profile = profile
+        # Instrument records of the checked stages, in order
+        self.profile_stages = []
+        self.start_time = time.time()
         self.diff = False
         self.diff_stage = None
         self.layout_diff = False
@@ -173,6 +297,7 @@ class FidelityDetector:
         self.screenshot_diff = False
         self.screenshot_diff_stage = None
         self.screenshot_simi = None
+        self.screenshot_diff_image = None
         self.more_errs_diff = False
         self.more_errs_diff_stage = None
         self.more_errs_num = None
@@ -184,12 +309,38 @@ class FidelityDetector:
         self.left_unique = []
         self.right_unique = []
     
+    def pending_checks(self) -> set:
+        """Enabled checks that have not found a diff so far"""
+        checks = {'fidex': self.fidex_check and not self.diff,
+                  'layout': self.layout_check and not self.layout_diff,
+                  'screenshot': self.screenshot and not self.screenshot_diff,
+                  'more_errs': self.more_errs and not self.more_errs_diff,
+                  'html_text': self.html_text and not self.html_text_diff}
+        return {check for check, pending in checks.items() if pending}
+
+    def _record_budget(self, exceeded):
+        if exceeded is None:
+            return
+        self.diff_budget_stats['bounded'] += 1
+        self.diff_budget_stats['exceeded'] += exceeded
+
     def detect_stage(self, left_stage, right_stage) -> "Tuple(bool, bool, bool, bool)":
-        left = self.left_prefix if left_stage == 'onload' else f'{self.left_prefix}_{left_stage.split("_")[1]}'
-        right = self.right_prefix if right_stage == 'onload' else f'{self.right_prefix}_{right_stage.split("_")[1]}'
-        if self.fidex_check and not self.diff:
+        results = check_stage(self.dirr, left_stage, right_stage, self.pending_checks(), left_prefix=self.left_prefix,
+                              right_prefix=self.right_prefix, meaningful=self.meaningful, diff_budget=self.diff_budget,
+                              profile=bool(self.profile))
+        return self.merge_stage(left_stage, results)
+
+    def merge_stage(self, left_stage, results: dict) -> "Tuple(bool, bool, bool, bool)":
+        """
+        Merge the check_stage results of a stage. Stages have to be merged in order, 
+        and only checks still pending are merged (results of later stages may include more)
+        """
+        if 'profile' in results:
+            self.profile_stages.append({'stage': left_stage, **results['profile']})
+        if 'fidex' in results and self.fidex_check and not self.diff:
             # Only check fidelity issue if no diff found so far
-            diff, (left_unique, right_unique) = fidelity_issue(self.dirr, left, right, meaningful=self.meaningful)
+            diff, (left_unique, right_unique), budget_exceeded = results['fidex']
+            self._record_budget(budget_exceeded)
             diff = to_python_type(diff)
             self.diff = to_python_type(self.diff or diff)
             if self.diff:
@@ -197,33 +348,36 @@ class FidelityDetector:
                 self.diff_stage = left_stage
                 self.left_unique = left_unique
                 self.right_unique = right_unique
-        if self.layout_check and not self.layout_diff:
-            layout_diff, (left_unique, right_unique) = fidelity_issue(self.dirr, left, right, meaningful=self.meaningful, js_comp=False)
+        if 'layout' in results and self.layout_check and not self.layout_diff:
+            layout_diff, budget_exceeded = results['layout']
+            self._record_budget(budget_exceeded)
             layout_diff = to_python_type(layout_diff)
             self.layout_diff = to_python_type(self.layout_diff or layout_diff)
             if self.layout_diff:
                 self.layout_diff_stage = left_stage
-        if self.screenshot and not self.screenshot_diff:
-            s_simi, s_diff_array = fidelity_issue_screenshot(self.dirr, left, right)
-            # Convert numpy float to Python float (compare_screenshot returns numpy.float64)
+        if 'screenshot' in results and self.screenshot and not self.screenshot_diff:
+            s_simi, s_diff_array = results['screenshot']
+            # screenshot_diff already returns a Python float, converted like the other checks' results
             s_simi = to_python_type(s_simi)
-            s_diff = to_python_type(s_simi < 1)  # Ensure Python bool, not numpy.bool_
+            s_diff = to_python_type(s_simi < 1)
             if s_diff:
-                cv2.imwrite(f"{self.dirr}/diff_{self.right_prefix}.jpg", s_diff_array)
+                # Kept encoded, so that cached results can write it down again (see fidelity_issue_all)
+                self.screenshot_diff_image = cv2.imencode('.jpg', s_diff_array)[1].tobytes()
+                write_diff_image(self.dirr, self.right_prefix, self.screenshot_diff_image)
             self.screenshot_diff = to_python_type(self.screenshot_diff or s_diff)
             if self.screenshot_diff:
                 self.screenshot_diff_stage = left_stage
                 self.screenshot_simi = s_simi
-        if self.more_errs and not self.more_errs_diff:
-            m_diff, m_errs = fidelity_issue_more_errs(self.dirr, left, right, left_stage)
+        if 'more_errs' in results and self.more_errs and not self.more_errs_diff:
+            m_diff, m_errs = results['more_errs']
             m_diff = to_python_type(m_diff)
             self.more_errs_diff = to_python_type(self.more_errs_diff or m_diff)
             if self.more_errs_diff:
                 self.more_errs_diff_stage = left_stage
                 self.more_errs_num = len(m_errs)
                 self.more_errs_list = m_errs
-        if self.html_text and not self.html_text_diff:
-            t_diff, t_simi = fidelity_issue_text(self.dirr, left, right)
+        if 'html_text' in results and self.html_text and not self.html_text_diff:
+            t_diff, t_simi = results['html_text']
             # Convert to Python types (though likely already Python types)
             t_simi = to_python_type(t_simi)
             t_diff = to_python_type(t_diff)
@@ -238,11 +392,20 @@ class FidelityDetector:
                 (not self.html_text or self.html_text_diff)
     
     def extra_interaction(self, need_exist=True):
+        if not self.profile:
+            return self._extra_interaction(need_exist=need_exist)
+        with instrument.record() as recorder:
+            extra = self._extra_interaction(need_exist=need_exist)
+        self.profile_stages.append({'stage': 'extraInteraction', **recorder.to_dict()})
+        return extra
+
+    def _extra_interaction(self, need_exist=True):
         left_info = LoadInfo(self.dirr, self.left_prefix)
         right_info = LoadInfo(self.dirr, self.right_prefix)
         left_info.read_events(available=need_exist), right_info.read_events(available=need_exist)
         left_info.gen_xpath_map(), right_info.gen_xpath_map()
-        left_unique_events, right_unique_events, left_common_events, right_common_events = check_utils.diff_interaction(left_info, right_info)
+        with instrument.step('interaction_diff'):
+            left_unique_events, right_unique_events, left_common_events, right_common_events = check_utils.diff_interaction(left_info, right_info)
         self.left_common_events = left_common_events
         self.right_common_events = right_common_events
         left_unique_events = [e for e in left_unique_events if check_meaningful.meaningful_interaction(e, elements_map=left_info.elements_map)]
@@ -257,7 +420,11 @@ class FidelityDetector:
             self.right_unique = [[e.xpath] for e in right_unique_events]
         return len(left_unique_events) > 0
     
-    def generate_result(self, writedown=True) -> FidelityResult:
+    def generate_result(self, writedown=True, cache_entry=None) -> FidelityResult:
+        """
+        Args:
+            cache_entry (dict): {'options', 'key'} of the result in result_cache, written down with the result
+        """
         info = {
             'hostname': self.dirr,
             'diff': self.diff,
@@ -274,26 +441,95 @@ class FidelityDetector:
             'more_errs_num': self.more_errs_num,
             'text_similarity': self.html_text_simi,
         }
-        # ! If comment, temp
-        if writedown:
-            json.dump({
-                'info': info,
-                'live_unique': self.left_unique,
-                'archive_unique': self.right_unique,
-                'more_errs': self.more_errs_list
-            }, open(f"{self.dirr}/diff_{self.left_prefix}_{self.right_prefix}.json", 'w'), indent=2)
-        # ! End of temp comment
-        return FidelityResult(info=info, 
+        if self.diff_budget is not None:
+            info['diff_budget_stats'] = dict(self.diff_budget_stats)
+        if self.profile:
+            info['profile'] = {'time': round(time.time() - self.start_time, 6), 'stages': self.profile_stages}
+            if isinstance(self.profile, str):
+                instrument.write_jsonl(self.profile, {'hostname': self.dirr, 'left_prefix': self.left_prefix,
+                                                      'right_prefix': self.right_prefix, 'diff_stage': self.diff_stage,
+                                                      **info['profile']})
+        result = FidelityResult(info=info, 
             live_unique=self.left_unique,
             archive_unique=self.right_unique,
             more_errs=self.more_errs_list)
+        # ! If comment, temp
+        if writedown:
+            write_result(self.dirr, self.left_prefix, self.right_prefix, result, cache_entry=cache_entry)
+        # ! End of temp comment
+        return result
+
+def write_diff_image(dirr, right_prefix, diff_image: bytes):
+    with open(f"{dirr}/diff_{right_prefix}.jpg", 'wb') as f:
+        f.write(diff_image)
+
+def write_result(dirr, left_prefix, right_prefix, result: FidelityResult, cache_entry=None):
+    """
+    Write down result as diff_{left_prefix}_{right_prefix}.json.
+    With cache_entry ({'options', 'key'}, see result_cache_key), readers can tell whether it is still up to date
+    """
+    diff_dict = {
+        'info': result.info,
+        'live_unique': result.live_unique,
+        'archive_unique': result.archive_unique,
+        'more_errs': result.more_errs
+    }
+    if cache_entry is not None:
+        diff_dict['result_cache'] = cache_entry
+    json.dump(diff_dict, open(f"{dirr}/diff_{left_prefix}_{right_prefix}.json", 'w'), indent=2)
+
+def result_cache_key(dirr, left_prefix='live', right_prefix='archive', **options) -> str:
+    """
+    result_cache key of fidelity_issue_all with options (all of them except writedown, workers, cache and profile)
+    on the current artifacts of both prefixes
+    """
+    return result_cache.cache_key(dirr, [left_prefix, right_prefix], noise_rules=check_meaningful.config_rules(),
+                                  **options)
 
 def fidelity_issue_all(dirr, left_prefix='live', right_prefix='archive', 
                        fidex_check=True, layout_check=False, screenshot=False, more_errs=False, html_text=False,
-                       meaningful=True, need_exist=True, finish_all=False, writedown=True) -> FidelityResult:
+                       meaningful=True, need_exist=True, finish_all=False, writedown=True, diff_budget=None,
+                       workers=None, cache=False, profile=None) -> FidelityResult:
     """
     Check fidelity issue for all stages (i.e. onload, extraInteraction, and interaction)
+
+    Args:
+        diff_budget (dict): Optional limits of the layout diffs (see FidelityDetector)
+        workers (int): If > 1, check interaction stages on a shared pool of workers processes (see shutdown_pool).
+                       Same result as sequential
+        cache (bool): Reuse the result of a previous call if the artifacts of both prefixes, the options, the noise
+                      rules of the config and the code are unchanged (see result_cache)
+        profile (bool | str): Record step times and counters of each stage in info['profile'], 
+                              and also append them to a JSONL file if a path (see FidelityDetector). Skips the cache
     """
+    options = dict(fidex_check=fidex_check, layout_check=layout_check, screenshot=screenshot, more_errs=more_errs,
+                   html_text=html_text, meaningful=meaningful, need_exist=need_exist, finish_all=finish_all,
+                   diff_budget=diff_budget)
+    if cache and not profile:
+        name = result_cache.entry_name(f'fidelity_{left_prefix}_{right_prefix}', **options)
+        key = result_cache_key(dirr, left_prefix, right_prefix, **options)
+        cached = result_cache.lookup(dirr, name, key)
+        if cached is None:
+            fidelity_detector = _detect_all(dirr, left_prefix, right_prefix, workers=workers, **options)
+            result = fidelity_detector.generate_result(writedown=writedown, cache_entry={'options': options, 'key': key})
+            # * The screenshot diff image is cached too, to write down the same outputs on hits
+            result_cache.store(dirr, name, key, (result, fidelity_detector.screenshot_diff_image))
+            return result
+        result, diff_image = cached
+        if writedown:
+            if diff_image is not None:
+                write_diff_image(dirr, right_prefix, diff_image)
+            write_result(dirr, left_prefix, right_prefix, result, cache_entry={'options': options, 'key': key})
+        return result
+    fidelity_detector = _detect_all(dirr, left_prefix, right_prefix, workers=workers, profile=profile, **options)
+    cache_entry = {'options': options, 'key': result_cache_key(dirr, left_prefix, right_prefix, **options)} if writedown else None
+    return fidelity_detector.generate_result(writedown=writedown, cache_entry=cache_entry)
+
+
+def _detect_all(dirr, left_prefix, right_prefix, fidex_check=True, layout_check=False, screenshot=False, more_errs=False,
+                html_text=False, meaningful=True, need_exist=True, finish_all=False, diff_budget=None, workers=None,
+                profile=None) -> FidelityDetector:
+    """Detection of fidelity_issue_all, stopping at the first stage where all checks differ unless finish_all"""
     start = time.time()
     fidelity_detector = FidelityDetector(dirr, left_prefix=left_prefix, 
                                                right_prefix=right_prefix, 
@@ -302,27 +538,108 @@ def fidelity_issue_all(dirr, left_prefix='live', right_prefix='archive',
                                                screenshot=screenshot,
                                                more_errs=more_errs, 
                                                html_text=html_text,
-                                               meaningful=meaningful)
+                                               meaningful=meaningful,
+                                               diff_budget=diff_budget,
+                                               profile=profile)
     diff, l_diff, s_diff, m_diff, t_diff = fidelity_detector.detect_stage('onload', 'onload')
     if not finish_all and diff and l_diff and s_diff and m_diff and t_diff:
-        return fidelity_detector.generate_result()
+        return fidelity_detector
     logging.info(f'{dirr.split("/")[-1]} onload elasped: {time.time()-start}')
     
     # * Check extraInteraction
     extra_intact = fidelity_detector.extra_interaction(need_exist=need_exist)
     if not finish_all and extra_intact:
-        return fidelity_detector.generate_result(writedown=writedown)
+        return fidelity_detector
 
     # * Check for each interaction
+    if workers is not None and workers > 1:
+        _detect_interactions_parallel(fidelity_detector, workers, need_exist=need_exist, finish_all=finish_all, start=start)
+        return fidelity_detector
     for left_e, right_e in zip(fidelity_detector.left_common_events, 
                                fidelity_detector.right_common_events):
-        if (not os.path.exists(f"{dirr}/{left_prefix}_{left_e.idx}_dom.json") or 
-            not os.path.exists(f"{dirr}/{right_prefix}_{right_e.idx}_dom.json")):
+        if (not dom_delta.exists(f"{dirr}/{left_prefix}_{left_e.idx}_dom.json") or 
+            not dom_delta.exists(f"{dirr}/{right_prefix}_{right_e.idx}_dom.json")):
             assert(not need_exist), f"Interaction {left_e.idx} or {right_e.idx} not found and need_exist is True"
             continue
         i, j = left_e.idx, right_e.idx
         diff, l_diff, s_diff, m_diff, t_diff = fidelity_detector.detect_stage(f'interaction_{i}', f'interaction_{j}')
         logging.info(f'{dirr.split("/")[-1]}, {i+1}/{len(fidelity_detector.left_common_events)} elasped: {time.time()-start}')
         if not finish_all and diff and l_diff and s_diff and m_diff and t_diff:
-            return fidelity_detector.generate_result(writedown=writedown)
-    return fidelity_detector.generate_result(writedown=writedown)
\ No newline at end of file
+            return fidelity_detector
+    return fidelity_detector
+
+
+# * Pool of fidelity_issue_all(workers=...), kept across calls so that worker processes (and their load caches)
+# * are only started once per process
+_pool = None
+_pool_workers = None
+
+def _get_pool(workers) -> ProcessPoolExecutor:
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        shutdown_pool()
+        _pool = ProcessPoolExecutor(max_workers=workers)
+        _pool_workers = workers
+    return _pool
+
+def shutdown_pool():
+    """Shut down the pool of fidelity_issue_all(workers=...), cancelling the stages not started yet"""
+    global _pool, _pool_workers
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool, _pool_workers = None, None
+
+atexit.register(shutdown_pool)
+
+
+def _detect_interactions_parallel(fidelity_detector: FidelityDetector, workers, need_exist=True, finish_all=False, start=None):
+    """
+    Check the interaction stages of fidelity_detector on the pool.
+    At most workers stages are in flight. Results are merged in stage order, and each stage is submitted with the checks
+    still pending after all merged stages, so the result is the same as checking the stages one by one.
+    Once all checks differ, no more stages are submitted and the later ones in flight are cancelled.
+    """
+    dirr = fidelity_detector.dirr
+    left_prefix, right_prefix = fidelity_detector.left_prefix, fidelity_detector.right_prefix
+    stages = iter(zip(fidelity_detector.left_common_events, fidelity_detector.right_common_events))
+    in_flight = deque()
+    executor = _get_pool(workers)
+
+    def submit():
+        for left_e, right_e in stages:
+            if (not dom_delta.exists(f"{dirr}/{left_prefix}_{left_e.idx}_dom.json") or 
+                not dom_delta.exists(f"{dirr}/{right_prefix}_{right_e.idx}_dom.json")):
+                if not need_exist:
+                    continue
+                # * Raised when merged, same as sequential
+                in_flight.append((left_e.idx, right_e.idx, None))
+                return
+            i, j = left_e.idx, right_e.idx
+            future = executor.submit(check_stage, dirr, f'interaction_{i}', f'interaction_{j}', 
+                                     fidelity_detector.pending_checks(), left_prefix=left_prefix, right_prefix=right_prefix,
+                                     meaningful=fidelity_detector.meaningful, diff_budget=fidelity_detector.diff_budget,
+                                     profile=bool(fidelity_detector.profile))
+            in_flight.append((i, j, future))
+            return
+
+    try:
+        for _ in range(workers):
+            submit()
+        while in_flight:
+            i, j, future = in_flight.popleft()
+            assert(future is not None), f"Interaction {i} or {j} not found and need_exist is True"
+            all_diff = all(fidelity_detector.merge_stage(f'interaction_{i}', future.result()))
+            logging.info(f'{dirr.split("/")[-1]}, {i+1}/{len(fidelity_detector.left_common_events)} elasped: {time.time()-start}')
+            if not finish_all and all_diff:
+                return
+            submit()
+    except BrokenProcessPool:
+        # * A worker died, the next call starts a new pool
+        shutdown_pool()
+        raise
+    finally:
+        # * Results of later stages are not needed. Stages already running can't be cancelled,
+        # * they finish on the pool in the background and are dropped
+        for _, _, future in in_flight:
+            if future is not None:
+                future.cancel()
\ No newline at end of file
@@ -32,8 +32,42 @@ def diff_rectangle(left, right):
     else:
         return []
 
-def calculate_total_area(rectangles):
-    """Apply sweep-line algorithm to calculate the total area of the rectangles, each rect in the format of (width, height, top, left)"""
+class _CoverageTree:
+    """
+    Union length of the active y intervals of the sweep, on the compressed y coordinates.
+    An interval adds 1 to the count of the O(log n) nodes spanning it (never pushed down),
+    and each node keeps its covered length: all of it if counted, otherwise the sum of its children's.
+    """
+    def __init__(self, ys: list):
+        self.ys = ys
+        self.n = len(ys) - 1
+        size = 4 * max(self.n, 1)
+        self.count = [0] * size
+        self.covered = [0] * size
+
+    def add(self, y1: int, y2: int, delta: int, node=1, lo=0, hi=None):
+        """Add delta to the count of the compressed interval [y1, y2)"""
+        if hi is None:
+            hi = self.n
+        if y1 <= lo and hi <= y2:
+            self.count[node] += delta
+        else:
+            mid = (lo + hi) // 2
+            if y1 < mid:
+                self.add(y1, y2, delta, 2 * node, lo, mid)
+            if y2 > mid:
+                self.add(y1, y2, delta, 2 * node + 1, mid, hi)
+        if self.count[node] > 0:
+            self.covered[node] = self.ys[hi] - self.ys[lo]
+        else:
+            self.covered[node] = 0 if hi - lo == 1 else self.covered[2 * node] + self.covered[2 * node + 1]
+
+    def length(self):
+        return self.covered[1] if self.n > 0 else 0
+
+
+def _sweep_scaled_area(rectangles):
+    """Sweep line re-merging the active intervals on every x, for rectangles with any scale"""
     events = []
     for (width, height, top, left, scale) in rectangles:
         start = left
@@ -80,7 +114,6 @@ def calculate_total_area(rectangles):
             last_x = x
 
         # Updating the active interval list with scale changes
-        # This part of the code could be optimized with a better data structure for interval management
         i = 0
         while i < len(active_intervals):
             if active_intervals[i][0] == y1 and active_intervals[i][1] == y2:
@@ -98,6 +131,44 @@ def calculate_total_area(rectangles):
     return total_area
 
 
+def calculate_total_area(rectangles):
+    """
+    Apply sweep-line algorithm to calculate the total area of the rectangles, each rect in the format of (width, height, top, left, scale)
+    Rectangles with scale 1 (all of fidelity_issue_impact's) are swept on a _CoverageTree in O(n log n),
+    any other scale (or negative height) on _sweep_scaled_area. Both give the same area
+    """
+    if any(scale != 1 or height < 0 for (_, height, _, _, scale) in rectangles):
+        return _sweep_scaled_area(rectangles)
+    ys = sorted({y for (_, height, top, _, _) in rectangles for y in (top, top + height)})
+    y_idxs = {y: i for i, y in enumerate(ys)}
+    events = []
+    for (width, height, top, left, _) in rectangles:
+        interval = (y_idxs[top], y_idxs[top + height])
+        events.append((left, 0, interval))  # Start of rectangle
+        events.append((left + width, 1, interval))   # End of rectangle
+    # Starts before ends on the same x
+    events.sort(key=lambda x: x[:2])
+    tree = _CoverageTree(ys)
+    # ! Same as _sweep_scaled_area, rectangles with the same y interval share one active interval:
+    # ! it is added by the first start and removed by the first end after that
+    active = set()
+    last_x = 0
+    total_area = 0
+    for x, end, interval in events:
+        if x != last_x:
+            # Calculate the area contribution from last_x to current x
+            total_area += tree.length() * (x - last_x)
+            last_x = x
+        if end == (interval in active):
+            if interval[0] < interval[1]:
+                tree.add(*interval, -1 if end else 1)
+            if end:
+                active.remove(interval)
+            else:
+                active.add(interval)
+    return total_area
+
+
 def _get_dimem(dimensions, xpaths):
     new_dimensions = {}
     for xpath in xpaths:
@@ -226,14 +297,27 @@ def total_space(dimensions: list) -> tuple:
     return max_width * max_height, (max_width, max_height)
 
 
+def _load_fidelity_result(dirr, left_prefix, right_prefix) -> "fidelity_detect.FidelityResult":
+    """
+    The existing diff_{left_prefix}_{right_prefix}.json, as produced by the measurement (with its own options),
+    if it is up to date: its result_cache key still matches the artifacts, options and code.
+    Otherwise the default fidelity check through the result cache, without writing down the diff json
+    """
+    path = f'{dirr}/diff_{left_prefix}_{right_prefix}.json'
+    if os.path.exists(path):
+        diff_dict = json.load(open(path))
+        cache_entry = diff_dict.get('result_cache')
+        if cache_entry is not None and \
+            fidelity_detect.result_cache_key(dirr, left_prefix, right_prefix, **cache_entry['options']) == cache_entry['key']:
+            fidelity_result = fidelity_detect.FidelityResult(info={}, live_unique=[], archive_unique=[], more_errs=None)
+            fidelity_result.load_from_dict(diff_dict)
+            return fidelity_result
+    return fidelity_detect.fidelity_issue_all(dirr, left_prefix, right_prefix, writedown=False, cache=True)
+
+
 def fidelity_issue_impact(dirr, left_prefix='live', right_prefix='archive') -> float:
     """Returns: Rectangle area of the fidelity issue"""
-    fidelity_result = fidelity_detect.FidelityResult(info={}, live_unique=[], archive_unique=[], more_errs=None)
-    if os.path.exists(f'{dirr}/diff_{left_prefix}_{right_prefix}.json'):
-        diff_dict = json.load(open(f'{dirr}/diff_{left_prefix}_{right_prefix}.json'))
-        fidelity_result.load_from_dict(diff_dict)
-    else:
-        fidelity_result = fidelity_detect.fidelity_issue_all(dirr, left_prefix, right_prefix)
+    fidelity_result = _load_fidelity_result(dirr, left_prefix, right_prefix)
     if not fidelity_result.info['diff']:
         return 0, 0
     diff_stage = fidelity_result.info['diff_stage']
@@ -254,12 +338,7 @@ def fidelity_issue_impact(dirr, left_prefix='live', right_prefix='archive') -> f
 
 def fidelity_issue_impact_heatmap(dirr, left_prefix='live', right_prefix='archive') -> np.ndarray:
     """Returns: Heatmap array of the fidelity issue"""
-    fidelity_result = fidelity_detect.FidelityResult(info={}, live_unique=[], archive_unique=[], more_errs=None)
-    if os.path.exists(f'{dirr}/diff_{left_prefix}_{right_prefix}.json'):
-        diff_dict = json.load(open(f'{dirr}/diff_{left_prefix}_{right_prefix}.json'))
-        fidelity_result.load_from_dict(diff_dict)
-    else:
-        fidelity_result = fidelity_detect.fidelity_issue_all(dirr, left_prefix, right_prefix)
+    fidelity_result = _load_fidelity_result(dirr, left_prefix, right_prefix)
     if not fidelity_result.info['diff']:
         return np.zeros(RESOLUTION)
     diff_stage = fidelity_result.info['diff_stage']
@@ -0,0 +1,88 @@
+"""
+Lightweight instrumentation of the fidelity check: wall time of named steps and counters
+
+Steps are timed with `with instrument.step('myers_diff'):`, and counters are added with instrument.count(name, n).
+Both do nothing unless a Recorder is active (see record), so the hot paths only pay a global lookup when not profiling.
+Each stage is checked under its own Recorder (see fidelity_detect.check_stage), returned with the stage results.
+
+Summarize a JSONL file of records: python -m fidex.fidelity_check.instrument <path>
+"""
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+_active = None
+
+
+class Recorder:
+    def __init__(self):
+        # name -> seconds, summed over all runs of the step
+        self.times = {}
+        self.counts = {}
+
+    def to_dict(self) -> dict:
+        return {'time': {k: round(v, 6) for k, v in self.times.items()}, 'counts': dict(self.counts)}
+
+
+@contextmanager
+def record():
+    """Activate a new Recorder for the body, and restore the previous one after"""
+    global _active
+    prev, _active = _active, Recorder()
+    try:
+        yield _active
+    finally:
+        _active = prev
+
+
+@contextmanager
+def step(name):
+    recorder = _active
+    if recorder is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.times[name] = recorder.times.get(name, 0) + time.perf_counter() - start
+
+
+def count(name, n=1):
+    if _active is not None:
+        _active.counts[name] = _active.counts.get(name, 0) + n
+
+
+def active() -> bool:
+    return _active is not None
+
+
+def write_jsonl(path, record: dict):
+    """Append record as one line, in a single write so concurrent workers don't interleave lines"""
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def summarize(path, top=10) -> dict:
+    """
+    Aggregate a JSONL file of page records (see FidelityDetector), e.g. of a whole collection run
+
+    Returns:
+        dict: time and counts summed by step over all stages of all pages, and the slowest pages
+    """
+    times, counts, pages = {}, {}, []
+    with open(path) as f:
+        for line in f:
+            page = json.loads(line)
+            pages.append((page['time'], page['hostname']))
+            for stage in page['stages']:
+                for k, v in stage['time'].items():
+                    times[k] = times.get(k, 0) + v
+                for k, v in stage['counts'].items():
+                    counts[k] = counts.get(k, 0) + v
+    return {'pages': len(pages), 'time': times, 'counts': counts, 'slowest': sorted(pages, reverse=True)[:top]}
+
+
+if __name__ == '__main__':
+    print(json.dumps(summarize(sys.argv[1]), indent=2))
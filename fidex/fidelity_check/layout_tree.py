@@ -1,12 +1,12 @@
 from bs4 import BeautifulSoup, Tag
+from bs4.builder import HTMLTreeBuilder, nonwhitespace_re
 from urllib.parse import unquote
-from collections import namedtuple
 import re, os
 import json, time
 import html
 import functools
 
-from fidex.fidelity_check import js_writes
+from fidex.fidelity_check import instrument, js_writes, myers
 from fidex.utils import url_utils, common
 
 CSS_ANIMATION_STYLES = [
@@ -33,29 +33,112 @@ FILTERED_STYLES = CSS_ANIMATION_STYLES + [
     'display', 
 ]
 
-def _filter_style(style, filter_keys=FILTERED_STYLES):
-    """Add style and throw away certain attr"""
+# Same tolerant patterns html.parser (used by BeautifulSoup) applies to a start tag
+_TAGFIND = re.compile(r'([a-zA-Z][^\t\n\r\f />\x00]*)(?:\s|/(?!>))*')
+_ATTRFIND = re.compile(
+    r'((?<=[\'"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*'
+    r'(\'[^\']*\'|"[^"]*"|(?![\'"])[^>\s]*))?(?:\s|/(?!>))*')
+_LOCATE_STARTTAG_END = re.compile(r"""
+  <[a-zA-Z][^\t\n\r\f />\x00]*       # tag name
+  (?:[\s/]*                          # optional whitespace before attribute name
+    (?:(?<=['"\s/])[^\s/>][^\s/=>]*  # attribute name
+      (?:\s*=+\s*                    # value indicator
+        (?:'[^']*'                   # LITA-enclosed value
+          |"[^"]*"                   # LIT-enclosed value
+          |(?!['"])[^>\s]*           # bare value
+         )
+        \s*                          # possibly followed by a space
+       )?(?:\s|/(?!>))*
+     )*
+   )?
+  \s*                                # trailing whitespace
+""", re.VERBOSE)
+_CDATA_LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+
+def _parse_start_tag(text):
+    """Tokenize the leading start tag of an element's serialized text without building a soup
+
+    Returns:
+        (str, dict): tag name and attributes the same way BeautifulSoup's html.parser would give them,
+                     or None if the text does not start with a plain start tag (caller should fall back to BeautifulSoup)
+    """
+    m = _LOCATE_STARTTAG_END.match(text)
+    if m is None:
+        return None
+    endpos = m.end()
+    if text.startswith('>', endpos):
+        endpos += 1
+    elif text.startswith('/>', endpos):
+        endpos += 2
+    else:
+        return None
+    match = _TAGFIND.match(text, 1)
+    k = match.end()
+    tagname = match.group(1).lower()
+    attrs = {}
+    while k < endpos:
+        m = _ATTRFIND.match(text, k)
+        if not m:
+            break
+        attrname, rest, attrvalue = m.group(1, 2, 3)
+        if not rest:
+            attrvalue = ''
+        elif attrvalue[:1] == '\'' == attrvalue[-1:] or \
+             attrvalue[:1] == '"' == attrvalue[-1:]:
+            attrvalue = attrvalue[1:-1]
+        if attrvalue:
+            attrvalue = html.unescape(attrvalue)
+        # Duplicated attributes: last one wins, same as BeautifulSoup
+        attrs[attrname.lower()] = attrvalue
+        k = m.end()
+    if text[k:endpos].strip() not in ('>', '/>'):
+        return None
+    # Multi-valued attributes (e.g. class) are split into lists by BeautifulSoup
+    for tag_key in ['*', tagname]:
+        for attr in _CDATA_LIST_ATTRIBUTES.get(tag_key, []):
+            if attr in attrs and isinstance(attrs[attr], str):
+                attrs[attr] = nonwhitespace_re.findall(attrs[attr])
+    return tagname, attrs
+
+# Inline styles repeat a lot within and across pages
+STYLE_CACHE_SIZE = 1 << 16
+_STYLE_SEMICOLON = re.compile(r';\s+')
+_STYLE_COLON = re.compile(r':\s+')
+# Split by ; outside of quotes
+_STYLE_SPLIT = re.compile(r';(?=(?:[^\'"]|\'[^\']*\'|"[^"]*")*$)')
+
+@functools.lru_cache(maxsize=None)
+def _style_filter_pattern(filter_keys: tuple) -> re.Pattern:
+    """One pattern that matches a property iff any of filter_keys matches it"""
+    if len(filter_keys) == 0:
+        return re.compile(r'(?!)')
+    return re.compile('|'.join(f'(?:{k})' for k in filter_keys))
+
+@functools.lru_cache(maxsize=STYLE_CACHE_SIZE)
+def _canonical_style(style: str, filter_keys: tuple) -> str:
     # Strip the ending ;
     style = html.unescape(style)
-    style = re.sub(r';\s+', ';', style.strip(';'))
+    style = _STYLE_SEMICOLON.sub(';', style.strip(';'))
     new_style = []
-    filter_keys = [re.compile(k) for k in filter_keys]
-    pattern = r';(?=(?:[^\'"]|\'[^\']*\'|"[^"]*")*$)'
-    for s in sorted(re.split(pattern, style)):
+    filter_pattern = _style_filter_pattern(filter_keys)
+    for s in sorted(_STYLE_SPLIT.split(style)):
         # Replace all :\s+ with :
-        s = re.sub(r':\s+', ':', s)
-        to_filter = False
+        s = _STYLE_COLON.sub(':', s)
         s_split = s.split(':')
-        for k in filter_keys:
-            if k.match(s_split[0]):
-                to_filter = True
-                break
-        if not to_filter:
+        if not filter_pattern.match(s_split[0]):
             if len(s_split) > 1:
                 s_split[1] = ' '.join(sorted(s_split[1].split()))
             new_style.append(': '.join(s_split))
     return ';'.join(new_style)
 
+def _filter_style(style, filter_keys=FILTERED_STYLES):
+    """Add style and throw away certain attr (memoized, see style_cache_info)"""
+    return _canonical_style(style, tuple(filter_keys))
+
+def style_cache_info():
+    """Hits and misses of the _filter_style cache"""
+    return _canonical_style.cache_info()
+
 
 def _sibling_xpath(path1, path2, max_diff=1, only_last=False):
     """Check if path1 and path2 are siblings (same length, differ by one element)
@@ -132,28 +215,12 @@ def js_dynamism_self_eq(e1, e2):
     If two elements have the same set of stack traces of writes
     """
     if len(e1.writes) + len(e2.writes) > 0:
-        e1_related_writes, e2_related_writes = [], []
-        if e1.parent:
-            e1_related_writes = [w for e in e1.parent.children for w in e.writes]
-        else:
-            e1_related_writes = e1.writes
-        if e2.parent:
-            e2_related_writes = [w for e in e2.parent.children for w in e.writes]
-        else:
-            e2_related_writes = e2.writes
-        # e1_related_writes = e1.writes
-        # e2_related_writes = e2.writes
-
-        e1_subset = set(e1_related_writes).issubset(set(e2_related_writes))
-        e2_subset = set(e2_related_writes).issubset(set(e1_related_writes))
-        if e1_subset and e2_subset:
+        # * Related writes are the writes on all children of the parent (see LayoutElement.related_writes)
+        e1_related_writes, e1_related_writes_plain = e1.related_writes
+        e2_related_writes, e2_related_writes_plain = e2.related_writes
+        if e1_related_writes == e2_related_writes:
             return True
-        
-        e1_related_writes_plain = [w.plain_form for w in e1_related_writes]
-        e2_related_writes_plain = [w.plain_form for w in e2_related_writes]
-        e1_subset = set(e1_related_writes_plain).issubset(set(e2_related_writes_plain))
-        e2_subset = set(e2_related_writes_plain).issubset(set(e1_related_writes_plain))
-        if e1_subset and e2_subset:
+        if e1_related_writes_plain == e2_related_writes_plain:
             return True
     return False
 
@@ -170,12 +237,11 @@ def css_dynamism_self_eq(e1, e2):
         return True
     if e1.extraAttr.get('animation') and e2.extraAttr.get('animation'):
         return True
-    if not isinstance(e1.tag, Tag) or not isinstance(e2.tag, Tag):
+    # attrs is None iff the text is not a tag
+    if e1.attrs is None or e2.attrs is None:
         return False
-    if 'style' in e1.tag.attrs and 'style' in e2.tag.attrs:
-        s1 = _filter_style(e1.tag.attrs['style'], filter_keys=CSS_ANIMATION_STYLES)
-        s2 = _filter_style(e2.tag.attrs['style'], filter_keys=CSS_ANIMATION_STYLES)
-        if s1 == s2:
+    if e1.static_style is not None and e2.static_style is not None:
+        if e1.static_style == e2.static_style:
             return True
     return False
 
@@ -194,8 +260,7 @@ class LayoutElement:
         self.xpath = element['xpath']
         self.text = element['text']
         self.extraAttr = element.get('extraAttr', {})
-        self.tag = self._get_tag()
-        self.tagname = self.tag.name if isinstance(self.tag, Tag) else self.tag
+        self.tagname, self.attrs = self._get_tagname_attrs()
         self.id = self._get_id()
         self.writes = []
         self.verbose_writes = []
@@ -204,6 +269,11 @@ class LayoutElement:
 
         self.children = []
         self.parent = None
+        # Position among parent's children
+        self.sibling_idx = 0
+        # Pre-order interval [pre, post] of the subtree in the indexed tree (see index_tree)
+        self.pre, self.post = None, None
+        self._preorder = None
     
     def _norm_href(self, href):
         if href is None:
@@ -235,15 +305,34 @@ class LayoutElement:
         return color
 
     def _get_src(self) -> set:
-        srcs = common.get_img_src(self.tag)
+        # Only called with attrs, same as the tag's attrs
+        srcs = common.get_img_src(self.attrs)
         if 'currentSrc' in self.extraAttr:
             srcs.add(url_utils.url_norm(self.extraAttr['currentSrc'], ignore_scheme=True, ignore_netloc=True, trim_www=True, trim_slash=True, archive=True))
         # TODO: Try only consider the directory part for random images orders
         srcs = set(['/'.join(s.split('/')[:-1] if s[-1]!='/' else s.split('/')[:-2]) for s in srcs])
         return srcs
     
-    def _get_tag(self):
-        """Extract tag name from the text"""
+    def _get_tagname_attrs(self):
+        """Extract tag name and attributes from the text
+        
+        Returns:
+            (str, dict): tag name and attributes. attributes is None if the text is not a tag (e.g. #text)
+        """
+        if '<' not in self.text:
+            return common.tagname_from_xpath(self.xpath), None
+        parsed = _parse_start_tag(self.text)
+        if parsed is not None:
+            return parsed
+        # Rare: Text with markup somewhere in the middle, let BeautifulSoup decide
+        tag = self.tag
+        if isinstance(tag, Tag):
+            return tag.name, tag.attrs
+        return tag, None
+
+    @functools.cached_property
+    def tag(self) -> "Tag | str":
+        """Full BeautifulSoup tag, only built on demand. Tag name if the text is not a tag"""
         tag = BeautifulSoup(self.text, 'html.parser').find()
         if tag is None:
             tagname = self.xpath.split('/')[-1].split('[')[0]
@@ -252,8 +341,8 @@ class LayoutElement:
 
     def _get_id(self):
         """Extract id from the tag"""
-        if isinstance(self.tag, Tag):
-            return self.tag.attrs.get('id', None)
+        if self.attrs is not None:
+            return self.attrs.get('id', None)
         return
 
     @functools.cached_property
@@ -263,24 +352,74 @@ class LayoutElement:
         tag_rules = {
             'img': [lambda _: self._get_src()],
             'a': [
-                # lambda a: a.attrs.get('class'), 
-                lambda a: self._norm_href(a.attrs.get('href'))],
+                # lambda attrs: attrs.get('class'), 
+                lambda attrs: self._norm_href(attrs.get('href'))],
         }
-        if isinstance(self.tag, str):
-            return [self.tag]
-        tag = self.tag
-        tagname = tag.name
+        if self.attrs is None:
+            return [self.tagname]
+        attrs = self.attrs
+        tagname = self.tagname
         features = [tagname]
         rules = tag_rules.get(tagname, []) + all_rules
         for r in rules:
-            tag_r = r(tag)
+            tag_r = r(attrs)
             if tag_r is not None:
                 features.append(tag_r)
-        if 'style' in tag.attrs and tag.attrs['style'] != '':
-            style = _filter_style(tag.attrs['style'])
+        if 'style' in attrs and attrs['style'] != '':
+            style = _filter_style(attrs['style'])
             if len(style) > 0:
                 features.append(style)
         return features
+
+    @functools.cached_property
+    def features_fingerprint(self) -> "tuple[bool, tuple]":
+        """Hashable key of features that is equal whenever features_eq is true
+
+        Returns:
+            (bool, tuple): exact (key equality implies features_eq) and the key
+        """
+        features = self.features
+        tagname = features[0].lower()
+        if tagname == '#text':
+            return True, (tagname, common.normal_text(self.text))
+        # href is matched by suffix
+        if tagname == 'a':
+            return False, (tagname, len(features))
+        # src is matched by intersection
+        if tagname == 'img':
+            return False, (tagname,) + tuple(features[2:])
+        return True, tuple(features)
+
+    @functools.cached_property
+    def static_style(self) -> "str | None":
+        """Style with animation related properties filtered out, None if there is no style attribute"""
+        if self.attrs is None or 'style' not in self.attrs:
+            return None
+        return _filter_style(self.attrs['style'], filter_keys=CSS_ANIMATION_STYLES)
+
+    @functools.cached_property
+    def static_identity(self) -> "tuple | None":
+        """Exact key that implies static matching: same serialized tag (hence same features) and same dimension
+        None if the element may not even match itself (img without any src)
+        """
+        if self.tagname == 'img':
+            features = self.features
+            if len(features) < 2 or len(features[1]) == 0:
+                return None
+        return (self.tagname, self.text, self.extraAttr.get('currentSrc'), tuple(sorted(self.dimension.items())))
+
+    @functools.cached_property
+    def children_writes(self) -> "tuple[frozenset, frozenset]":
+        """Set of writes (and their plain forms) on all children"""
+        writes = [w for c in self.children for w in c.writes]
+        return frozenset(writes), frozenset(w.plain_form for w in writes)
+
+    @property
+    def related_writes(self) -> "tuple[frozenset, frozenset]":
+        """Writes compared by js_dynamism_self_eq: the ones on all siblings (including self), or self if root"""
+        if self.parent:
+            return self.parent.children_writes
+        return frozenset(self.writes), frozenset(w.plain_form for w in self.writes)
     
     def __eq__(self, other):
         if self.tagname != other.tagname:
@@ -295,11 +434,15 @@ class LayoutElement:
         #     return True
 
         # Static matching
-        if features_eq(self, other) and dimension_eq(self, other):
+        # * Fingerprints are necessary conditions of the predicates, so most pairs are rejected without calling them
+        self_exact, self_fp = self.features_fingerprint
+        other_exact, other_fp = other.features_fingerprint
+        if self_fp == other_fp and (self_exact and other_exact or features_eq(self, other)) \
+           and dimension_eq(self, other):
             return True
         # Dynamic element that changes itself 
         # ! Temp comment out for pure layout match
-        if self.js_comp and js_dynamism_self_eq(self, other):
+        if self.js_comp and (self.writes or other.writes) and js_dynamism_self_eq(self, other):
             # Exclude body dynamic match tagging
             if self.tagname != 'body':
                 self.dynamic_matched = True
@@ -318,7 +461,7 @@ class LayoutElement:
             check_viewport (bool): If True, check if the element is in the viewport
             historical (bool): If True, check if the element is visible historically
         """
-        if self.tag == '#text':
+        if self.tagname == '#text' and self.attrs is None:
             return self.parent.visible(check_viewport=check_viewport, historical=historical, check_visibility=check_visibility)
         has_dimension = self.dimension.get('width', 0) > 0 and self.dimension.get('height', 0) > 0
         if check_viewport:
@@ -331,39 +474,61 @@ class LayoutElement:
         return has_dimension and (not check_viewport or in_viewport) and (not check_visibility or has_visibility)
 
     def ancestors(self) -> "list[LayoutElement]":
-        ancestors = []
-        cur_node = self
-        while cur_node.parent:
-            ancestors.append(cur_node.parent)
+        return list(self.iter_ancestors())
+
+    def iter_ancestors(self) -> "Iterator[LayoutElement]":
+        """Ancestors from parent to root, without building a list"""
+        cur_node = self.parent
+        while cur_node:
+            yield cur_node
             cur_node = cur_node.parent
-        return ancestors
+
+    def is_ancestor_of(self, other: "LayoutElement") -> bool:
+        if self._preorder is not None and self._preorder is other._preorder:
+            return self.pre < other.pre <= self.post
+        return any(a is self for a in other.iter_ancestors())
     
     def descendants(self) -> "list[LayoutElement]":
-        descendants = []
-        for child in self.children:
-            descendants.append(child)
-            descendants += child.descendants()
-        return descendants
+        """Descendants in pre-order. A slice of the pre-order list if the tree is indexed"""
+        if self._preorder is not None:
+            return self._preorder[self.pre+1:self.post+1]
+        return list(self.iter_descendants())
+
+    def iter_descendants(self) -> "Iterator[LayoutElement]":
+        """Descendants in pre-order, without building a list"""
+        if self._preorder is not None:
+            preorder = self._preorder
+            for i in range(self.pre+1, self.post+1):
+                yield preorder[i]
+            return
+        stack = list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def index_tree(self):
+        """Assign pre-order intervals to the subtree, so that descendant queries become range lookups"""
+        preorder = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.pre = len(preorder)
+            node._preorder = preorder
+            preorder.append(node)
+            stack.extend(reversed(node.children))
+        for node in reversed(preorder):
+            node.post = node.children[-1].post if node.children else node.pre
     
     def next_siblings(self) -> "List[LayoutElement]":
         if not self.parent:
             return None
-        idx = 0
-        while idx < len(self.parent.children):
-            if self.parent.children[idx] is self:
-                break
-            idx += 1
-        return self.parent.children[idx+1:]
+        return self.parent.children[self.sibling_idx+1:]
     
     def prev_siblings(self) -> "List[LayoutElement]":
         if not self.parent:
             return None
-        idx = 0
-        while idx < len(self.parent.children):
-            if self.parent.children[idx] is self:
-                break
-            idx += 1
-        return self.parent.children[:idx]
+        return self.parent.children[:self.sibling_idx]
 
     def tag_new_writes(self, other):
         """tag unique writes for both self and others"""
@@ -383,14 +548,28 @@ class LayoutElement:
         return False
 
     def add_child(self, child):
+        child.sibling_idx = len(self.children)
         self.children.append(child)
         child.parent = self
+        # Intervals are stale once the tree changes
+        if self._preorder is not None:
+            for node in self._preorder:
+                node._preorder = None
+        self.__dict__.pop('children_writes', None)
     
     def add_writes(self, writes: "list[js_writes.JSWrite]", effective=False):
         self.verbose_writes += writes
         if effective:
             self.writes += writes
+            if self.parent:
+                self.parent.__dict__.pop('children_writes', None)
     
+    def in_layout(self) -> bool:
+        """If the element is listed in the layout tree"""
+        if self.visible(historical=True):
+            return True
+        return self.tagname == '#text' and self.attrs is None and self.parent.visible()
+
     def list_tree(self, layout=True, layout_order=False) -> "list(LayoutElement)":
         """List all elements in the tree
         Args:
@@ -399,9 +578,7 @@ class LayoutElement:
         """
         tree_list = []
         if layout:
-            if self.visible(historical=True):
-                tree_list.append(self)
-            elif self.tag == '#text' and self.parent.visible():
+            if self.in_layout():
                 tree_list.append(self)
         else:
             tree_list.append(self)
@@ -424,7 +601,7 @@ def build_layout_tree(elements: "list[element]", writes: list, writeStacks: list
                       include_verbose_writes=False, js_comp=True) -> "Optional[LayoutElement]":
     """
     Args:
-        elements (list): List of elements
+        elements (list): List of elements, in document (DFS) order as dumped, the root first
         writes (list): List of writes
         writeStacks (list): List of write stacks
         include_verbose_writes (bool): If True, include verbose writes
@@ -436,22 +613,24 @@ def build_layout_tree(elements: "list[element]", writes: list, writeStacks: list
         dummy.all_nodes = {dummy.xpath: dummy}
         return dummy
     root_e = elements[0]
-    nodes = {root_e['xpath']: LayoutElement(root_e, js_comp=js_comp)} # {xpath: LayoutElement}
-
-    def get_parent_xpath(xpath, elements):
-        for e in reversed(elements):
-            if xpath.startswith(e['xpath']):
-                return e['xpath']
-        assert False, 'No parent found'
+    root_node = LayoutElement(root_e, js_comp=js_comp)
+    nodes = {root_e['xpath']: root_node} # {xpath: LayoutElement}
 
+    # * Elements are dumped in document (DFS) order, so the parent of each element is the
+    # * closest ancestor on the stack of open elements. Pop until the top is a prefix.
+    # * The root stays on the stack (it is a prefix of every xpath), so other orders give wrong parents.
+    ancestors = [root_node]
     for i in range(1, len(elements)):
         element = elements[i]
         xpath = element['xpath']
         layout_element = LayoutElement(element, js_comp=js_comp)
         nodes[xpath] = layout_element
-        parent_xpath = get_parent_xpath(xpath, elements[:i])
-        parent_node = nodes[parent_xpath]
-        parent_node.add_child(layout_element)
+        while not xpath.startswith(ancestors[-1].xpath):
+            ancestors.pop()
+        ancestors[-1].add_child(layout_element)
+        ancestors.append(layout_element)
+    # * Index before associating writes, which query descendants and siblings a lot
+    root_node.index_tree()
     
     # Given addEventlistener could be registered by webrecord ruffle, some wid in writes may not in stack_map
     writes_obj = [js_writes.JSWrite(w, stack_map[w['wid']]['stackInfo'], nodes) \
@@ -462,6 +641,10 @@ def build_layout_tree(elements: "list[element]", writes: list, writeStacks: list
         for xpath in w.associated_xpaths:
             if xpath in nodes:
                 nodes[xpath].add_writes([w], effective=w.effective)
+    # * Freeze the related writes of each parent once, instead of rebuilding them on every comparison
+    for node in nodes.values():
+        if node.children:
+            node.children_writes
     root_node = nodes[root_e['xpath']]
     root_node.all_writes = [w for w in writes_obj if w.currentDS.get('width', 0) > 0 and w.currentDS.get('height', 0) > 0]
     root_node.all_nodes = nodes
@@ -512,91 +695,59 @@ def _lcs_diff(left_seq, right_seq):
     return left_diff, right_diff
 
 
-def _myers_diff(left_seq, right_seq):
+def _list_tree_blocks(node, interned, tree_list, keys, spans, layout_order=False) -> "int | None":
     """
-    Impl 2: Myers diff algorithm
-    myers algorithm borrowed from https://gist.github.com/adamnew123456/37923cf53f51d6b9af32a539cdfa7cc4
+    Same listing as list_tree (layout=True), plus Merkle keys of every listed element's subtree
+    Subtrees are hash-consed in interned, so equal keys mean both subtrees list the same static identities in the same order.
+
+    Args:
+        interned (dict): {static identity or (identity key, children keys): key}, shared by the trees to be compared
+        tree_list, keys, spans (list): Filled with listed elements, their subtree keys (None if some element may not
+                                       match itself) and number of list entries in their subtrees
+    
+    Returns:
+        int: key of node's subtree
     """
-    # See frontier in myers_diff
-    Frontier = namedtuple('Frontier', ['x', 'left_diff', 'right_diff', 'left_common', 'right_common'])
-
-    # This marks the farthest-right point along each diagonal in the edit
-    # graph, along with the history that got it there
-    frontier = {1: Frontier(0, [], [], [], [])}
-
-    L = len(left_seq)
-    R = len(right_seq)
-    for d in range(0, L + R + 1):
-        for k in range(-d, d + 1, 2):
-            # This determines whether our next search point will be going down
-            # in the edit graph, or to the right.
-            #
-            # The intuition for this is that we should go down if we're on the
-            # left edge (k == -d) to make sure that the left edge is fully
-            # explored.
-            #
-            # If we aren't on the top (k != d), then only go down if going down
-            # would take us to territory that hasn't sufficiently been explored
-            # yet.
-            go_down = (k == -d or 
-                    (k != d and frontier[k - 1].x < frontier[k + 1].x))
-
-            # Figure out the starting point of this iteration. The diagonal
-            # offsets come from the geometry of the edit grid - if you're going
-            # down, your diagonal is lower, and if you're going right, your
-            # diagonal is higher.
-            if go_down:
-                x, left_diff, right_diff, left_common, right_common = frontier[k + 1]
-            else:
-                x, left_diff, right_diff, left_common, right_common = frontier[k - 1]
-                x += 1
-
-            # We want to avoid modifying the old history, since some other step
-            # may decide to use it.
-            left_diff, right_diff= left_diff.copy(), right_diff.copy()
-            left_common, right_common = left_common.copy(), right_common.copy()
-            y = x - k
-
-            # We start at the invalid point (0, 0) - we should only start building
-            # up history when we move off of it.
-            if 1 <= y <= R and go_down:
-                right_diff.append((right_seq[y-1]))
-            elif 1 <= x <= L:
-                left_diff.append(left_seq[x-1])
-
-            # Chew up as many diagonal moves as we can - these correspond to common lines,
-            # and they're considered "free" by the algorithm because we want to maximize
-            # the number of these in the output.
-            while x < L and y < R and left_seq[x] == right_seq[y]:
-                left_e, right_e = left_seq[x], right_seq[y]
-                left_common.append(left_e)
-                right_common.append(right_e)
-                x += 1
-                y += 1
-                if getattr(left_e, 'full_matched', False):
-                    while x < L and left_seq[x].xpath.startswith(left_e.xpath):
-                        left_common.append(left_seq[x])
-                        x += 1
-                if getattr(right_e, 'full_matched', False):
-                    while y < R and right_seq[y].xpath.startswith(right_e.xpath):
-                        right_common.append(right_seq[y])
-                        y += 1
-
-            if x >= L and y >= R:
-                # If we're here, then we've traversed through the bottom-left corner,
-                # and are done.
-                # print(json.dumps([e.xpath for e in left_common], indent=2))
-                # print(json.dumps([e.xpath for e in right_common], indent=2))
-                return left_diff, right_diff
-            else:
-                frontier[k] = Frontier(x, left_diff, right_diff, left_common, right_common)
+    in_layout = node.in_layout()
+    if in_layout:
+        idx = len(tree_list)
+        tree_list.append(node)
+        keys.append(None)
+        spans.append(0)
+    if layout_order:
+        children = sorted(node.children, key=lambda x: (x.dimension.get('top', 0), x.dimension.get('left', 0), x.text))
+    else:
+        children = node.children
+    child_keys = tuple([_list_tree_blocks(child, interned, tree_list, keys, spans) for child in children])
+    if in_layout:
+        identity = node.static_identity
+        identity_key = None if identity is None else interned.setdefault(identity, len(interned))
+    else:
+        identity_key = -1
+    if identity_key is None or None in child_keys:
+        key = None
+    else:
+        key = interned.setdefault((identity_key, child_keys), len(interned))
+    if in_layout:
+        keys[idx] = key
+        spans[idx] = len(tree_list) - idx
+    return key
 
-    assert False, 'Could not find edit script'
+def _myers_diff(left_seq, right_seq, blocks=None, budget=None):
+    """
+    Impl 2: Myers diff algorithm (see myers.myers_diff)
+    """
+    left_diff, right_diff, _, _ = myers.myers_diff(left_seq, right_seq, blocks=blocks, budget=budget)
+    return left_diff, right_diff
 
 def diff_layout_tree(left_layout: "LayoutElement", right_layout: "LayoutElement", 
-                     layout_order=False, js_comp=True) -> "tuple[list[LayoutElement], list[LayoutElement]]":
+                     layout_order=False, js_comp=True, listed=None, budget=None) -> "tuple[list[LayoutElement], list[LayoutElement]]":
     """
     Compute the diff between left_tree and right_tree by computing the longest common subsequence
+
+    Args:
+        listed (dict): Optional cache of both trees' listings by layout_order, for diffing the same two trees multiple times
+        budget (myers.Budget): Optional limits of the diff. If exceeded, the diff is partial (see myers.myers_diff)
         
     Returns:
         (List[LayoutElement], List[LayoutElement]): List of elements that are different, for live and archive respectively.
@@ -622,26 +773,40 @@ def diff_layout_tree(left_layout: "LayoutElement", right_layout: "LayoutElement"
         # print("Same whole write stacks", left_layout.all_writes, right_layout.all_writes)
         return [], []
 
-    left_layout_list = left_layout.list_tree(layout_order=layout_order)
-    right_layout_list = right_layout.list_tree(layout_order=layout_order)
+    # * Identical subtrees (usually most of the page) are matched in one step
+    if listed is not None and layout_order in listed:
+        left_layout_list, left_keys, left_spans, right_layout_list, right_keys = listed[layout_order]
+    else:
+        with instrument.step('list_tree'):
+            interned = {}
+            left_layout_list, left_keys, left_spans = [], [], []
+            _list_tree_blocks(left_layout, interned, left_layout_list, left_keys, left_spans, layout_order=layout_order)
+            right_layout_list, right_keys, right_spans = [], [], []
+            _list_tree_blocks(right_layout, interned, right_layout_list, right_keys, right_spans, layout_order=layout_order)
+        instrument.count('listed_elements', len(left_layout_list) + len(right_layout_list))
+        if listed is not None:
+            listed[layout_order] = (left_layout_list, left_keys, left_spans, right_layout_list, right_keys)
     # print(json.dumps([e.xpath for e in left_layout_list], indent=2))
     # print(json.dumps([e.xpath for e in right_layout_list], indent=2))
 
     # left_diff, right_diff = _lcs_diff(left_layout_list, right_layout_list)
-    left_diff, right_diff = _myers_diff(left_layout_list, right_layout_list)
+    with instrument.step('myers_diff'):
+        left_diff, right_diff = _myers_diff(left_layout_list, right_layout_list, blocks=(left_keys, right_keys, left_spans),
+                                            budget=budget)
     left_diff = [e for e in left_diff if post_diff_element(e)]
     right_diff = [e for e in right_diff if post_diff_element(e)]
     return left_diff, right_diff
 
 def diff_layout_tree_xpath(left_layout: "LayoutElement", right_layout: "LayoutElement", 
-                           layout_order=False, js_comp=True) -> "tuple[list[str], list[str]]":
+                           layout_order=False, js_comp=True, listed=None, budget=None) -> "tuple[list[str], list[str]]":
     """
     Wrapper for diff_layout_tree that returns the xpaths only
     
     Returns:
         (List[str], List[str]): List of xpaths that are different, for live and archive respectively.
     """
-    left_diff, right_diff = diff_layout_tree(left_layout, right_layout, layout_order=layout_order, js_comp=js_comp)
+    left_diff, right_diff = diff_layout_tree(left_layout, right_layout, layout_order=layout_order, js_comp=js_comp,
+                                             listed=listed, budget=budget)
     return [e.xpath for e in left_diff], [e.xpath for e in right_diff]
     
 
@@ -653,8 +818,7 @@ def post_diff_element(element: "LayoutElement") -> bool:
         return False
     # * Check if the diff could be caused by dynamic ancestors
     # * Since some writes may only change parents, but all descendants are affected
-    ancestors = element.ancestors()
-    for a in ancestors:
+    for a in element.iter_ancestors():
         if getattr(a, 'dynamic_matched', False):
             return False
     return True
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""
+Myers diff shared by layout tree and interaction events comparison
+Greedy forward search, same as https://gist.github.com/adamnew123456/37923cf53f51d6b9af32a539cdfa7cc4
+but instead of copying the history on every step, only the furthest x on each diagonal is kept per edit distance,
+and the edit script is recovered by backtracking that trace.
+The trace holds d + 1 ints for each edit distance d, so memory is O(D^2) ints for an edit distance D
+(instead of O((N+M)D) list entries when copying the history). It is not linear space: a divide-and-conquer
+(middle snake) search would be, but it compares elements in another order and may pick another of the
+equally short edit scripts, while __eq__ has side effects (e.g. LayoutElement tags dynamic_matched).
+"""
+from array import array
+import time
+
+from fidex.fidelity_check import instrument
+
+# How often bounded diffs run out of budget
+BUDGET_STATS = {'bounded': 0, 'exceeded': 0}
+
+
+class Budget:
+    """
+    Limits of a bounded diff, for callers that only need to know whether sequences differ.
+    Once exceeded, myers_diff stops and returns a partial edit script (see _partial)
+    """
+    def __init__(self, max_d=None, timeout=None):
+        """
+        Args:
+            max_d (int): Max edit distance to search
+            timeout (float): Max seconds to search
+        """
+        self.max_d = max_d
+        self.timeout = timeout
+        self.exceeded = False
+
+
+def _backtrack(trace, left_seq, right_seq, d, k):
+    """Walk the trace back from (d, k) to (0, 0) and collect the edit script in forward order"""
+    L, R = len(left_seq), len(right_seq)
+    left_diff, right_diff = [], []
+    left_common, right_common = [], []
+    while d >= 0:
+        x_end = trace[d][(k + d) // 2]
+        if d == 0:
+            go_down, x = True, 0
+        else:
+            prev = trace[d - 1]
+            go_down = (k == -d or
+                       (k != d and prev[(k - 1 + d - 1) // 2] < prev[(k + 1 + d - 1) // 2]))
+            x = prev[(k + 1 + d - 1) // 2] if go_down else prev[(k - 1 + d - 1) // 2] + 1
+        y = x - k
+        for i in range(x_end - x - 1, -1, -1):
+            left_common.append(left_seq[x + i])
+            right_common.append(right_seq[y + i])
+        # Same edit bookkeeping as the forward search (down is an insertion from right, otherwise deletion from left)
+        if 1 <= y <= R and go_down:
+            right_diff.append(right_seq[y - 1])
+        elif 1 <= x <= L:
+            left_diff.append(left_seq[x - 1])
+        k = k + 1 if go_down else k - 1
+        d -= 1
+    left_diff.reverse()
+    right_diff.reverse()
+    left_common.reverse()
+    right_common.reverse()
+    return left_diff, right_diff, left_common, right_common
+
+
+def _partial(trace, left_seq, right_seq, d):
+    """
+    Edit script of the furthest point reached after d edits, with everything after that point left unaligned
+    It is a valid edit script, just not the minimal one
+    """
+    L, R = len(left_seq), len(right_seq)
+    best_k, best = None, -1
+    for i, x in enumerate(trace[d]):
+        k = 2 * i - d
+        y = x - k
+        if x <= L and 0 <= y <= R and x + y > best:
+            best_k, best = k, x + y
+    if best_k is None:
+        return list(left_seq), list(right_seq), [], []
+    left_diff, right_diff, left_common, right_common = _backtrack(trace, left_seq, right_seq, d, best_k)
+    x = trace[d][(best_k + d) // 2]
+    left_diff += left_seq[x:]
+    right_diff += right_seq[x - best_k:]
+    return left_diff, right_diff, left_common, right_common
+
+
+def _count(d, probes, matched):
+    """Instrument counters of a diff: edit distance, diagonals probed, and elements matched along them.
+    Element comparisons are at most probes + matched (less with blocks)"""
+    if not instrument.active():
+        return
+    instrument.count('myers_diffs')
+    instrument.count('edit_distance', d)
+    instrument.count('myers_probes', probes)
+    instrument.count('myers_matched', matched)
+
+
+def myers_diff(left_seq: list, right_seq: list, blocks=None, budget: Budget = None) -> "tuple[list, list, list, list]":
+    """
+    Compute the diff between left_seq and right_seq with elements' __eq__
+
+    Args:
+        blocks (tuple): Optional (left_keys, right_keys, left_spans). If left_keys[x] is not None and equals right_keys[y],
+                        the next left_spans[x] elements from x and y are known to be pairwise equal without side effects,
+                        so the snake jumps over them instead of comparing one by one.
+        budget (Budget): Optional limits. If exceeded, budget.exceeded is set and a partial edit script is returned
+
+    Returns:
+        (list, list, list, list): left_diff, right_diff, left_common, right_common
+    """
+    L = len(left_seq)
+    R = len(right_seq)
+    if blocks is not None:
+        left_keys, right_keys, left_spans = blocks
+    offset = L + R + 1
+    # frontier[offset + k]: furthest x reached on diagonal k
+    frontier = [0] * (2 * offset + 2)
+    # trace[d][(k + d) // 2]: furthest x on diagonal k after d edits
+    trace = []
+    max_d, deadline = L + R, None
+    matched = 0
+    if budget is not None:
+        BUDGET_STATS['bounded'] += 1
+        if budget.max_d is not None:
+            max_d = min(max_d, budget.max_d)
+        if budget.timeout is not None:
+            deadline = time.perf_counter() + budget.timeout
+    for d in range(0, L + R + 1):
+        if d > 0 and (d > max_d or (deadline is not None and time.perf_counter() > deadline)):
+            budget.exceeded = True
+            BUDGET_STATS['exceeded'] += 1
+            _count(d - 1, d * (d + 1) // 2, matched)
+            return _partial(trace, left_seq, right_seq, d - 1)
+        for k in range(-d, d + 1, 2):
+            # Go down if we're on the left edge, or going down reaches further
+            go_down = (k == -d or
+                       (k != d and frontier[offset + k - 1] < frontier[offset + k + 1]))
+            if go_down:
+                x = frontier[offset + k + 1]
+            else:
+                x = frontier[offset + k - 1] + 1
+            y = x - k
+            x_start = x
+            # Chew up as many diagonal moves (common elements) as we can
+            if blocks is None:
+                while x < L and y < R and left_seq[x] == right_seq[y]:
+                    x += 1
+                    y += 1
+            else:
+                while x < L and y < R:
+                    key = left_keys[x]
+                    if key is not None and key == right_keys[y]:
+                        span = left_spans[x]
+                        x += span
+                        y += span
+                    elif left_seq[x] == right_seq[y]:
+                        x += 1
+                        y += 1
+                    else:
+                        break
+            frontier[offset + k] = x
+            matched += x - x_start
+            if x >= L and y >= R:
+                trace.append(array('q', frontier[offset - d: offset + k + 1: 2]))
+                _count(d, d * (d + 1) // 2 + (k + d) // 2 + 1, matched)
+                return _backtrack(trace, left_seq, right_seq, d, k)
+        trace.append(array('q', frontier[offset - d: offset + d + 1: 2]))
+
+    assert False, 'Could not find edit script'
@@ -0,0 +1,136 @@
+"""
+Content-addressed cache of per-page analysis results (e.g. fidelity_issue_all, pinpoint_issue)
+
+An entry is stored in {dirr}/.fidex_cache/{name}.pkl (see entry_name) along with its key, which is a hash of
+    - content of the input artifacts in dirr: all files of the given prefixes ({prefix}_dom.json, {prefix}.jpg,
+      {base}_events.json ...), and extra files like metadata.json
+    - options of the call
+    - code version (sources of the fidex package)
+Each set of options has its own entry. A lookup with a different key (i.e. changed inputs or code) is a miss,
+and the entry is replaced when the new result is stored.
+So re-analyzing a collection only recomputes the pages (and options) that changed.
+"""
+import functools
+import hashlib
+import json
+import os
+import pickle
+
+from fidex.fidelity_check import sidecar
+
+CACHE_DIR = '.fidex_cache'
+CACHE_STATS = {'hits': 0, 'misses': 0}
+
+_FIDEX_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# * (path, mtime_ns, size) -> digest, so that a file is only hashed once per process while unchanged
+_digests = {}
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+    """Hash of the python sources of the fidex package (tests excluded)"""
+    h = hashlib.sha256()
+    for root, dirnames, filenames in os.walk(_FIDEX_DIR):
+        dirnames[:] = sorted(d for d in dirnames if d not in ['tests', '__pycache__'])
+        for filename in sorted(filenames):
+            if not filename.endswith('.py'):
+                continue
+            path = os.path.join(root, filename)
+            h.update(os.path.relpath(path, _FIDEX_DIR).encode())
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def _file_digest(path) -> str:
+    stat = os.stat(path)
+    signature = (path, stat.st_mtime_ns, stat.st_size)
+    if signature not in _digests:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _digests[signature] = h.hexdigest()
+    return _digests[signature]
+
+
+def input_files(dirr, prefixes, extra_files=()) -> list:
+    """
+    Input artifacts of prefixes in dirr, as paths relative to dirr.
+    Sidecars are only included for json files that are not kept, so converting a collection does not change the key.
+    """
+    files = [f for f in extra_files if os.path.isfile(f'{dirr}/{f}')]
+    for filename in os.listdir(dirr):
+        if not any(filename.startswith((f'{prefix}_', f'{prefix}.')) for prefix in prefixes):
+            continue
+        path = f'{dirr}/{filename}'
+        if os.path.isfile(path):
+            files.append(filename)
+        elif filename.endswith(sidecar.SUFFIX) and not os.path.exists(path[:-len(sidecar.SUFFIX)]):
+            files += [f'{filename}/{f}' for f in os.listdir(path) if os.path.isfile(f'{path}/{f}')]
+    return sorted(set(files))
+
+
+def _dumps_options(options) -> bytes:
+    return json.dumps(options, sort_keys=True, default=repr).encode()
+
+
+def entry_name(name, **options) -> str:
+    """Name of the entry of name (e.g. fidelity_live_archive) called with options"""
+    return f'{name}_{hashlib.sha256(_dumps_options(options)).hexdigest()[:16]}'
+
+
+def cache_key(dirr, prefixes, extra_files=(), **options) -> str:
+    """
+    Args:
+        prefixes (list): Prefixes of the input artifacts (e.g. live, archive)
+        extra_files (list): Other input files in dirr (e.g. metadata.json)
+        options: Options of the call that may change the result
+    """
+    h = hashlib.sha256()
+    h.update(code_version().encode())
+    h.update(_dumps_options(options))
+    for filename in input_files(dirr, prefixes, extra_files):
+        h.update(f'{filename}:{_file_digest(f"{dirr}/{filename}")}\n'.encode())
+    return h.hexdigest()
+
+
+def _entry_path(dirr, name) -> str:
+    return f'{dirr}/{CACHE_DIR}/{name}.pkl'
+
+
+def lookup(dirr, name, key):
+    """Cached result of name in dirr if its key matches, otherwise None"""
+    path = _entry_path(dirr, name)
+    entry = None
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:
+            # * Truncated or written by an incompatible version, treated as a miss
+            entry = None
+    if entry is None or entry.get('key') != key:
+        CACHE_STATS['misses'] += 1
+        return None
+    CACHE_STATS['hits'] += 1
+    return entry['result']
+
+
+def store(dirr, name, key, result):
+    path = _entry_path(dirr, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'key': key, 'result': result}, f)
+    os.replace(tmp_path, path)
+
+
+def clear(dirr):
+    """Remove all cached results of dirr"""
+    path = f'{dirr}/{CACHE_DIR}'
+    if not os.path.exists(path):
+        return
+    for filename in os.listdir(path):
+        os.remove(f'{path}/{filename}')
+    os.rmdir(path)
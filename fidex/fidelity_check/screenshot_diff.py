@@ -0,0 +1,123 @@
+"""
+Pixel comparison of (full page) screenshots, shared by check_utils.compare_screenshot and baseline/pixel_diff
+
+Similarity is the fraction of equal bytes (pixels x channels) in the common top-left part of both images.
+Full page screenshots can be tens of thousands of pixels tall, so instead of materializing the difference of the two
+images (and the mask of its zeros), equal bytes are counted over horizontal tiles into one reused buffer.
+The diff image (absolute difference) is only computed if asked for and the images differ,
+and byte-identical files are not decoded at all.
+Only cv2 and numpy are used, so it can be imported by the standalone baseline scripts.
+
+Decoded screenshots are kept in a process-local LRU cache (see imread), since the same screenshots are read by
+several checks and stages of a page.
+"""
+import filecmp
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+TILE_ROWS = 256
+
+# * Process-local cache of decoded images by (path, mtime, size), bounded by the total bytes of the images
+IMAGE_CACHE_BYTES = 512 * 2**20
+_image_cache = OrderedDict()
+_image_cache_bytes = 0
+IMAGE_CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def image_cache_info() -> dict:
+    return {**IMAGE_CACHE_STATS, 'size': len(_image_cache), 'bytes': _image_cache_bytes, 'maxbytes': IMAGE_CACHE_BYTES}
+
+
+def clear_image_cache():
+    global _image_cache_bytes
+    _image_cache.clear()
+    _image_cache_bytes = 0
+    for k in IMAGE_CACHE_STATS:
+        IMAGE_CACHE_STATS[k] = 0
+
+
+def imread(path) -> "numpy.NDArray | None":
+    """
+    cv2.imread through the cache. The image is shared by all readers, so it is read-only (copy it to modify)
+    Images that can't be decoded (None) are not cached, nor images larger than IMAGE_CACHE_BYTES
+    """
+    global _image_cache_bytes
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key in _image_cache:
+        IMAGE_CACHE_STATS['hits'] += 1
+        _image_cache.move_to_end(key)
+        return _image_cache[key]
+    IMAGE_CACHE_STATS['misses'] += 1
+    img = cv2.imread(path)
+    if img is None:
+        return None
+    img.flags.writeable = False
+    if img.nbytes > IMAGE_CACHE_BYTES:
+        return img
+    _image_cache[key] = img
+    _image_cache_bytes += img.nbytes
+    while _image_cache_bytes > IMAGE_CACHE_BYTES:
+        _, evicted = _image_cache.popitem(last=False)
+        _image_cache_bytes -= evicted.nbytes
+        IMAGE_CACHE_STATS['evictions'] += 1
+    return img
+
+
+def same_file(left_path, right_path) -> bool:
+    return os.path.getsize(left_path) == os.path.getsize(right_path) and filecmp.cmp(left_path, right_path, shallow=False)
+
+
+def _crop(img1, img2):
+    height = min(img1.shape[0], img2.shape[0])
+    width = min(img1.shape[1], img2.shape[1])
+    return img1[:height, :width], img2[:height, :width]
+
+
+def count_equal(img1, img2, tile_rows=TILE_ROWS) -> int:
+    """Number of equal bytes of two images of the same shape, tile by tile"""
+    if img1.size == 0:
+        return 0
+    tile = np.empty((min(tile_rows, img1.shape[0]),) + img1.shape[1:], dtype=bool)
+    same = 0
+    for top in range(0, img1.shape[0], tile_rows):
+        left, right = img1[top:top + tile_rows], img2[top:top + tile_rows]
+        out = tile[:left.shape[0]]
+        np.equal(left, right, out=out)
+        same += int(np.count_nonzero(out))
+    return same
+
+
+def similarity(img1, img2, tile_rows=TILE_ROWS) -> float:
+    img1, img2 = _crop(img1, img2)
+    return count_equal(img1, img2, tile_rows=tile_rows) / img1.size
+
+
+def diff_image(img1, img2) -> np.ndarray:
+    """Absolute difference of the common part of two images"""
+    img1, img2 = _crop(img1, img2)
+    return cv2.absdiff(img1, img2)
+
+
+def compare(left_path, right_path, with_diff=False, tile_rows=TILE_ROWS) -> "(float | None, numpy.NDArray | None)":
+    """
+    Args:
+        with_diff: Also return the diff image (see diff_image) if the images differ
+
+    Returns:
+        (similarity, diff image or None). similarity is None if either image can't be read
+    """
+    if same_file(left_path, right_path):
+        return 1.0, None
+    img1 = imread(left_path)
+    img2 = imread(right_path)
+    if img1 is None or img2 is None:
+        return None, None
+    cropped1, cropped2 = _crop(img1, img2)
+    same = count_equal(cropped1, cropped2, tile_rows=tile_rows)
+    total = cropped1.size
+    diff = cv2.absdiff(cropped1, cropped2) if with_diff and same < total else None
+    return same / total, diff
@@ -0,0 +1,298 @@
+"""
+Compact columnar sidecars of the recorded json files ({prefix}_dom.json, {base}_writes.json, {base}_writeStacks.json)
+
+A sidecar is a directory next to the json file ({name}.json.fxc) with
+    - meta.json: format version, kind of file, and the (mtime, size) of the json file it was converted from
+    - strings.bin: string table, NUL separated utf-8 (strings.json if any string has NUL).
+                   xpaths, texts, methods etc. are interned, so repeated ones are stored once
+    - *.npy: numeric columns (string ids, depths, dimensions as floats ...)
+Stacks of writeStacks are deduplicated. Everything else (e.g. write args) is kept as interned json strings.
+A sidecar is decoded whole into the same objects as json.load, so it saves parsing time and disk space, not memory
+(apart from repeated strings and stacks being shared).
+
+LoadInfo reads the sidecar instead of the json file if it is up to date (see read_sidecar).
+Files that do not fit the format (e.g. unexpected keys) are left as json only.
+
+Convert a collection: python -m fidex.fidelity_check.sidecar <dirr> [<dirr> ...]
+"""
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+VERSION = 1
+SUFFIX = '.fxc'
+KINDS = {'_dom.json': 'dom', '_writes.json': 'writes', '_writeStacks.json': 'writeStacks'}
+
+ELEMENT_KEYS = {'text', 'xpath', 'dimension', 'extraAttr', 'depth'}
+DIMENSION_KEYS = ('left', 'top', 'width', 'height')
+WRITE_KEYS = ('wid', 'method', 'xpath', 'currentStage')
+
+
+def sidecar_path(json_path) -> str:
+    return json_path + SUFFIX
+
+
+def file_kind(json_path) -> "str | None":
+    for suffix, kind in KINDS.items():
+        if json_path.endswith(suffix):
+            return kind
+    return None
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class _StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, s: str) -> int:
+        idx = self.ids.get(s)
+        if idx is None:
+            idx = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return idx
+
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _encode_dom(elements, strings) -> "dict | None":
+    n = len(elements)
+    xpath, text, extra = np.empty(n, np.int32), np.empty(n, np.int32), np.empty(n, np.int32)
+    depth = np.empty(n, np.int32)
+    dimension = np.full((n, 4), np.nan)
+    # -1: no dimension, otherwise bitmask of the values that are ints
+    dimension_kind = np.full(n, -1, np.int8)
+    for i, e in enumerate(elements):
+        if not isinstance(e, dict) or e.keys() != ELEMENT_KEYS:
+            return None
+        if not isinstance(e['xpath'], str) or not isinstance(e['text'], str) \
+           or not isinstance(e['depth'], int) or not isinstance(e['extraAttr'], dict):
+            return None
+        xpath[i], text[i] = strings.add(e['xpath']), strings.add(e['text'])
+        extra[i], depth[i] = strings.add(json.dumps(e['extraAttr'])), e['depth']
+        dimen = e['dimension']
+        if dimen is None:
+            continue
+        if not isinstance(dimen, dict) or dimen.keys() != set(DIMENSION_KEYS) \
+           or not all(_is_number(dimen[k]) for k in DIMENSION_KEYS):
+            return None
+        kind = 0
+        for j, k in enumerate(DIMENSION_KEYS):
+            dimension[i, j] = dimen[k]
+            if isinstance(dimen[k], int):
+                kind |= 1 << j
+        dimension_kind[i] = kind
+    return {'xpath': xpath, 'text': text, 'extra': extra, 'depth': depth,
+            'dimension': dimension, 'dimension_kind': dimension_kind}
+
+
+def _lookup(table: np.ndarray, ids: np.ndarray) -> list:
+    return table[ids].tolist()
+
+
+def _dimension_dicts(values: np.ndarray) -> list:
+    flat = iter(values.ravel().tolist())
+    return [{'left': left, 'top': top, 'width': width, 'height': height}
+            for left, top, width, height in zip(flat, flat, flat, flat)]
+
+
+def _decode_dimensions(dimensions, kinds) -> list:
+    """Dimension dicts (or None) of all elements. Rows are converted by kind, so only the needed python numbers are made"""
+    dimensions, kinds = np.asarray(dimensions), np.asarray(kinds)
+    decoded = [None] * len(kinds)
+    all_int, all_float = np.flatnonzero(kinds == 15), np.flatnonzero(kinds == 0)
+    for rows, values in [(all_int, dimensions[all_int].astype(np.int64)), (all_float, dimensions[all_float])]:
+        for i, dimension in zip(rows.tolist(), _dimension_dicts(values)):
+            decoded[i] = dimension
+    for i in np.flatnonzero((kinds > 0) & (kinds < 15)).tolist():
+        kind = int(kinds[i])
+        decoded[i] = {k: int(v) if kind >> j & 1 else float(v) for j, (k, v) in enumerate(zip(DIMENSION_KEYS, dimensions[i]))}
+    return decoded
+
+
+def _decode_dom(strings, columns) -> list:
+    dimensions = _decode_dimensions(columns['dimension'], columns['dimension_kind'])
+    # * extraAttr is mostly the same few objects, decode each once
+    extras = np.empty(len(strings), dtype=object)
+    for extra in np.unique(columns['extra']).tolist():
+        extras[extra] = json.loads(strings[extra])
+    table = np.array(strings, dtype=object)
+    return [{'text': text, 'xpath': xpath, 'dimension': dimension, 'extraAttr': extra, 'depth': depth}
+            for text, xpath, dimension, extra, depth in zip(_lookup(table, columns['text']), _lookup(table, columns['xpath']),
+                                                            dimensions, _lookup(extras, columns['extra']),
+                                                            columns['depth'].tolist())]
+
+
+def _encode_writes(writes, strings) -> "dict | None":
+    n = len(writes)
+    columns = {k: np.empty(n, np.int32) for k in WRITE_KEYS + ('rest',)}
+    for i, w in enumerate(writes):
+        if not isinstance(w, dict) or not all(isinstance(w.get(k), str) for k in WRITE_KEYS):
+            return None
+        for k in WRITE_KEYS:
+            columns[k][i] = strings.add(w[k])
+        columns['rest'][i] = strings.add(json.dumps({k: v for k, v in w.items() if k not in WRITE_KEYS}))
+    return columns
+
+
+def _decode_writes(strings, columns) -> list:
+    # * Same args etc. (by serialization) are decoded once and shared by the writes
+    rests = {}
+    writes = []
+    for wid, method, xpath, stage, rest in zip(*[columns[k].tolist() for k in WRITE_KEYS + ('rest',)]):
+        write = {'wid': strings[wid], 'method': strings[method], 'xpath': strings[xpath], 'currentStage': strings[stage]}
+        if rest not in rests:
+            rests[rest] = json.loads(strings[rest])
+        write.update(rests[rest])
+        writes.append(write)
+    return writes
+
+
+def _encode_write_stacks(write_stacks, strings) -> "dict | None":
+    group_stack, wids, offsets = [], [], [0]
+    for obj in write_stacks:
+        if not isinstance(obj, dict) or obj.keys() != {'stackInfo', 'wids'} \
+           or not all(isinstance(wid, str) for wid in obj['wids']):
+            return None
+        group_stack.append(strings.add(json.dumps(obj['stackInfo'])))
+        wids += [strings.add(wid) for wid in obj['wids']]
+        offsets.append(len(wids))
+    return {'group_stack': np.array(group_stack, np.int32), 'wids': np.array(wids, np.int32),
+            'offsets': np.array(offsets, np.int64)}
+
+
+def _decode_write_stacks(strings, columns) -> list:
+    # * Same stack (by serialization) is decoded once and shared by its groups
+    stacks = {}
+    wids = [strings[i] for i in columns['wids'].tolist()]
+    offsets = columns['offsets'].tolist()
+    write_stacks = []
+    for g, stack in enumerate(columns['group_stack'].tolist()):
+        if stack not in stacks:
+            stacks[stack] = json.loads(strings[stack])
+        write_stacks.append({'stackInfo': stacks[stack], 'wids': wids[offsets[g]:offsets[g + 1]]})
+    return write_stacks
+
+
+_ENCODERS = {'dom': _encode_dom, 'writes': _encode_writes, 'writeStacks': _encode_write_stacks}
+_DECODERS = {'dom': _decode_dom, 'writes': _decode_writes, 'writeStacks': _decode_write_stacks}
+
+
+def write_sidecar(json_path, obj=None) -> bool:
+    """
+    Write the sidecar of json_path
+
+    Args:
+        obj: Parsed content of json_path if already loaded
+
+    Returns:
+        bool: If written. False if the file is not a recorded dom/writes/writeStacks file or does not fit the format
+    """
+    kind = file_kind(json_path)
+    if kind is None:
+        return False
+    if obj is None:
+        obj = json.load(open(json_path))
+    strings = _StringTable()
+    columns = _ENCODERS[kind](obj, strings)
+    if columns is None:
+        return False
+    path = sidecar_path(json_path)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, column in columns.items():
+        np.save(f'{tmp_path}/{name}.npy', column)
+    if any('\0' in s for s in strings.strings):
+        strings_file = 'strings.json'
+        json.dump(strings.strings, open(f'{tmp_path}/{strings_file}', 'w'))
+    else:
+        strings_file = 'strings.bin'
+        with open(f'{tmp_path}/{strings_file}', 'wb') as f:
+            f.write('\0'.join(strings.strings).encode('utf-8', 'surrogatepass'))
+    json.dump({'version': VERSION, 'kind': kind, 'strings': strings_file, 'source': _signature(json_path)},
+              open(f'{tmp_path}/meta.json', 'w'))
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return True
+
+
+def sidecar_meta(json_path) -> "dict | None":
+    """meta.json of json_path's sidecar, if there is an up to date one"""
+    meta_path = f'{sidecar_path(json_path)}/meta.json'
+    if not os.path.exists(meta_path):
+        return None
+    meta = json.load(open(meta_path))
+    if meta.get('version') != VERSION:
+        return None
+    # * json rewritten after the conversion, the sidecar is stale
+    if os.path.exists(json_path) and meta['source'] != _signature(json_path):
+        return None
+    return meta
+
+
+def read_sidecar(json_path):
+    """
+    Load json_path from its sidecar
+
+    Returns:
+        Same content as json.load(open(json_path)), or None if there is no up to date sidecar
+    """
+    meta = sidecar_meta(json_path)
+    if meta is None:
+        return None
+    path = sidecar_path(json_path)
+    if meta['strings'] == 'strings.bin':
+        with open(f'{path}/strings.bin', 'rb') as f:
+            strings = f.read().decode('utf-8', 'surrogatepass').split('\0')
+    else:
+        strings = json.load(open(f'{path}/strings.json'))
+    columns = {}
+    for filename in os.listdir(path):
+        if filename.endswith('.npy'):
+            columns[filename[:-len('.npy')]] = np.load(f'{path}/{filename}')
+    return _DECODERS[meta['kind']](strings, columns)
+
+
+def exists(json_path) -> bool:
+    """If json_path can be loaded, either from the json file or its sidecar"""
+    return os.path.exists(json_path) or sidecar_meta(json_path) is not None
+
+
+def load(json_path):
+    """Load json_path, from its sidecar if there is an up to date one"""
+    obj = read_sidecar(json_path)
+    if obj is not None:
+        return obj
+    return json.load(open(json_path))
+
+
+def convert(dirr) -> int:
+    """
+    Write sidecars for all dom, writes and writeStacks files under dirr (e.g. a collection) that don't have an up to date one
+
+    Returns:
+        int: Number of sidecars written
+    """
+    written = 0
+    for root, _, filenames in os.walk(dirr):
+        for filename in filenames:
+            json_path = os.path.join(root, filename)
+            if file_kind(json_path) is None or sidecar_meta(json_path) is not None:
+                continue
+            written += write_sidecar(json_path)
+    return written
+
+
+if __name__ == '__main__':
+    for dirr in sys.argv[1:]:
+        print(f'{dirr}: {convert(dirr)} sidecars written')
@@ -0,0 +1,678 @@
+"""
+Micro benchmarks for the fidelity check hot paths on synthetic pages.
+Run: python bench_fidelity_check.py <name> (or "all")
+"""
+import gc
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+import numpy as np
+
+import synthetic_pages
+from fidex.fidelity_check import fidelity_detect, layout_tree, myers
+
+
+def _timeit(func, repeat=1):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _peak_memory(func):
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def _copying_myers_diff(left_seq, right_seq):
+    """Previous Myers implementation that copies the edit history on every step"""
+    Frontier = namedtuple('Frontier', ['x', 'left_diff', 'right_diff', 'left_common', 'right_common'])
+    frontier = {1: Frontier(0, [], [], [], [])}
+    L, R = len(left_seq), len(right_seq)
+    for d in range(0, L + R + 1):
+        for k in range(-d, d + 1, 2):
+            go_down = (k == -d or (k != d and frontier[k - 1].x < frontier[k + 1].x))
+            if go_down:
+                x, left_diff, right_diff, left_common, right_common = frontier[k + 1]
+            else:
+                x, left_diff, right_diff, left_common, right_common = frontier[k - 1]
+                x += 1
+            left_diff, right_diff = left_diff.copy(), right_diff.copy()
+            left_common, right_common = left_common.copy(), right_common.copy()
+            y = x - k
+            if 1 <= y <= R and go_down:
+                right_diff.append(right_seq[y-1])
+            elif 1 <= x <= L:
+                left_diff.append(left_seq[x-1])
+            while x < L and y < R and left_seq[x] == right_seq[y]:
+                left_common.append(left_seq[x])
+                right_common.append(right_seq[y])
+                x += 1
+                y += 1
+            if x >= L and y >= R:
+                return left_diff, right_diff, left_common, right_common
+            frontier[k] = Frontier(x, left_diff, right_diff, left_common, right_common)
+
+
+def _edited_sequence(n, edits, seed=0):
+    rnd = random.Random(seed)
+    left = list(range(n))
+    right = list(left)
+    for _ in range(edits):
+        idx = rnd.randrange(len(right))
+        if rnd.random() < 0.5:
+            right.pop(idx)
+        else:
+            right.insert(idx, -idx - 1)
+    return left, right
+
+
+def bench_myers_scaling(sizes=(1000, 10000, 50000, 100000, 200000), edit_ratio=0.005, copying_limit=20000):
+    """Time and peak memory of myers.myers_diff vs. the history-copying version, with edits proportional to size"""
+    for n in sizes:
+        left, right = _edited_sequence(n, max(1, int(n * edit_ratio)))
+        t_new = _timeit(lambda: myers.myers_diff(left, right))
+        m_new = _peak_memory(lambda: myers.myers_diff(left, right))
+        line = f'myers n={n}: trace {t_new:.2f}s {m_new / 1e6:.1f}MB'
+        if n <= copying_limit:
+            t_old = _timeit(lambda: _copying_myers_diff(left, right))
+            m_old = _peak_memory(lambda: _copying_myers_diff(left, right))
+            line += f', copying {t_old:.2f}s {m_old / 1e6:.1f}MB'
+        print(line)
+
+
+def bench_layout_element_init(n=50000):
+    """LayoutElement construction with the start tag tokenizer vs. a full BeautifulSoup parse per element"""
+    elements = synthetic_pages.gen_elements(n, seed=0)
+
+    def tokenizer():
+        for e in elements:
+            layout_tree.LayoutElement(e)
+
+    def soup():
+        for e in elements:
+            layout_tree.LayoutElement(e).tag
+
+    t_tokenizer = _timeit(tokenizer)
+    t_soup = _timeit(soup)
+    print(f'LayoutElement init ({len(elements)} elements): tokenizer {t_tokenizer:.2f}s, '
+          f'with soup {t_soup:.2f}s, speedup {t_soup / t_tokenizer:.1f}x')
+
+
+def _full_predicate_eq(self, other):
+    """LayoutElement.__eq__ without fingerprints: every pair goes through the predicates"""
+    if self.tagname != other.tagname:
+        return False
+    if layout_tree.features_eq(self, other) and layout_tree.dimension_eq(self, other):
+        return True
+    if self.js_comp and layout_tree.js_dynamism_self_eq(self, other):
+        if self.tagname != 'body':
+            self.dynamic_matched = True
+        if other.tagname != 'body':
+            other.dynamic_matched = True
+        return True
+    return layout_tree.css_dynamism_self_eq(self, other)
+
+
+def bench_layout_element_eq(n=20000, changes=1000):
+    """Predicate calls and time of the layout diff with and without the comparison fingerprints"""
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0)
+    stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+    mutated = synthetic_pages.mutate_elements(elements, changes, seed=0)
+    predicates = ['features_eq', 'js_dynamism_self_eq', 'css_dynamism_self_eq']
+    originals = {name: getattr(layout_tree, name) for name in predicates}
+    fingerprint_eq = layout_tree.LayoutElement.__eq__
+
+    def run(eq):
+        counts = {name: 0 for name in predicates}
+
+        def counted(name):
+            def wrapper(*args):
+                counts[name] += 1
+                return originals[name](*args)
+            return wrapper
+
+        left = layout_tree.build_layout_tree(elements, writes, stacks).list_tree()
+        right = layout_tree.build_layout_tree(mutated, writes, stacks).list_tree()
+        # Per element data is computed once either way, only time the comparisons
+        for e in left + right:
+            e.features_fingerprint, e.static_style
+        layout_tree.LayoutElement.__eq__ = eq
+        for name in predicates:
+            setattr(layout_tree, name, counted(name))
+        try:
+            duration = _timeit(lambda: layout_tree._myers_diff(left, right))
+        finally:
+            layout_tree.LayoutElement.__eq__ = fingerprint_eq
+            for name, func in originals.items():
+                setattr(layout_tree, name, func)
+        return duration, counts
+
+    t_full, c_full = run(_full_predicate_eq)
+    t_fp, c_fp = run(fingerprint_eq)
+    print(f'layout diff ({len(elements)} elements, {changes} changes): '
+          f'full predicates {t_full:.2f}s {c_full}, fingerprints {t_fp:.2f}s {c_fp}')
+
+
+def bench_subtree_jumps(n=20000, changes=1, repeat=3):
+    """Cold layout diff on a page with one broken region, with and without jumping over identical subtrees"""
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0)
+    stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+    mutated = synthetic_pages.mutate_elements(elements, changes, seed=0)
+
+    def run(jump):
+        best = float('inf')
+        for _ in range(repeat):
+            # Fresh trees, so per element data (features etc.) is computed inside the timed region
+            left = layout_tree.build_layout_tree(elements, writes, stacks)
+            right = layout_tree.build_layout_tree(mutated, writes, stacks)
+            gc.collect()
+            start = time.perf_counter()
+            if jump:
+                interned = {}
+                left_list, left_keys, left_spans = [], [], []
+                layout_tree._list_tree_blocks(left, interned, left_list, left_keys, left_spans)
+                right_list, right_keys, right_spans = [], [], []
+                layout_tree._list_tree_blocks(right, interned, right_list, right_keys, right_spans)
+                layout_tree._myers_diff(left_list, right_list, blocks=(left_keys, right_keys, left_spans))
+            else:
+                layout_tree._myers_diff(left.list_tree(), right.list_tree())
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    t_plain = run(False)
+    t_jumps = run(True)
+    print(f'layout diff ({n} elements, {changes} changes): element by element {t_plain * 1000:.0f}ms, '
+          f'subtree jumps {t_jumps * 1000:.0f}ms')
+
+
+def bench_write_association(n=20000, num_writes=1000):
+    """build_layout_tree with many innerHTML writes, with and without the pre-order index"""
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, num_writes, seed=0)
+    # Target big containers, like frameworks re-rendering whole sections
+    containers = [e['xpath'] for e in elements if e['depth'] == 4 and not e['xpath'].split('/')[-1].startswith('#text')]
+    for i, w in enumerate(writes):
+        w['method'], w['xpath'] = 'set:innerHTML', containers[i % len(containers)]
+        w['args'] = [{'html': '<div><span>x</span><a href="/x">x</a><img src="/x.png"></div>'}]
+    stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+    index_tree = layout_tree.LayoutElement.index_tree
+
+    t_index = _timeit(lambda: layout_tree.build_layout_tree(elements, writes, stacks))
+    layout_tree.LayoutElement.index_tree = lambda self: None
+    try:
+        t_plain = _timeit(lambda: layout_tree.build_layout_tree(elements, writes, stacks))
+    finally:
+        layout_tree.LayoutElement.index_tree = index_tree
+    print(f'build_layout_tree ({n} elements, {num_writes} innerHTML writes): '
+          f'recursive descendants {t_plain:.2f}s, pre-order index {t_index:.2f}s')
+
+
+def bench_filter_style(n=50000):
+    """Style canonicalization for every styled element of a page, with and without the cache"""
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    styles = [e.attrs['style'] for e in map(layout_tree.LayoutElement, elements)
+              if e.attrs is not None and 'style' in e.attrs]
+    keys = tuple(layout_tree.FILTERED_STYLES)
+    t_uncached = _timeit(lambda: [layout_tree._canonical_style.__wrapped__(s, keys) for s in styles])
+    layout_tree._canonical_style.cache_clear()
+    t_cached = _timeit(lambda: [layout_tree._filter_style(s) for s in styles])
+    print(f'_filter_style ({len(styles)} styles): uncached {t_uncached:.2f}s, cached {t_cached:.3f}s, '
+          f'{layout_tree.style_cache_info()}')
+
+
+def bench_detect_stage(n=20000, changes=50):
+    """One stage with fidex_check and layout_check, separate pipelines vs. a shared DiffSession (without check_meaningful)"""
+    dirr = tempfile.mkdtemp()
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0, num_stacks=6)
+    archive_writes, archive_stacks = synthetic_pages.gen_writes(elements, n // 10, seed=1, num_stacks=4)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks)
+    synthetic_pages.write_page(dirr, 'archive', synthetic_pages.mutate_elements(elements, changes, seed=0),
+                               archive_writes, archive_stacks)
+    logging.disable(logging.WARNING)
+
+    def separate():
+        fidelity_detect.fidelity_issue(dirr, 'live', 'archive', meaningful=False)
+        fidelity_detect.fidelity_issue(dirr, 'live', 'archive', meaningful=False, js_comp=False)
+
+    def shared():
+        detector = fidelity_detect.FidelityDetector(dirr, layout_check=True, meaningful=False)
+        detector.detect_stage('onload', 'onload')
+
+    t_separate = _timeit(separate)
+    t_shared = _timeit(shared)
+    logging.disable(logging.NOTSET)
+    print(f'detect_stage ({n} elements, fidex_check + layout_check): '
+          f'separate pipelines {t_separate:.2f}s, shared session {t_shared:.2f}s')
+
+
+def _list_js_dynamism_self_eq(e1, e2):
+    """Previous js_dynamism_self_eq rebuilding the sibling write sets on every call"""
+    if len(e1.writes) + len(e2.writes) > 0:
+        e1_related_writes = [w for e in e1.parent.children for w in e.writes] if e1.parent else e1.writes
+        e2_related_writes = [w for e in e2.parent.children for w in e.writes] if e2.parent else e2.writes
+        if set(e1_related_writes) == set(e2_related_writes):
+            return True
+        return set(w.plain_form for w in e1_related_writes) == set(w.plain_form for w in e2_related_writes)
+    return False
+
+
+def bench_js_dynamism(slides=500, writes_per_slide=4, pairs=20000):
+    """js_dynamism_self_eq between slides of a carousel, per call set rebuilding vs. per parent frozen sets"""
+    elements = synthetic_pages.gen_elements(200, seed=0)
+    carousel = elements[-1]['xpath'].rsplit('/', 1)[0]
+    depth = carousel.count('/')
+    elements += [{**elements[-1], 'xpath': f'{carousel}/li[{i + 1}]', 'depth': depth,
+                  'text': f'<li class="slide">'} for i in range(slides)]
+    writes, stacks = [], []
+    for i in range(slides * writes_per_slide):
+        wid = f'{i}:0'
+        writes.append({'wid': wid, 'method': 'setAttribute', 'xpath': f'{carousel}/li[{i % slides + 1}]',
+                       'args': [{'html': 'class'}, {'html': f'slide-{i}'}], 'currentStage': 'onload', 'effective': True})
+        stacks.append({'wid': wid, 'stackInfo': [{'callFrames': [{'url': 'https://example.com/carousel.js',
+                       'functionName': f'rotate{i % 7}', 'lineNumber': 1, 'columnNumber': i}], 'description': ''}]})
+    left = layout_tree.build_layout_tree(elements, writes, stacks)
+    right = layout_tree.build_layout_tree(elements, writes, stacks)
+    left_slides = [left.all_nodes[f'{carousel}/li[{i + 1}]'] for i in range(slides)]
+    right_slides = [right.all_nodes[f'{carousel}/li[{i + 1}]'] for i in range(slides)]
+    rnd = random.Random(0)
+    pairs = [(rnd.choice(left_slides), rnd.choice(right_slides)) for _ in range(pairs)]
+    t_list = _timeit(lambda: [_list_js_dynamism_self_eq(e1, e2) for e1, e2 in pairs])
+    t_frozen = _timeit(lambda: [layout_tree.js_dynamism_self_eq(e1, e2) for e1, e2 in pairs])
+    print(f'js_dynamism_self_eq ({slides} slides, {len(pairs)} pairs): '
+          f'rebuilt sets {t_list:.2f}s, frozen per parent {t_frozen:.3f}s')
+
+
+def bench_diff_budget(n=20000, changes=1000, max_d=200):
+    """Yes/no layout diff of a heavily broken page, full edit script vs. bounded by max_d"""
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    # Different write stacks on both sides, otherwise the diff returns early
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0, num_stacks=6)
+    stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+    archive_writes, archive_stacks = synthetic_pages.gen_writes(elements, n // 10, seed=1, num_stacks=4)
+    archive_stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in archive_stacks for wid in s['wids']]
+    mutated = synthetic_pages.mutate_elements(elements, changes, seed=0)
+
+    def run(budget):
+        left = layout_tree.build_layout_tree(elements, writes, stacks)
+        right = layout_tree.build_layout_tree(mutated, archive_writes, archive_stacks)
+        gc.collect()
+        start = time.perf_counter()
+        left_diff, _ = layout_tree.diff_layout_tree(left, right, budget=budget)
+        return time.perf_counter() - start, len(left_diff) > 0
+
+    t_full, diff_full = run(None)
+    budget = myers.Budget(max_d=max_d)
+    t_bounded, diff_bounded = run(budget)
+    print(f'layout diff ({n} elements, {changes} changes): full {t_full:.2f}s (diff={diff_full}), '
+          f'max_d={max_d} {t_bounded:.2f}s (diff={diff_bounded}, exceeded={budget.exceeded}), {myers.BUDGET_STATS}')
+
+
+def bench_load_info(n=50000, loads=5):
+    """Loading the same prefix several times (as pinpointing does), parsing every time vs. the LoadInfo cache"""
+    dirr = tempfile.mkdtemp()
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks)
+
+    def load(cached):
+        for _ in range(loads):
+            if not cached:
+                fidelity_detect.clear_load_cache()
+            fidelity_detect.LoadInfo(dirr, 'live')
+
+    t_parse = _timeit(lambda: load(False))
+    fidelity_detect.clear_load_cache()
+    t_cached = _timeit(lambda: load(True))
+    print(f'LoadInfo x{loads} ({n} elements): parse every time {t_parse:.2f}s, cached {t_cached:.2f}s, '
+          f'{fidelity_detect.load_cache_info()}')
+
+
+def bench_result_cache(n=20000, interactions=10):
+    """Re-checking an unchanged page (all checks) from scratch vs. a result cache hit"""
+    from fidex.fidelity_check import result_cache
+    dirr = tempfile.mkdtemp()
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0)
+    events = synthetic_pages.gen_events(elements, interactions, seed=0)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks, events=events)
+    synthetic_pages.write_page(dirr, 'archive', elements, writes, stacks, events=events)
+    for i in range(interactions):
+        synthetic_pages.write_page(dirr, f'live_{i}', elements, writes, stacks)
+        synthetic_pages.write_page(dirr, f'archive_{i}', elements, writes, stacks)
+    checks = dict(layout_check=True, html_text=True, writedown=False)
+
+    def run(cache):
+        fidelity_detect.clear_load_cache()
+        fidelity_detect.fidelity_issue_all(dirr, **checks, cache=cache)
+
+    t_full = _timeit(lambda: run(False))
+    run(True)
+    t_hit = _timeit(lambda: run(True))
+    print(f'fidelity_issue_all ({n} elements, {interactions} interactions): full {t_full:.2f}s, '
+          f'cache hit {t_hit:.3f}s, {result_cache.CACHE_STATS}')
+
+
+def bench_dom_delta(n=50000, interactions=10, changes=20):
+    """Disk usage and load time (all stages through LoadInfo) of interaction stage doms, full json vs. deltas"""
+    from fidex.fidelity_check import dom_delta
+    dirr = tempfile.mkdtemp()
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks)
+    for i in range(interactions):
+        synthetic_pages.write_page(dirr, f'live_{i}', synthetic_pages.mutate_elements(elements, changes, seed=i),
+                                   writes, stacks)
+
+    def stage_size():
+        return sum(os.path.getsize(f'{dirr}/{f}') for f in os.listdir(dirr)
+                   if f.startswith('live_') and f.endswith(('_dom.json', dom_delta.SUFFIX)) and f != 'live_dom.json')
+
+    def load():
+        fidelity_detect.clear_load_cache()
+        dom_delta._bases.clear()
+        for i in range(interactions):
+            fidelity_detect.LoadInfo(dirr, f'live_{i}')
+
+    size_full, t_full = stage_size(), _timeit(load)
+    dom_delta.convert(dirr, remove=True)
+    size_delta, t_delta = stage_size(), _timeit(load)
+    print(f'{interactions} stages ({n} elements, {changes} changes each): '
+          f'json {size_full / 2**20:.1f}MB {t_full:.2f}s, delta {size_delta / 2**20:.2f}MB {t_delta:.2f}s')
+
+
+def bench_screenshot(height=20000, width=1280):
+    """Time and peak memory (including decoding) of comparing two tall screenshots, full subtraction vs. tiles"""
+    import cv2
+    from fidex.fidelity_check import check_utils, screenshot_diff
+    dirr = tempfile.mkdtemp()
+    rnd = np.random.default_rng(0)
+    # Page-like: flat blocks with some noise
+    img = np.repeat(rnd.integers(0, 256, (height // 40, 1, 3), dtype=np.uint8), 40, axis=0).repeat(width, axis=1)
+    img[::7, ::5] = rnd.integers(0, 256, img[::7, ::5].shape, dtype=np.uint8)
+    other = img.copy()
+    other[height // 2: height // 2 + 500] = 255
+    cv2.imwrite(f'{dirr}/live.jpg', img)
+    cv2.imwrite(f'{dirr}/archive.jpg', other)
+    shutil.copy(f'{dirr}/live.jpg', f'{dirr}/live_copy.jpg')
+    del img, other
+
+    def full(live, archive):
+        img1, img2 = cv2.imread(live), cv2.imread(archive)
+        diff = img1 - img2
+        return np.count_nonzero(diff == 0) / diff.size, diff
+
+    for name, archive in [('different', 'archive.jpg'), ('identical', 'live_copy.jpg')]:
+        live, archive = f'{dirr}/live.jpg', f'{dirr}/{archive}'
+        t_full, m_full = _timeit(lambda: full(live, archive)), _peak_memory(lambda: full(live, archive))
+        t_tile = _timeit(lambda: check_utils.compare_screenshot(live, archive, with_diff=False))
+        m_tile = _peak_memory(lambda: check_utils.compare_screenshot(live, archive, with_diff=False))
+        m_diff = _peak_memory(lambda: check_utils.compare_screenshot(live, archive))
+        print(f'{name} {height}x{width}: full {t_full:.2f}s {m_full / 2**20:.0f}MB, '
+              f'tiles {t_tile:.2f}s {m_tile / 2**20:.0f}MB ({m_diff / 2**20:.0f}MB with diff image), '
+              f'similarity {full(live, archive)[0]:.4f} vs {check_utils.compare_screenshot(live, archive)[0]:.4f}')
+
+
+def bench_image_cache(height=10000, width=1280, stages=5):
+    """Screenshot reads of a page's stage checks (visual filter of fidex and layout checks, and compare_screenshot),
+    decoding every time vs. the decoded image cache"""
+    import cv2
+    from fidex.fidelity_check import check_utils, screenshot_diff
+    dirr = tempfile.mkdtemp()
+    rnd = np.random.default_rng(0)
+    img = rnd.integers(0, 256, (height // 20, width // 20, 3), dtype=np.uint8).repeat(20, axis=0).repeat(20, axis=1)
+    other = img.copy()
+    other[:200] = 0
+    cv2.imwrite(f'{dirr}/live.jpg', img)
+    cv2.imwrite(f'{dirr}/archive.jpg', other)
+    elements = [{'xpath': f'/html[1]/div[{i}]', 'dimension': {'left': 0, 'top': 100 * i, 'width': 300, 'height': 100}}
+                for i in range(1, 50)]
+    uniques = [[e['xpath']] for e in elements]
+    live, archive = f'{dirr}/live.jpg', f'{dirr}/archive.jpg'
+
+    def check_page(cached):
+        for _ in range(stages):
+            for _ in range(2):
+                if not cached:
+                    screenshot_diff.clear_image_cache()
+                check_utils.filter_same_visual_part(live, uniques, elements, archive, uniques, elements)
+            if not cached:
+                screenshot_diff.clear_image_cache()
+            check_utils.compare_screenshot(live, archive)
+
+    t_decode = _timeit(lambda: check_page(False))
+    screenshot_diff.clear_image_cache()
+    t_cached = _timeit(lambda: check_page(True))
+    print(f'{stages} stages x 3 screenshot reads ({height}x{width}): decode every time {t_decode:.2f}s, '
+          f'cached {t_cached:.2f}s, {screenshot_diff.image_cache_info()}')
+
+
+def bench_visual_part(branches=3000, height=20000, width=1280):
+    """filter_same_visual_part with many unique branches over a tall page, all pairs vs. the crop grid"""
+    import cv2
+    from fidex.fidelity_check import check_utils, screenshot_diff
+    from test_check_utils import _gen_branches, _reference_filter_same_visual_part
+    dirr = tempfile.mkdtemp()
+    rnd = np.random.default_rng(0)
+    img = np.zeros((height, width, 3), np.uint8)
+    other = img.copy()
+    # Half of the page differs, so that about half of the branches are kept
+    other[height // 2:, :, 0] = 255
+    cv2.imwrite(f'{dirr}/live.png', img)
+    cv2.imwrite(f'{dirr}/archive.png', other)
+    live, archive = f'{dirr}/live.png', f'{dirr}/archive.png'
+    left_elements, left_unique = _gen_branches(rnd, 'l', branches, height, width)
+    right_elements, right_unique = _gen_branches(rnd, 'r', branches, height, width)
+    args = (live, left_unique, left_elements, archive, right_unique, right_elements)
+    screenshot_diff.imread(live), screenshot_diff.imread(archive)
+    t_pairs = _timeit(lambda: _reference_filter_same_visual_part(*args))
+    t_grid = _timeit(lambda: check_utils.filter_same_visual_part(*args))
+    kept = check_utils.filter_same_visual_part(*args)
+    assert kept == _reference_filter_same_visual_part(*args)
+    print(f'{branches} x {branches} branches ({height}x{width}): all pairs {t_pairs:.2f}s, grid {t_grid:.2f}s, '
+          f'kept {len(kept[0])}/{len(kept[1])}')
+
+
+def bench_extract_text(n=100000, skipped=5000):
+    """extract_text on a page with many skipped (script, style ...) nodes, checking every skipped prefix vs. one pass,
+    and the text of a dom file from the loaded list vs. streamed"""
+    import json
+    from fidex.fidelity_check import check_utils, dom_delta
+    from test_check_utils import _reference_extract_text
+    dirr = tempfile.mkdtemp()
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    rnd = random.Random(0)
+    for idx in rnd.sample(range(len(elements)), skipped):
+        parent = elements[idx]['xpath'].rsplit('/', 1)[0]
+        elements[idx] = {**elements[idx], 'xpath': f'{parent}/script[{idx}]'}
+    synthetic_pages.write_page(dirr, 'live', elements, [], [])
+    path = f'{dirr}/live_dom.json'
+    t_prefixes = _timeit(lambda: _reference_extract_text(elements))
+    t_pass = _timeit(lambda: check_utils.extract_text(elements))
+    assert check_utils.extract_text(elements) == _reference_extract_text(elements)
+    load = lambda: check_utils.extract_text(json.load(open(path)))
+    stream = lambda: check_utils.extract_text(dom_delta.iter_elements(path))
+    t_load, m_load = _timeit(load), _peak_memory(load)
+    t_stream, m_stream = _timeit(stream), _peak_memory(stream)
+    print(f'{n} elements, {skipped} skipped nodes: all prefixes {t_prefixes:.2f}s, one pass {t_pass:.3f}s; '
+          f'file: loaded {t_load:.2f}s {m_load / 2**20:.0f}MB, streamed {t_stream:.2f}s {m_stream / 2**20:.0f}MB')
+
+
+def bench_wrapping_elements(n=20000, branches=20, branch_size=500):
+    """check_meaningful._remove_wrapping_elements on large unique branches, scanning the page vs. the xpath index"""
+    from fidex.fidelity_check import check_meaningful
+    from test_check_meaningful import _reference_remove_wrapping_elements
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    xpaths_map = {e['xpath']: e for e in elements}
+    xpaths = list(xpaths_map)
+    rnd = random.Random(0)
+    # Unique subtrees where some of the descendants are matched (not in the branch)
+    unique = []
+    for _ in range(branches):
+        start = rnd.randrange(len(xpaths) - branch_size)
+        unique.append([x for x in xpaths[start:start + branch_size] if rnd.random() < 0.8])
+    t_scan = _timeit(lambda: [_reference_remove_wrapping_elements(b, xpaths_map) for b in unique])
+    def indexed():
+        index = check_meaningful._XPathIndex(xpaths_map)
+        return [check_meaningful._remove_wrapping_elements(b, xpaths_map, index) for b in unique]
+    t_index = _timeit(indexed)
+    assert indexed() == [_reference_remove_wrapping_elements(b, xpaths_map) for b in unique]
+    print(f'{branches} branches of ~{branch_size} xpaths on {n} elements: scan {t_scan:.2f}s, index {t_index:.3f}s')
+
+
+def bench_meaningful_diff(n=2000, branches=100):
+    """meaningful_diff of a broken page with many unique branches, page data derived per branch vs. once per side"""
+    from fidex.fidelity_check import check_meaningful
+    from test_check_meaningful import _gen_branches, _reference_meaningful_diff
+    left = synthetic_pages.gen_elements(n, seed=0)
+    right = synthetic_pages.mutate_elements(left, n // 20, seed=0)
+    left_unique, right_unique = _gen_branches(left, branches, seed=0), _gen_branches(right, branches, seed=1)
+    args = (left, left_unique, right, right_unique)
+    t_branch = _timeit(lambda: _reference_meaningful_diff(*args))
+    t_page = _timeit(lambda: check_meaningful.meaningful_diff(*args))
+    assert check_meaningful.meaningful_diff(*args) == _reference_meaningful_diff(*args)
+    print(f'{n} elements, {branches} unique branches per side: per branch {t_branch:.2f}s, per page {t_page:.2f}s')
+
+
+def bench_noise_rules(n=10000):
+    """branch_meaningful of every element of a page, each filter parsing the elements vs. the compiled noise rules"""
+    from fidex.fidelity_check import check_meaningful
+    from test_check_meaningful import _reference_branch_meaningful
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    xpaths_map = {e['xpath']: e for e in elements}
+    branches = [[x] for x in xpaths_map]
+    t_filters = _timeit(lambda: [_reference_branch_meaningful(b, xpaths_map) for b in branches])
+    check_meaningful.clear_noise_rule_hits()
+    def compiled():
+        page = check_meaningful._PageIndex(xpaths_map)
+        return [check_meaningful.branch_meaningful(b, xpaths_map, page) for b in branches]
+    t_rules = _timeit(compiled)
+    assert compiled() == [_reference_branch_meaningful(b, xpaths_map) for b in branches]
+    hits = sorted(check_meaningful.noise_rule_hits().items(), key=lambda kv: -kv[1])
+    print(f'{n} single element branches: per filter {t_filters:.2f}s, compiled rules {t_rules:.2f}s, hits {hits[:5]}')
+
+
+def bench_diff_events(sizes=(500, 2000, 5000), broken=0.5):
+    """Event alignment of a broken archive (events missing or on other elements), Myers vs. the hash join"""
+    from fidex.fidelity_check import events
+    for n in sizes:
+        rnd = random.Random(0)
+        elements = synthetic_pages.gen_elements(n * 4, seed=0)
+        # * One event per element, as recorded
+        left = list({e['path']: e for e in synthetic_pages.gen_events(elements, n, seed=0)}.values())
+        right = []
+        for e in left:
+            if rnd.random() < broken:
+                e = dict(e, path=f'{e["path"]}/div[1]', element=f'div.moved-{e["idx"]}')
+            if rnd.random() < 0.9:
+                right.append(e)
+        left_seq, right_seq = events.load_events(left), events.load_events(right)
+        t_myers = _timeit(lambda: myers.myers_diff(left_seq, right_seq))
+        m_myers = _peak_memory(lambda: myers.myers_diff(left_seq, right_seq))
+        t_join = _timeit(lambda: events.diff_events(left_seq, right_seq))
+        m_join = _peak_memory(lambda: events.diff_events(left_seq, right_seq))
+        assert events.diff_events(left_seq, right_seq) == myers.myers_diff(left_seq, right_seq)
+        print(f'{len(left_seq)} vs. {len(right_seq)} events: myers {t_myers:.3f}s {m_myers / 2**20:.1f}MB, '
+              f'hash join {t_join:.4f}s {m_join / 2**20:.2f}MB, {events.ALIGN_STATS}')
+
+
+def bench_total_area(sizes=(1000, 5000, 20000, 100000), reference_limit=20000):
+    """calculate_total_area of diff rectangles over a 1280x20000 page, previous sweep vs. the coverage tree"""
+    from fidex.fidelity_check import fidelity_impact
+    from test_fidelity_impact import _reference_calculate_total_area
+    for n in sizes:
+        rnd = random.Random(0)
+        rectangles = [(rnd.randint(10, 400), rnd.randint(10, 300), rnd.randrange(20000), rnd.randrange(1280), 1)
+                      for _ in range(n)]
+        t_tree = _timeit(lambda: fidelity_impact.calculate_total_area(rectangles))
+        if n <= reference_limit:
+            t_ref = _timeit(lambda: _reference_calculate_total_area(rectangles))
+            reference = f'{t_ref:.2f}s'
+            assert fidelity_impact.calculate_total_area(rectangles) == _reference_calculate_total_area(rectangles)
+        else:
+            reference = 'skipped'
+        print(f'{n} rectangles: previous sweep {reference}, coverage tree {t_tree:.2f}s')
+
+
+_COLD_LOAD = """
+import json, sys, time, tracemalloc
+from fidex.fidelity_check import sidecar
+mode, measure, paths = sys.argv[1], sys.argv[2], sys.argv[3:]
+if measure == 'memory':
+    tracemalloc.start()
+start = time.perf_counter()
+loaded = [json.load(open(p)) if mode == 'json' else sidecar.read_sidecar(p) for p in paths]
+duration = time.perf_counter() - start
+print(*tracemalloc.get_traced_memory() if measure == 'memory' else [duration])
+"""
+
+
+def bench_sidecar(n=100000):
+    """Cold load (fresh process) time and memory (retained/peak python heap) of a page's files, json vs. sidecars"""
+    import subprocess
+    from fidex.fidelity_check import sidecar
+    dirr = tempfile.mkdtemp()
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks)
+    sidecar.convert(dirr)
+    paths = [f'{dirr}/live_dom.json', f'{dirr}/live_writes.json', f'{dirr}/live_writeStacks.json']
+    results = {}
+    for mode in ['json', 'sidecar']:
+        def run(measure):
+            return subprocess.run([sys.executable, '-c', _COLD_LOAD, mode, measure] + paths,
+                                  capture_output=True, text=True, check=True).stdout.split()
+        (duration,), (retained, peak) = run('time'), run('memory')
+        results[mode] = f'{float(duration):.2f}s {int(retained) / 1e6:.0f}MB/{int(peak) / 1e6:.0f}MB'
+    disk = {mode: sum(os.path.getsize(p) if mode == 'json' else
+                      sum(os.path.getsize(f'{p}{sidecar.SUFFIX}/{f}') for f in os.listdir(p + sidecar.SUFFIX))
+                      for p in paths) / 1e6 for mode in results}
+    print(f'cold load ({n} elements, {n // 10} writes): json {results["json"]} {disk["json"]:.0f}MB on disk, '
+          f'sidecar {results["sidecar"]} {disk["sidecar"]:.0f}MB on disk')
+
+
+def bench_parallel_interactions(n=10000, interactions=20, workers=4):
+    """fidelity_issue_all on a site with many interactions (no issue, so all stages run), sequential vs. process pool"""
+    dirr = tempfile.mkdtemp()
+    elements = synthetic_pages.gen_elements(n, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, n // 10, seed=0, num_stacks=6)
+    archive_writes, archive_stacks = synthetic_pages.gen_writes(elements, n // 10, seed=1, num_stacks=4)
+    events = synthetic_pages.gen_events(elements, interactions, seed=0)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks, events=events)
+    synthetic_pages.write_page(dirr, 'archive', elements, archive_writes, archive_stacks, events=events)
+    for i in range(interactions):
+        synthetic_pages.write_page(dirr, f'live_{i}', elements, writes, stacks)
+        synthetic_pages.write_page(dirr, f'archive_{i}', elements, archive_writes, archive_stacks)
+    logging.disable(logging.WARNING)
+    t_sequential = _timeit(lambda: fidelity_detect.fidelity_issue_all(dirr, layout_check=True, writedown=False))
+    # * First call starts the pool, the timed ones reuse it
+    fidelity_detect.fidelity_issue_all(dirr, layout_check=True, writedown=False, workers=workers)
+    t_parallel = _timeit(lambda: fidelity_detect.fidelity_issue_all(dirr, layout_check=True, writedown=False, workers=workers))
+    fidelity_detect.shutdown_pool()
+    logging.disable(logging.NOTSET)
+    print(f'fidelity_issue_all ({n} elements, {interactions} interactions, {os.cpu_count()} CPUs): '
+          f'sequential {t_sequential:.2f}s, {workers} workers {t_parallel:.2f}s')
+
+
+BENCHMARKS = {name[len('bench_'):]: func for name, func in globals().items() if name.startswith('bench_')}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or ['all']
+    for name, func in BENCHMARKS.items():
+        if 'all' in names or name in names:
+            func()
@@ -0,0 +1,171 @@
+"""
+Synthetic page generator for fidelity check tests and benchmarks.
+Produces the same on-disk artifacts as record.js/replay.js ({prefix}_dom.json, {base}_writes.json, {base}_writeStacks.json)
+"""
+import json
+import os
+import random
+
+TAGS = ['div', 'span', 'p', 'section', 'li', 'ul', 'a', 'img', 'button']
+STYLES = ['', 'color: red;', 'display: block; width: 100px;', 'margin: 0px 4px;', 'transform: translate(3px, 0px); opacity: 1;']
+CLASSES = ['', 'card', 'nav item', 'ad-slot', 'ytp-chrome', 'progress-bar', 'lazy hero']
+
+
+def _start_tag(tagname, idx, rnd):
+    attrs = []
+    if rnd.random() < 0.5:
+        attrs.append(f'class="{rnd.choice(CLASSES)}"')
+    if rnd.random() < 0.2:
+        attrs.append(f'id="{tagname}-{idx}"')
+    style = rnd.choice(STYLES)
+    if style:
+        attrs.append(f'style="{style}"')
+    if tagname == 'a':
+        attrs.append(f'href="https://example.com/page/{idx % 97}?a=1&amp;b=2"')
+    if tagname == 'img':
+        attrs.append(f'src="/static/img/{idx % 31}.png"')
+        if rnd.random() < 0.3:
+            attrs.append(f'data-lazy-src="/static/lazy/{idx % 17}.jpg"')
+    attr_str = (' ' + ' '.join(attrs)) if attrs else ''
+    return f'<{tagname}{attr_str}>'
+
+
+def gen_elements(n, seed=0, max_children=6, max_depth=12):
+    """Generate a DOM element list in document (DFS) order with roughly n entries"""
+    rnd = random.Random(seed)
+    elements = []
+    top = [0]
+
+    def add(xpath, text, depth, dimension):
+        elements.append({
+            'text': text,
+            'xpath': xpath,
+            'dimension': dimension,
+            'extraAttr': {},
+            'depth': depth,
+        })
+
+    def dfs(xpath, depth, left, width):
+        if len(elements) >= n or depth >= max_depth:
+            return
+        counters = {}
+        for _ in range(rnd.randint(1, max_children)):
+            if len(elements) >= n:
+                return
+            if rnd.random() < 0.25:
+                tagname = '#text'
+            else:
+                tagname = rnd.choice(TAGS)
+            counters[tagname] = counters.get(tagname, 0) + 1
+            child = f'{xpath}/{tagname}[{counters[tagname]}]'
+            if tagname == '#text':
+                add(child, f'text {len(elements)} {rnd.randint(0, 5)}', depth + 1, None)
+                continue
+            height = rnd.choice([0, 20, 40, 100])
+            dimension = {'left': left, 'top': top[0], 'width': width, 'height': height}
+            top[0] += height // 2
+            add(child, _start_tag(tagname, len(elements), rnd), depth + 1, dimension)
+            if tagname not in ['img']:
+                dfs(child, depth + 1, left + 5, max(width - 10, 10))
+
+    add('/html[1]', '<html>', 0, {'left': 0, 'top': 0, 'width': 1280, 'height': 4000})
+    add('/html[1]/body[1]', '<body>', 1, {'left': 0, 'top': 0, 'width': 1280, 'height': 4000})
+    while len(elements) < n:
+        dfs('/html[1]/body[1]', 1, 0, 1280)
+        if len(elements) < n:
+            # Start another top-level section to keep filling
+            sections = sum(1 for e in elements if e['depth'] == 2 and e['xpath'].startswith('/html[1]/body[1]/main['))
+            xpath = f'/html[1]/body[1]/main[{sections + 1}]'
+            add(xpath, '<main>', 2, {'left': 0, 'top': top[0], 'width': 1280, 'height': 400})
+            dfs(xpath, 2, 0, 1280)
+    return elements
+
+
+def gen_writes(elements, num_writes, seed=0, num_stacks=20):
+    """Generate writes and stacks (writeStacks.json format) associated with random elements"""
+    rnd = random.Random(seed)
+    stacks = []
+    for i in range(num_stacks):
+        stacks.append({
+            'stackInfo': [{
+                'callFrames': [{
+                    'url': f'https://example.com/static/app{i % 5}.js',
+                    'functionName': f'render{i}',
+                    'lineNumber': i,
+                    'columnNumber': 10 * i,
+                }],
+                'description': '',
+            }],
+            'wids': [],
+        })
+    element_xpaths = [e['xpath'] for e in elements if not e['xpath'].split('/')[-1].startswith('#text')]
+    writes = []
+    for i in range(num_writes):
+        target = rnd.choice(element_xpaths)
+        method = rnd.choice(['appendChild', 'setAttribute', 'set:textContent', 'set:innerHTML'])
+        if method == 'appendChild':
+            children = [e['xpath'] for e in elements if e['xpath'].startswith(target + '/')]
+            arg = {'html': '<div>', 'xpath': children[0]} if children else {'html': '<div>'}
+            args = [arg]
+        elif method == 'setAttribute':
+            args = [{'html': 'class'}, {'html': rnd.choice(CLASSES)}]
+        elif method == 'set:textContent':
+            args = [{'html': f'text {i}'}]
+        else:
+            args = [{'html': '<span>inner</span><a href="/x">x</a>'}]
+        wid = f'{i}:{rnd.randint(0, 1 << 20)}'
+        stacks[rnd.randrange(num_stacks)]['wids'].append(wid)
+        writes.append({
+            'wid': wid,
+            'method': method,
+            'xpath': target,
+            'args': args,
+            'currentStage': 'onload',
+            'effective': rnd.random() < 0.5,
+            'currentDS': {'width': rnd.choice([0, 10]), 'height': 10},
+        })
+    stacks = [s for s in stacks if s['wids']]
+    return writes, stacks
+
+
+def gen_events(elements, num_events, seed=0):
+    """Generate recorded interactions ({base}_events.json format) on random visible elements"""
+    rnd = random.Random(seed)
+    candidates = [e for e in elements if e['dimension'] and e['dimension']['height'] > 1 and e['dimension']['width'] > 1
+                  and not e['xpath'].split('/')[-1].startswith(('#text', 'a['))]
+    events = []
+    for idx in range(num_events):
+        e = rnd.choice(candidates)
+        events.append({'idx': idx, 'element': f'{e["xpath"].split("/")[-1].split("[")[0]}.target-{idx}',
+                       'path': e['xpath'], 'events': ['click'], 'url': 'https://example.com/'})
+    return events
+
+
+def mutate_elements(elements, num_changes, seed=0):
+    """Copy elements and break a few of them (drop a subtree, resize, or change text)"""
+    rnd = random.Random(seed)
+    elements = [dict(e) for e in elements]
+    for _ in range(num_changes):
+        idx = rnd.randrange(2, len(elements))
+        e = elements[idx]
+        op = rnd.random()
+        if op < 0.3:
+            xpath = e['xpath']
+            elements = [el for el in elements if not (el['xpath'] == xpath or el['xpath'].startswith(xpath + '/'))]
+        elif op < 0.6 and e['dimension']:
+            e['dimension'] = dict(e['dimension'], width=e['dimension']['width'] // 2 + 1)
+        else:
+            e['text'] = e['text'] + ' changed'
+    return elements
+
+
+def write_page(dirr, prefix, elements, writes, stacks, events=None):
+    """Dump a page to dirr the same way replay.js does"""
+    os.makedirs(dirr, exist_ok=True)
+    base = prefix.split('_')[0]
+    json.dump(elements, open(f'{dirr}/{prefix}_dom.json', 'w'))
+    if not os.path.exists(f'{dirr}/{base}_writes.json') or prefix == base:
+        json.dump(writes, open(f'{dirr}/{base}_writes.json', 'w'))
+        json.dump(stacks, open(f'{dirr}/{base}_writeStacks.json', 'w'))
+    if events is not None:
+        json.dump(events, open(f'{dirr}/{base}_events.json', 'w'))
@@ -0,0 +1,268 @@
+import json
+import random
+import re
+
+import pytest
+from bs4 import BeautifulSoup
+
+import synthetic_pages
+from fidex import config
+from fidex.fidelity_check import check_meaningful
+from fidex.utils import common, url_utils
+
+
+def _reference_iframe_text(branch, xpaths_map):
+    paths = branch[0].split('/')
+    iframe_idx = next((i for i, p in enumerate(paths) if p.startswith('iframe')), -1)
+    iframe_element = xpaths_map.get('/'.join(paths[:iframe_idx + 1]), None)
+    return iframe_element['text'].lower() if iframe_element is not None else ''
+
+
+def _reference_class_ids(tag):
+    class_ids = []
+    if tag.attrs.get('class', ''):
+        class_ids += tag.attrs.get('class', '')
+    if tag.attrs.get('id', ''):
+        class_ids.append(tag.attrs.get('id', ''))
+    return [c for cl in class_ids for c in re.split(r'[ \-_]+', cl)]
+
+
+def _reference_from_recaptcha(branch, xpaths_map):
+    if 'recaptcha' in _reference_iframe_text(branch, xpaths_map) \
+      or any('recaptcha' in xpaths_map[br]['text'].lower() for br in branch):
+        return True
+    background = re.compile(r'<div style="width: 100%; height: 100%; position: fixed; top: 0px; left: 0px; '
+                            r'z-index: \d+; background-color: rgb\(255, 255, 255\);\ opacity:\ 0\.\d+;">')
+    return len(branch) == 1 and background.search(xpaths_map[branch[0]]['text'].lower()) is not None
+
+
+def _reference_from_ads(branch, xpaths_map):
+    for br in branch:
+        tag = BeautifulSoup(xpaths_map[br]['text'], 'html.parser').find()
+        if tag is None:
+            continue
+        class_ids = _reference_class_ids(tag)
+        if any(ad in class_ids for ad in ['adsbygoogle', 'ad', 'ads', 'advertisement', 'infinite', 'gpt']) \
+          or 'counter.yadro.ru/hit' in tag.attrs.get('src', ''):
+            return True
+    return False
+
+
+def _reference_from_dynamic(branch, xpaths_map):
+    for br in branch:
+        tag = BeautifulSoup(xpaths_map[br]['text'], 'html.parser').find()
+        if tag is not None and 'progress' in _reference_class_ids(tag):
+            return True
+    return False
+
+
+def _reference_branch_meaningful(branch, xpaths_map):
+    """Previous branch_meaningful, with each filter parsing and matching the elements itself"""
+    if not check_meaningful._visible(branch, xpaths_map) or check_meaningful._ignore_tag(branch):
+        return False
+    if _reference_from_recaptcha(branch, xpaths_map):
+        return False
+    for br in branch:
+        while common.tagname_from_xpath(xpaths_map[br]['xpath']) == '#text' and len(br.split('/')) > 1:
+            br = '/'.join(br.split('/')[:-1])
+        tag = BeautifulSoup(xpaths_map[br]['text'], 'html.parser').find()
+        if tag is not None and 'ytp' in ' '.join(tag.attrs.get('class', '')):
+            return False
+    if 'player.vimeo.com' in _reference_iframe_text(branch, xpaths_map):
+        return False
+    return not _reference_from_ads(branch, xpaths_map) and not _reference_from_dynamic(branch, xpaths_map)
+
+
+def _reference_remove_wrapping_elements(branch, xpaths_map):
+    """Previous _remove_wrapping_elements, scanning the branch and the page for children"""
+    removed = 1
+    cur_branch = branch
+    while removed > 0:
+        removed = 0
+        new_branch = []
+        for br in cur_branch:
+            if any(b != br and b.startswith(br) for b in cur_branch):
+                new_branch.append(br)
+                continue
+            if any(b != br and b.startswith(br) for b in xpaths_map):
+                removed += 1
+            else:
+                new_branch.append(br)
+        cur_branch = new_branch
+    return cur_branch
+
+
+def _reference_invisible_img_srcs(other_xpaths_map):
+    invisible_img_srcs = set()
+    for xpath, obj in other_xpaths_map.items():
+        if not check_meaningful._visible([xpath], other_xpaths_map) and common.tagname_from_xpath(xpath) == 'img':
+            img_tag = BeautifulSoup(obj['text'], 'html.parser').find('img')
+            srcs = common.get_img_src(img_tag)
+            if 'currentSrc' in obj.get('extraAttr', {}):
+                srcs.add(url_utils.url_norm(obj['extraAttr']['currentSrc'],
+                                            ignore_scheme=True, trim_www=True, trim_slash=True, archive=True))
+            invisible_img_srcs.update(srcs)
+    return invisible_img_srcs
+
+
+def _reference_remove_unnecessary_elements(branch, xpaths_map, other_xpaths_map):
+    """Previous _remove_unnecessary_elements, checking every filtered xpath"""
+    invisible_img_srcs = _reference_invisible_img_srcs(other_xpaths_map)
+    new_branch, filtered_branch = [], []
+    for br in branch:
+        if any(br.startswith(fbr) for fbr in filtered_branch):
+            continue
+        if _reference_from_ads([br], xpaths_map) \
+          or _reference_from_dynamic([br], xpaths_map) \
+          or _reference_from_recaptcha([br], xpaths_map) \
+          or check_meaningful._from_lazyload_image([br], xpaths_map, invisible_img_srcs):
+            filtered_branch.append(br)
+            continue
+        new_branch.append(br)
+    return new_branch
+
+
+def _gen_branches(elements, num, seed=0):
+    """Subtrees of the page, some partial, some with unrelated xpaths or out of DOM order"""
+    rnd = random.Random(seed)
+    xpaths = [e['xpath'] for e in elements]
+    branches = []
+    for i in range(num):
+        start = rnd.randrange(len(xpaths))
+        branch = [x for x in xpaths[start:start + 60] if x.startswith(xpaths[start])]
+        branch = [x for x in branch if rnd.random() < 0.7] or [xpaths[start]]
+        if i % 5 == 0:
+            branch += rnd.sample(xpaths, 3)
+        if i % 7 == 0:
+            rnd.shuffle(branch)
+        branches.append(branch)
+    return branches
+
+
+def test_xpath_index():
+    index = check_meaningful._XPathIndex(['/html[1]/body[1]/div[1]', '/html[1]/body[1]/div[1]/p[1]',
+                                          '/html[1]/body[1]/div[10]'])
+    assert index.has_descendant('/html[1]/body[1]')
+    assert index.has_descendant('/html[1]/body[1]/div[1]')
+    assert not index.has_descendant('/html[1]/body[1]/div[1]/p[1]')
+    assert not index.has_descendant('/html[1]/body[1]/div[2]')
+    roots = check_meaningful._XPathIndex()
+    for xpath in ['/html[1]/body[1]/div[2]/p[1]', '/html[1]/body[1]/div[1]', '/html[1]/body[1]/div[2]']:
+        roots.add_root(xpath)
+    assert roots.xpaths == ['/html[1]/body[1]/div[1]', '/html[1]/body[1]/div[2]']
+    assert roots.under('/html[1]/body[1]/div[2]/p[3]') and roots.under('/html[1]/body[1]/div[1]')
+    assert not roots.under('/html[1]/body[1]/div[3]') and not roots.under('/html[1]/body[1]')
+
+
+def test_branch_filters_match_reference():
+    for seed in range(2):
+        left = synthetic_pages.gen_elements(600, seed=seed)
+        right = synthetic_pages.mutate_elements(left, 50, seed=seed)
+        left_map, right_map = {e['xpath']: e for e in left}, {e['xpath']: e for e in right}
+        left_page, right_page = check_meaningful._PageIndex(left_map), check_meaningful._PageIndex(right_map)
+        for branch in _gen_branches(left, 50, seed=seed):
+            assert check_meaningful._remove_wrapping_elements(branch, left_map, left_page.xpaths) \
+                == check_meaningful._remove_wrapping_elements(branch, left_map) \
+                == _reference_remove_wrapping_elements(branch, left_map)
+            assert check_meaningful._remove_unnecessary_elements(branch, left_page, right_page) \
+                == _reference_remove_unnecessary_elements(branch, left_map, right_map)
+
+
+def _reference_meaningful_diff(left_element, left_unique, right_element, right_unique):
+    """Previous meaningful_diff, deriving the page data for every branch"""
+    left_xpaths_map = {e['xpath']: e for e in left_element}
+    right_xpaths_map = {e['xpath']: e for e in right_element}
+    new_unique = []
+    for unique, xpaths_map, other_xpaths_map in [(left_unique, left_xpaths_map, right_xpaths_map),
+                                                 (right_unique, right_xpaths_map, left_xpaths_map)]:
+        new_unique.append([])
+        for branch in unique:
+            if not _reference_branch_meaningful(branch, xpaths_map):
+                continue
+            branch = _reference_remove_unnecessary_elements(branch, xpaths_map, other_xpaths_map)
+            branch = _reference_remove_wrapping_elements(branch, xpaths_map)
+            new_unique[-1].append(branch) if len(branch) > 0 else None
+    return tuple(new_unique)
+
+
+def test_meaningful_diff_matches_reference():
+    left = synthetic_pages.gen_elements(500, seed=0)
+    right = synthetic_pages.mutate_elements(left, 50, seed=0)
+    left_unique, right_unique = _gen_branches(left, 30, seed=0), _gen_branches(right, 30, seed=1)
+    expected = _reference_meaningful_diff(left, left_unique, right, right_unique)
+    assert check_meaningful.meaningful_diff(left, left_unique, right, right_unique) == expected
+    assert 0 < sum(map(len, expected[0])) < sum(map(len, left_unique))
+
+
+def _noise_page():
+    body = '/html[1]/body[1]'
+    texts = {
+        f'{body}/div[1]': '<div class="x-ad_box">',
+        f'{body}/div[2]': '<div class="&#97;d">',
+        f'{body}/div[3]': '<div id="Progress" class="header">',
+        f'{body}/div[4]': '<div class="bar  progress">',
+        f'{body}/div[5]': '<div class="ytp-chrome top">',
+        f'{body}/div[5]/#text[1]': 'Video title',
+        f'{body}/div[6]': '<img src="https://counter.yadro.ru/hit?q=1">',
+        f'{body}/iframe[1]': '<iframe src="https://www.google.com/ReCaptcha/api2/anchor">',
+        f'{body}/iframe[1]/div[1]': '<div class="inner">',
+        f'{body}/iframe[2]': '<iframe src="https://player.vimeo.com/video/1">',
+        f'{body}/iframe[2]/div[1]': '<div>',
+        f'{body}/div[7]': '<div style="width: 100%; height: 100%; position: fixed; top: 0px; left: 0px; z-index: 2000000000; '
+                          'background-color: rgb(255, 255, 255); opacity: 0.05;">',
+        f'{body}/div[8]': '<div class="sponsored-links">',
+        f'{body}/div[9]': '<div class="card">',
+        f'{body}/div[9]/#text[1]': 'ad ads progress <b class="ad">',
+        f'{body}/div[10]': '<div class="zoom">',
+    }
+    return {xpath: {'xpath': xpath, 'text': text, 'dimension': {'left': 0, 'top': 0, 'width': 100, 'height': 100}}
+            for xpath, text in texts.items()}
+
+
+def test_noise_rules(monkeypatch):
+    xpaths_map = _noise_page()
+    branches = [[x] for x in xpaths_map] + [list(xpaths_map)[i:i + 3] for i in range(len(xpaths_map))]
+    check_meaningful.clear_noise_rule_hits()
+    page = check_meaningful._PageIndex(xpaths_map)
+    for branch in branches:
+        assert check_meaningful.branch_meaningful(branch, xpaths_map, page) \
+            == check_meaningful.branch_meaningful(branch, xpaths_map) \
+            == _reference_branch_meaningful(branch, xpaths_map)
+    hits = check_meaningful.noise_rule_hits()
+    assert hits['ads_ad'] > 0 and hits['recaptcha'] > 0 and hits['vimeo_player'] > 0 and hits['youtube_ytp'] > 0
+    assert check_meaningful.branch_meaningful(['/html[1]/body[1]/div[8]'], xpaths_map)
+
+    # Rules from the config
+    monkeypatch.setattr(check_meaningful, 'config_rules', lambda: [
+        {'name': 'ads_sponsored', 'filter': 'ads', 'kind': 'class_id', 'pattern': 'sponsored'},
+        {'name': 'doubled', 'filter': 'dynamic', 'kind': 'text_regex', 'pattern': r'(o)\1'},
+    ])
+    check_meaningful._noise_rules.cache_clear()
+    try:
+        assert not check_meaningful.branch_meaningful(['/html[1]/body[1]/div[8]'], xpaths_map)
+        # Elements are classified once per page
+        assert check_meaningful.branch_meaningful(['/html[1]/body[1]/div[10]'], page=page, xpaths_map=xpaths_map)
+        assert not check_meaningful.branch_meaningful(['/html[1]/body[1]/div[10]'], xpaths_map)
+        assert check_meaningful.noise_rule_hits()['ads_sponsored'] == 1
+        monkeypatch.setattr(check_meaningful, 'config_rules', lambda: [
+            {'name': 'bad', 'filter': 'ads', 'kind': 'attr', 'pattern': 'x'}])
+        check_meaningful._noise_rules.cache_clear()
+        with pytest.raises(ValueError):
+            check_meaningful.branch_meaningful(['/html[1]/body[1]/div[8]'], xpaths_map)
+    finally:
+        check_meaningful._noise_rules.cache_clear()
+        check_meaningful.clear_noise_rule_hits()
+
+
+
+def test_config_rules(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, '_config', None)
+    monkeypatch.setattr(config, 'config_path', str(tmp_path / 'config.json'))
+    # * No config file: no extra rules, and CONFIG still raises
+    assert config.load_config() is None and check_meaningful.config_rules() == []
+    with pytest.raises(FileNotFoundError):
+        from fidex.config import CONFIG
+    rules = [{'name': 'ads_sponsored', 'filter': 'ads', 'kind': 'class_id', 'pattern': 'sponsored'}]
+    (tmp_path / 'config.json').write_text(f'{{"noise_rules": {json.dumps(rules)}}}')
+    assert check_meaningful.config_rules() == rules
+    assert config.CONFIG is config.load_config()
@@ -0,0 +1,266 @@
+import os
+import random
+import shutil
+
+import cv2
+import numpy as np
+
+import synthetic_pages
+from fidex.fidelity_check import check_utils, events, fidelity_detect, myers, screenshot_diff
+
+
+def _gen_stage(dirr, seed, changes=30):
+    elements = synthetic_pages.gen_elements(2000, seed=seed)
+    writes, stacks = synthetic_pages.gen_writes(elements, 300, seed=seed, num_stacks=6)
+    archive_writes, archive_stacks = synthetic_pages.gen_writes(elements, 300, seed=seed + 1, num_stacks=4)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks)
+    synthetic_pages.write_page(dirr, 'archive', synthetic_pages.mutate_elements(elements, changes, seed=seed),
+                               archive_writes, archive_stacks)
+
+
+def test_diff_session_matches_fresh_trees(tmp_path):
+    for seed in range(3):
+        dirr = str(tmp_path / f'site{seed}')
+        _gen_stage(dirr, seed)
+        left_info = fidelity_detect.LoadInfo(dirr, 'live')
+        right_info = fidelity_detect.LoadInfo(dirr, 'archive')
+        session = check_utils.DiffSession(left_info, right_info)
+        for js_comp in [True, False, True]:
+            fresh = check_utils.diff(fidelity_detect.LoadInfo(dirr, 'live'), fidelity_detect.LoadInfo(dirr, 'archive'),
+                                     js_comp=js_comp)
+            assert session.diff(js_comp=js_comp) == fresh
+
+
+def test_load_info_cache(tmp_path, monkeypatch):
+    dirr = str(tmp_path / 'site')
+    _gen_stage(dirr, 0)
+    fidelity_detect.clear_load_cache()
+    first = fidelity_detect.LoadInfo(dirr, 'live')
+    second = fidelity_detect.LoadInfo(dirr, 'live')
+    assert second.elements is first.elements and second.writes is first.writes
+    assert fidelity_detect.load_cache_info()['hits'] == 1 and fidelity_detect.load_cache_info()['misses'] == 1
+    # Rewritten files are parsed again
+    synthetic_pages.write_page(dirr, 'live', synthetic_pages.gen_elements(100, seed=1), [], [])
+    third = fidelity_detect.LoadInfo(dirr, 'live')
+    assert len(third.elements) != len(first.elements) and len(third.writes) == 0
+    assert fidelity_detect.load_cache_info()['misses'] == 2
+    # Least recently used prefixes are evicted
+    monkeypatch.setattr(fidelity_detect, 'LOAD_CACHE_SIZE', 1)
+    fidelity_detect.LoadInfo(dirr, 'archive')
+    assert fidelity_detect.load_cache_info()['evictions'] == 2
+    fidelity_detect.LoadInfo(dirr, 'live')
+    assert fidelity_detect.load_cache_info()['misses'] == 4
+    fidelity_detect.clear_load_cache()
+
+
+def _reference_compare_screenshot(live_img, archive_img):
+    """Previous compare_screenshot, subtracting the full images"""
+    img1, img2 = cv2.imread(live_img), cv2.imread(archive_img)
+    height, width = min(img1.shape[0], img2.shape[0]), min(img1.shape[1], img2.shape[1])
+    img1, img2 = img1[:height, :width, :], img2[:height, :width, :]
+    same = np.count_nonzero((img1 - img2) == 0)
+    return same / (img1.shape[0] * img1.shape[1] * img1.shape[2])
+
+
+def test_compare_screenshot_matches_reference(tmp_path):
+    rnd = np.random.default_rng(0)
+    base = rnd.integers(0, 256, (700, 300, 3), dtype=np.uint8)
+    other = base.copy()
+    other[100:150, 20:80] = 0
+    other[650:] = 255 - other[650:]
+    pairs = [(base, other), (base, other[:500, :250]), (base[:10], other), (base, base)]
+    for i, (left, right) in enumerate(pairs):
+        live, archive = str(tmp_path / f'live_{i}.png'), str(tmp_path / f'archive_{i}.png')
+        cv2.imwrite(live, left), cv2.imwrite(archive, right)
+        expected = _reference_compare_screenshot(live, archive)
+        for tile_rows in [1, 64, screenshot_diff.TILE_ROWS, 10000]:
+            simi, diff = screenshot_diff.compare(live, archive, with_diff=True, tile_rows=tile_rows)
+            assert simi == expected
+        simi, diff = check_utils.compare_screenshot(live, archive)
+        if simi < 1:
+            # Absolute difference, not the wrapped around subtraction
+            height, width = min(left.shape[0], right.shape[0]), min(left.shape[1], right.shape[1])
+            cropped = left[:height, :width].astype(int) - right[:height, :width]
+            assert (diff == np.abs(cropped)).all()
+        else:
+            assert diff is None
+    # Byte-identical files are not decoded
+    shutil.copy(str(tmp_path / 'live_0.png'), str(tmp_path / 'copy.png'))
+    open(str(tmp_path / 'broken.png'), 'wb').write(b'not an image')
+    shutil.copy(str(tmp_path / 'broken.png'), str(tmp_path / 'broken_copy.png'))
+    assert check_utils.compare_screenshot(str(tmp_path / 'live_0.png'), str(tmp_path / 'copy.png')) == (1, None)
+    assert screenshot_diff.compare(str(tmp_path / 'broken.png'), str(tmp_path / 'broken_copy.png')) == (1, None)
+    assert screenshot_diff.compare(str(tmp_path / 'broken.png'), str(tmp_path / 'live_0.png')) == (None, None)
+
+
+def test_image_cache(tmp_path, monkeypatch):
+    screenshot_diff.clear_image_cache()
+    img = np.full((100, 50, 3), 7, np.uint8)
+    paths = [str(tmp_path / f'{i}.png') for i in range(3)]
+    for path in paths:
+        cv2.imwrite(path, img)
+    first = screenshot_diff.imread(paths[0])
+    assert screenshot_diff.imread(paths[0]) is first and not first.flags.writeable
+    assert screenshot_diff.image_cache_info()['hits'] == 1
+    # Rewritten file is decoded again
+    cv2.imwrite(paths[0], img + 1)
+    os.utime(paths[0], ns=(0, 0))
+    assert (screenshot_diff.imread(paths[0]) == 8).all()
+    # At most two images fit
+    monkeypatch.setattr(screenshot_diff, 'IMAGE_CACHE_BYTES', 2 * img.nbytes)
+    for path in paths:
+        screenshot_diff.imread(path)
+    info = screenshot_diff.image_cache_info()
+    assert info['size'] == 2 and info['bytes'] == 2 * img.nbytes and info['evictions'] == 2
+    screenshot_diff.clear_image_cache()
+
+
+def _reference_filter_same_visual_part(left_img, left_unique, left_elements, right_img, right_unique, right_elements):
+    """Previous filter_same_visual_part, checking all pairs of crops"""
+    left_xpaths_map = {e['xpath']: e for e in left_elements}
+    right_xpaths_map = {e['xpath']: e for e in right_elements}
+    def update_crop(crop, element, img_dimen):
+        if element.get('dimension', None) is None:
+            return crop
+        dimen = element['dimension']
+        t, b, l, r = crop
+        t = max(0, min(t, dimen['top']))
+        b = min(img_dimen[0], max(b, dimen['top'] + dimen['height']))
+        l = max(0, min(l, dimen['left']))
+        r = min(img_dimen[1], max(r, dimen['left'] + dimen['width']))
+        return [t, b, l, r]
+    def crop_intersect(crop1, crop2):
+        return crop1[0] < crop2[1] and crop1[1] > crop2[0] and crop1[2] < crop2[3] and crop1[3] > crop2[2]
+    def branch_crop(branch, xpaths_map, img_dimen):
+        crop_area = [float('inf'), float('-inf'), float('inf'), float('-inf')]
+        for xpath in branch:
+            crop_area = update_crop(crop_area, xpaths_map[xpath], img_dimen)
+        return crop_area
+    img1, img2 = screenshot_diff.imread(left_img), screenshot_diff.imread(right_img)
+    img_dimen = [min(img1.shape[0], img2.shape[0]), min(img1.shape[1], img2.shape[1])]
+    left_crops = [branch_crop(br, left_xpaths_map, img1.shape[:2]) for br in left_unique]
+    right_crops = [branch_crop(br, right_xpaths_map, img2.shape[:2]) for br in right_unique]
+    new_left_unique = []
+    for i in range(len(left_unique)):
+        matched_crop = False
+        for j in range(len(right_unique)):
+            left_crpo, right_crop = left_crops[i], right_crops[j]
+            if not crop_intersect(left_crpo, right_crop):
+                continue
+            merged_crop = [min(left_crpo[0], right_crop[0]), min(img_dimen[0], max(left_crpo[1], right_crop[1])),
+                           min(left_crpo[2], right_crop[2]), min(img_dimen[1], max(left_crpo[3], right_crop[3]))]
+            merged_crop = [int(c) for c in merged_crop]
+            left_crop = img1[merged_crop[0]:merged_crop[1], merged_crop[2]:merged_crop[3], :]
+            right_crop = img2[merged_crop[0]:merged_crop[1], merged_crop[2]:merged_crop[3], :]
+            diff = left_crop - right_crop
+            if np.count_nonzero(diff == 0) == diff.shape[0]*diff.shape[1]*diff.shape[2]:
+                matched_crop = True
+                right_unique = right_unique[:j] + right_unique[j+1:]
+                break
+        if not matched_crop:
+            new_left_unique.append(left_unique[i])
+    return new_left_unique, right_unique
+
+
+def _gen_branches(rnd, prefix, num, height, width):
+    elements, branches = [], []
+    for i in range(num):
+        branch = []
+        # Elements of a branch are close to each other. Some are (partly) out of the image, or of zero size
+        branch_top, branch_left = int(rnd.integers(-50, height + 100)), int(rnd.integers(-50, width))
+        for k in range(int(rnd.integers(1, 4))):
+            xpath = f'/html/{prefix}[{i}]/div[{k}]'
+            if rnd.random() < 0.1:
+                elements.append({'xpath': xpath})
+            else:
+                top, left = branch_top + int(rnd.integers(0, 100)), branch_left + int(rnd.integers(0, 100))
+                elements.append({'xpath': xpath, 'dimension': {'top': top, 'left': left,
+                                                               'height': int(rnd.integers(0, 400)),
+                                                               'width': int(rnd.integers(0, 200))}})
+            branch.append(xpath)
+        branches.append(branch)
+    return elements, branches
+
+
+def test_filter_same_visual_part_matches_reference(tmp_path):
+    rnd = np.random.default_rng(0)
+    for seed in range(6):
+        height, width = 3000, 400
+        # Mostly identical screenshots, so that many branches match
+        left = np.zeros((height, width, 3), np.uint8)
+        right = left.copy()
+        for _ in range(seed * 3):
+            top, l = int(rnd.integers(0, height)), int(rnd.integers(0, width))
+            right[top:top + 100, l:l + 50] = 255
+        if seed % 2:
+            right = right[:height - 500]
+        left_img, right_img = str(tmp_path / f'left_{seed}.png'), str(tmp_path / f'right_{seed}.png')
+        cv2.imwrite(left_img, left), cv2.imwrite(right_img, right)
+        left_elements, left_unique = _gen_branches(rnd, 'l', 60, height, width)
+        right_elements, right_unique = _gen_branches(rnd, 'r', 60, height, width)
+        expected = _reference_filter_same_visual_part(left_img, left_unique, left_elements,
+                                                      right_img, right_unique, right_elements)
+        assert len(expected[1]) < len(right_unique)
+        assert check_utils.filter_same_visual_part(left_img, left_unique, left_elements,
+                                                   right_img, right_unique, right_elements) == expected
+
+
+def _reference_extract_text(elements):
+    """Previous extract_text, checking every skipped prefix for each element"""
+    skip_prefix = set()
+    extracted_text = []
+    for element in elements:
+        tag = element['xpath'].split('/')[-1].split('[')[0]
+        if tag.upper() in ['SCRIPT', 'STYLE', 'HEADER', 'FOOTER', 'BANNER-DIV', 'NOSCRIPT', 'TITLE']:
+            skip_prefix.add(element['xpath'])
+            continue
+        if any(element['xpath'].startswith(prefix) for prefix in skip_prefix):
+            continue
+        if tag != '#text':
+            continue
+        extracted_text.append(element['text'])
+    return '\n'.join(extracted_text)
+
+
+def test_extract_text_matches_reference():
+    for seed in range(3):
+        elements = synthetic_pages.gen_elements(3000, seed=seed)
+        rnd = np.random.default_rng(seed)
+        # Skipped nodes, some nested in each other, with the text of the elements under them
+        for idx in rnd.choice(len(elements), 100, replace=False):
+            tag = rnd.choice(['script', 'style', 'header', 'FOOTER', 'title', 'div'])
+            parent = elements[idx]['xpath'].rsplit('/', 1)[0]
+            elements[idx] = {**elements[idx], 'xpath': f'{parent}/{tag}[{idx}]'}
+            for child in range(idx + 1, min(idx + 5, len(elements))):
+                elements[child] = {**elements[child], 'xpath': f'{parent}/{tag}[{idx}]/#text[{child}]',
+                                   'text': f'text {child}'}
+        elements = [{**e, 'text': e.get('text', '') or f'text of {e["xpath"]}'} for e in elements]
+        assert check_utils.extract_text(elements) == _reference_extract_text(elements)
+        assert check_utils.extract_text(iter(elements)) == _reference_extract_text(elements)
+
+
+
+def _gen_events(rnd, num, xpaths, selectors):
+    """Raw events on a few xpaths / selectors, so both kinds of equality, duplicates and reorders happen"""
+    return [{'idx': idx, 'element': rnd.choice(selectors), 'path': f'/html[1]/body[1]/div[{rnd.randrange(xpaths)}]',
+             'events': ['click'], 'url': 'https://example.com/'} for idx in range(num)]
+
+
+def test_diff_events_matches_myers():
+    rnd = random.Random(0)
+    events.ALIGN_STATS.update(hash_join=0, myers=0)
+    for _ in range(2000):
+        xpaths = rnd.randint(1, 40)
+        selectors = ['div', 'button', 'a.more', 'a..more', 'span#menu', 'div.nav.item'][:rnd.randint(1, 6)] \
+                    + [f'li.item-{i}' for i in range(rnd.randint(0, 30))]
+        left = _gen_events(rnd, rnd.randint(0, 30), xpaths, selectors)
+        right = _gen_events(rnd, rnd.randint(0, 30), xpaths, selectors)
+        if rnd.random() < 0.5:
+            left = right[:rnd.randint(0, len(right))] + left
+        for loader in [events.load_events, lambda evts: [events.Event(e) for e in evts]]:
+            left_seq, right_seq = loader(left), loader(right)
+            new = events.diff_events(left_seq, right_seq)
+            ref = myers.myers_diff(left_seq, right_seq)
+            assert [[id(e) for e in part] for part in new] == [[id(e) for e in part] for part in ref]
+    # * Both the hash join and the fallback are exercised
+    assert events.ALIGN_STATS['hash_join'] > 500 and events.ALIGN_STATS['myers'] > 500
\ No newline at end of file
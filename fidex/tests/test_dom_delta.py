@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import synthetic_pages
+from fidex.fidelity_check import dom_delta, fidelity_detect, sidecar
+from fidex.utils import diff_utils
+from test_fidelity_detect import _gen_site
+
+
+def test_delta_round_trip(tmp_path):
+    dirr = str(tmp_path / 'site')
+    elements = synthetic_pages.gen_elements(1000, seed=0)
+    writes, stacks = synthetic_pages.gen_writes(elements, 100, seed=0)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks)
+    stages = [elements, elements[:500], synthetic_pages.mutate_elements(elements, 10, seed=1),
+              # Added elements, reordered and duplicated xpaths
+              elements[:10] + [{**elements[3], 'text': 'added'}] + elements[600:] + elements[10:600] + elements[:5],
+              []]
+    for i, stage in enumerate(stages):
+        synthetic_pages.write_page(dirr, f'live_{i}', stage, writes, stacks)
+    # Not a stage dom, or no onload dom
+    assert not dom_delta.write_delta(f'{dirr}/live_dom.json')
+    synthetic_pages.write_page(dirr, 'proxy_0', elements, writes, stacks)
+    assert not dom_delta.write_delta(f'{dirr}/proxy_0_dom.json')
+
+    # * Stage json files are kept unless asked to remove them
+    assert dom_delta.convert(dirr) == len(stages)
+    assert all(os.path.exists(f'{dirr}/live_{i}_dom.json') for i in range(len(stages)))
+    assert dom_delta.convert(dirr, remove=True) == len(stages)
+    onload = dom_delta.load(f'{dirr}/live_dom.json')
+    for i, stage in enumerate(stages):
+        path = f'{dirr}/live_{i}_dom.json'
+        assert not os.path.exists(path) and dom_delta.exists(path)
+        loaded = dom_delta.load(path)
+        assert json.dumps(loaded) == json.dumps(stage)
+        # Unchanged elements are shared with the onload dom
+        onload_ids = set(id(e) for e in onload)
+        assert sum(id(e) in onload_ids for e in loaded) >= sum(e in elements for e in stage) - 1
+    assert os.path.getsize(f'{dirr}/live_0_dom.delta.json') < 100
+
+
+def test_delta_stale_base(tmp_path):
+    dirr = str(tmp_path / 'site')
+    elements = synthetic_pages.gen_elements(200, seed=0)
+    synthetic_pages.write_page(dirr, 'live', elements, [], [])
+    synthetic_pages.write_page(dirr, 'live_0', elements[:100], [], [])
+    assert sidecar.convert(dirr) == 4
+    assert dom_delta.convert(dirr, remove=True) == 1
+    # Only the sidecar of the onload dom is kept
+    os.remove(f'{dirr}/live_dom.json')
+    assert dom_delta.load(f'{dirr}/live_0_dom.json') == elements[:100]
+    # * Re-recorded onload dom: the leftover delta is not a stage anymore
+    synthetic_pages.write_page(dirr, 'live', elements[:50], [], [])
+    assert not dom_delta.exists(f'{dirr}/live_0_dom.json')
+    with pytest.raises(ValueError):
+        dom_delta.load(f'{dirr}/live_0_dom.json')
+    json.dump([{'idx': 0, 'element': 'div.a', 'path': elements[1]['xpath'], 'events': ['click'], 'url': ''}],
+              open(f'{dirr}/live_events.json', 'w'))
+    info = fidelity_detect.LoadInfo(dirr, 'live')
+    assert info.read_events() == []
+    # * Onload dom gone altogether
+    os.remove(f'{dirr}/live_dom.json')
+    shutil.rmtree(sidecar.sidecar_path(f'{dirr}/live_dom.json'))
+    assert not dom_delta.exists(f'{dirr}/live_0_dom.json')
+    with pytest.raises(FileNotFoundError):
+        dom_delta._load_base(f'{dirr}/live_dom.json')
+
+
+def test_fidelity_with_deltas(tmp_path):
+    checks = dict(layout_check=True, html_text=True, writedown=False, finish_all=True)
+    for seed, broken_from in enumerate([None, 2]):
+        dirr = str(tmp_path / f'site{seed}')
+        _gen_site(dirr, seed, broken_from=broken_from)
+        fidelity_detect.clear_load_cache()
+        expected = fidelity_detect.fidelity_issue_all(dirr, **checks)
+        stage = expected.info['diff_stage'] or 'onload'
+        expected_drops = diff_utils.drop_incorrect_left_diff(dirr, sum(expected.live_unique, []), 'live', 'archive', stage)
+        assert dom_delta.convert(dirr, remove=True) == 12
+        fidelity_detect.clear_load_cache()
+        assert fidelity_detect.fidelity_issue_all(dirr, **checks) == expected
+        assert diff_utils.drop_incorrect_left_diff(dirr, sum(expected.live_unique, []), 'live', 'archive', stage) \
+            == expected_drops
+
+
+def test_iter_elements(tmp_path):
+    dirr = str(tmp_path / 'site')
+    elements = synthetic_pages.gen_elements(300, seed=0)
+    elements[5]['text'] = 'unicode é中 "quoted" \\ \n'
+    synthetic_pages.write_page(dirr, 'live', elements, [], [])
+    synthetic_pages.write_page(dirr, 'live_0', elements[:100], [], [])
+    path = f'{dirr}/live_dom.json'
+    for chunk_size in [1, 7, 1000, dom_delta.STREAM_CHUNK]:
+        assert list(dom_delta._iter_json_array(path, chunk_size=chunk_size)) == json.load(open(path))
+    for content in ['[]', ' [ 1 , 23 ,{"a": [4]}, "x" ] \n', '[1.5e3]']:
+        open(f'{dirr}/array.json', 'w').write(content)
+        assert list(dom_delta._iter_json_array(f'{dirr}/array.json', chunk_size=2)) == json.loads(content)
+    for content in ['{}', '[1, 2', '[1 2]']:
+        open(f'{dirr}/array.json', 'w').write(content)
+        with pytest.raises(ValueError):
+            list(dom_delta._iter_json_array(f'{dirr}/array.json', chunk_size=2))
+    # Sidecar and delta only
+    assert sidecar.convert(dirr) == 4 and dom_delta.convert(dirr, remove=True) == 1
+    os.remove(path)
+    assert list(dom_delta.iter_elements(path)) == elements
+    assert list(dom_delta.iter_elements(f'{dirr}/live_0_dom.json')) == elements[:100]
@@ -0,0 +1,142 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+import synthetic_pages
+from fidex.fidelity_check import fidelity_detect, instrument, result_cache
+
+
+def _gen_site(dirr, seed, interactions=6, broken_from=None):
+    """Site with interactions, where the archive breaks from interaction broken_from on (never if None)"""
+    elements = synthetic_pages.gen_elements(600, seed=seed)
+    writes, stacks = synthetic_pages.gen_writes(elements, 100, seed=seed, num_stacks=6)
+    archive_writes, archive_stacks = synthetic_pages.gen_writes(elements, 100, seed=seed + 1, num_stacks=4)
+    events = synthetic_pages.gen_events(elements, interactions, seed=seed)
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks, events=events)
+    synthetic_pages.write_page(dirr, 'archive', elements, archive_writes, archive_stacks, events=events)
+    image = np.full((200, 200, 3), 255, np.uint8)
+    for prefix in ['live', 'archive']:
+        cv2.imwrite(f'{dirr}/{prefix}.jpg', image)
+        exceptions = [{'stage': 'onload', 'exceptions': []}]
+        if prefix == 'archive' and broken_from is not None:
+            exceptions.append({'stage': f'interaction_{broken_from}',
+                               'exceptions': [{'description': 'TypeError', 'scriptURL': 'https://example.com/app.js'}]})
+        json.dump(exceptions, open(f'{dirr}/{prefix}_exception_failfetch.json', 'w'))
+    for i in range(interactions):
+        broken = broken_from is not None and i >= broken_from
+        archive = synthetic_pages.mutate_elements(elements, 5, seed=seed + i) if broken else elements
+        synthetic_pages.write_page(dirr, f'live_{i}', elements, writes, stacks)
+        synthetic_pages.write_page(dirr, f'archive_{i}', archive, archive_writes, archive_stacks)
+        cv2.imwrite(f'{dirr}/live_{i}.jpg', image)
+        cv2.imwrite(f'{dirr}/archive_{i}.jpg', 255 - image if broken else image)
+
+
+def test_parallel_interactions_match_sequential(tmp_path):
+    checks = dict(layout_check=True, screenshot=True, more_errs=True, html_text=True)
+    pools = set()
+    for seed, broken_from in enumerate([None, 0, 3, 5]):
+        dirr = str(tmp_path / f'site{seed}')
+        _gen_site(dirr, seed, broken_from=broken_from)
+        for finish_all in [False, True]:
+            results = []
+            for workers in [None, 3]:
+                result = fidelity_detect.fidelity_issue_all(dirr, **checks, finish_all=finish_all, writedown=False,
+                                                            workers=workers)
+                diff_image = open(f'{dirr}/diff_archive.jpg', 'rb').read() if broken_from is not None else None
+                results.append((result.info, result.live_unique, result.archive_unique, result.more_errs, diff_image))
+            pools.add(id(fidelity_detect._pool))
+            assert results[0] == results[1]
+            for check in ['diff', 'layout_diff', 'screenshot_diff', 'more_errs_diff', 'html_text_diff']:
+                assert results[0][0][check] == (broken_from is not None)
+                assert results[0][0][f'{check}_stage'] == (f'interaction_{broken_from}' if broken_from is not None else None)
+    # The pool is shared by all calls
+    assert len(pools) == 1
+    fidelity_detect.shutdown_pool()
+    assert fidelity_detect._pool is None
+
+
+def test_result_cache(tmp_path):
+    dirr = str(tmp_path / 'site')
+    _gen_site(dirr, 0, broken_from=3)
+    checks = dict(layout_check=True, screenshot=True, writedown=False)
+    expected = fidelity_detect.fidelity_issue_all(dirr, **checks)
+
+    def run(**kwargs):
+        stats = dict(result_cache.CACHE_STATS)
+        result = fidelity_detect.fidelity_issue_all(dirr, **checks, cache=True, **kwargs)
+        return result, result_cache.CACHE_STATS['hits'] - stats['hits']
+
+    result, hits = run()
+    assert hits == 0 and result == expected
+    result, hits = run()
+    assert hits == 1 and result == expected
+    # Different options are different entries
+    assert run(meaningful=False)[1] == 0
+    assert run(meaningful=False)[1] == 1
+    # Outputs (diff files) and unrelated files don't invalidate, changed inputs do
+    open(f'{dirr}/proxy_dom.json', 'w').write('[]')
+    _, hits = run()
+    assert hits == 1
+    synthetic_pages.write_page(dirr, 'archive_3', json.load(open(f'{dirr}/live_3_dom.json')), [], [])
+    result, hits = run()
+    assert hits == 0 and result.info['diff_stage'] == 'interaction_4'
+    assert run()[1] == 1
+    result_cache.clear(dirr)
+    assert run()[1] == 0
+
+
+
+def test_result_cache_writedown(tmp_path):
+    dirr = str(tmp_path / 'site')
+    _gen_site(dirr, 0, broken_from=3)
+    outputs = [f'{dirr}/diff_live_archive.json', f'{dirr}/diff_archive.jpg']
+
+    def run(**options):
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+        fidelity_detect.fidelity_issue_all(dirr, layout_check=True, cache=True, **options)
+        return [open(path, 'rb').read() if os.path.exists(path) else None for path in outputs]
+
+    written = run(screenshot=True)
+    assert written[1] is not None
+    assert run(screenshot=False)[0] != written[0]
+    # A hit writes down the same outputs as the run it was cached from
+    hits = result_cache.CACHE_STATS['hits']
+    assert run(screenshot=True) == written
+    assert result_cache.CACHE_STATS['hits'] - hits == 1
+
+def test_pinpoint_result_cache(tmp_path):
+    from fidex.error_pinpoint import pinpoint
+    dirr = str(tmp_path / 'site')
+    _gen_site(dirr, 1)
+    json.dump({'req_url': 'https://example.com/', 'archive_url': 'https://example.com/'}, open(f'{dirr}/metadata.json', 'w'))
+    expected = pinpoint.pinpoint_issue(dirr)
+    hits = result_cache.CACHE_STATS['hits']
+    for _ in range(2):
+        result = pinpoint.pinpoint_issue(dirr, cache=True)
+        assert result.fidelity_result == expected.fidelity_result and result.pinpointed_errors == []
+    # Second call hits the pinpoint entry, the first one the fidelity entry of pinpointing missed
+    assert result_cache.CACHE_STATS['hits'] - hits == 1
+
+
+def test_profile(tmp_path):
+    dirr = str(tmp_path / 'site')
+    _gen_site(dirr, 2, broken_from=2)
+    checks = dict(layout_check=True, screenshot=True, writedown=False)
+    expected = fidelity_detect.fidelity_issue_all(dirr, **checks)
+    path = str(tmp_path / 'profile.jsonl')
+    for workers in [None, 2]:
+        result = fidelity_detect.fidelity_issue_all(dirr, **checks, profile=path, workers=workers)
+        profile = result.info.pop('profile')
+        # Profiling doesn't change the result
+        assert result == expected
+        stages = profile['stages']
+        assert [s['stage'] for s in stages] == ['onload', 'extraInteraction', 'interaction_0', 'interaction_1', 'interaction_2']
+        assert {'load', 'tree_build', 'list_tree', 'myers_diff', 'fidex_check'} <= stages[0]['time'].keys()
+        assert 'interaction_diff' in stages[1]['time']
+        assert stages[-1]['counts']['left_elements'] == 600 and stages[-1]['counts']['edit_distance'] > 0
+    summary = instrument.summarize(path)
+    assert summary['pages'] == 2 and summary['counts']['left_elements'] == 2 * 4 * 600
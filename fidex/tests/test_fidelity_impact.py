@@ -0,0 +1,123 @@
+import bisect
+import json
+import os
+import random
+
+import pytest
+
+import synthetic_pages
+from fidex.fidelity_check import fidelity_detect, fidelity_impact
+from test_fidelity_detect import _gen_site
+
+
+def _reference_calculate_total_area(rectangles):
+    """Previous sweep line, re-sorting and re-merging all active intervals on every x"""
+    events = []
+    for (width, height, top, left, scale) in rectangles:
+        start = left
+        end = left + width
+        bottom = top + height
+        events.append((start, top, bottom, scale))  # Start of rectangle
+        events.append((end, top, bottom, -scale))   # End of rectangle
+    events.sort(key=lambda x: (x[0], -x[3] if x[3] < 0 else 0))
+    last_x = 0
+    active_intervals = []
+    total_area = 0
+
+    def compute_y_coverage():
+        if not active_intervals:
+            return 0
+        merged_intervals = []
+        sorted_intervals = sorted(active_intervals)
+        current_start, current_end, current_scale = sorted_intervals[0]
+        for start, end, scale in sorted_intervals[1:]:
+            if start > current_end:
+                merged_intervals.append((current_start, current_end, current_scale))
+                current_start, current_end, current_scale = start, end, scale
+            else:
+                if current_end < end:
+                    merged_intervals.append((current_start, current_end, current_scale))
+                    current_start = current_end
+                    current_scale = min(1, current_scale + scale)
+                    current_end = end
+                else:
+                    current_scale = min(1, current_scale + scale)
+        merged_intervals.append((current_start, current_end, current_scale))
+        return sum((end - start) * scale for start, end, scale in merged_intervals)
+
+    for x, y1, y2, scale_change in events:
+        if x != last_x:
+            total_area += compute_y_coverage() * (x - last_x)
+            last_x = x
+        i = 0
+        while i < len(active_intervals):
+            if active_intervals[i][0] == y1 and active_intervals[i][1] == y2:
+                new_scale = active_intervals[i][2] + scale_change
+                if new_scale == 0:
+                    active_intervals.pop(i)
+                else:
+                    active_intervals[i] = (y1, y2, min(1, new_scale))
+                break
+            i += 1
+        else:
+            if scale_change > 0:
+                bisect.insort(active_intervals, (y1, y2, scale_change))
+    return total_area
+
+
+def _gen_rectangles(rnd, num, size, scales=(1,)):
+    """Random rectangles within size x size, many of them sharing y intervals and coordinates, some empty"""
+    tops = [rnd.randrange(size) for _ in range(4)]
+    rectangles = []
+    for _ in range(num):
+        top = rnd.choice(tops) if rnd.random() < 0.3 else rnd.randrange(size)
+        height = rnd.randint(0, size) if rnd.random() > 0.05 else -rnd.randint(1, size)
+        width = rnd.randint(0, size) if rnd.random() > 0.05 else -rnd.randint(1, size)
+        rectangles.append((width, height, top, rnd.randrange(size), rnd.choice(scales)))
+    return rectangles
+
+
+def test_calculate_total_area_matches_reference():
+    rnd = random.Random(0)
+    for _ in range(1000):
+        size = rnd.choice([5, 10, 100, 10000])
+        scales = rnd.choice([(1,), (1,), (1, 0.5), (0.25, 0.5, 1, 2)])
+        rectangles = _gen_rectangles(rnd, rnd.randint(0, 60), size, scales)
+        assert fidelity_impact.calculate_total_area(rectangles) == _reference_calculate_total_area(rectangles)
+    # * Same y interval: only counted until either rectangle ends
+    rectangles = [(10, 10, 0, 0, 1), (10, 10, 0, 5, 1), (10, 10, 0, 10, 1)]
+    assert fidelity_impact.calculate_total_area(rectangles) == _reference_calculate_total_area(rectangles) == 100
+    # * Float coordinates, as from getBoundingClientRect, only differ by rounding
+    for _ in range(300):
+        rectangles = [(w / 3, h / 7, t / 3, l / 7, s) for (w, h, t, l, s) in _gen_rectangles(rnd, 40, 100)]
+        assert fidelity_impact.calculate_total_area(rectangles) == \
+            pytest.approx(_reference_calculate_total_area(rectangles), rel=1e-9, abs=1e-9)
+
+
+def test_fidelity_issue_impact_uses_up_to_date_diff(tmp_path):
+    dirr = str(tmp_path / 'site')
+    _gen_site(dirr, 0)
+    path = f'{dirr}/diff_live_archive.json'
+    # * Without a diff json, the check runs but doesn't write it down
+    assert fidelity_impact.fidelity_issue_impact(dirr) == (0, 0)
+    assert not os.path.exists(path)
+    element = next(e for e in synthetic_pages.gen_elements(600, seed=0)
+                   if e['dimension'] and e['dimension']['width'] > 0 and e['dimension']['height'] > 0)
+    area = element['dimension']['width'] * element['dimension']['height']
+    # * A diff json without a result_cache key is not trusted, and kept as is
+    diff = {'info': {'diff': True, 'diff_stage': 'onload', 'layout_diff': True}, 'live_unique': [[element['xpath']]],
+            'archive_unique': [], 'more_errs': None}
+    json.dump(diff, open(path, 'w'))
+    assert fidelity_impact.fidelity_issue_impact(dirr) == (0, 0)
+    assert json.load(open(path)) == diff
+    # * An up to date diff json, written by a check with other options, is the one used
+    fidelity_detect.fidelity_issue_all(dirr, layout_check=True)
+    diff = json.load(open(path))
+    assert diff['result_cache']['options']['layout_check']
+    diff.update(info={**diff['info'], 'diff': True, 'diff_stage': 'onload'}, live_unique=[[element['xpath']]])
+    json.dump(diff, open(path, 'w'))
+    assert fidelity_impact.fidelity_issue_impact(dirr) == (area, 0)
+    # * Not anymore once an input artifact changes
+    exceptions = json.load(open(f'{dirr}/archive_exception_failfetch.json'))
+    json.dump(exceptions, open(f'{dirr}/archive_exception_failfetch.json', 'w'), indent=2)
+    assert fidelity_impact.fidelity_issue_impact(dirr) == (0, 0)
@@ -0,0 +1,371 @@
+import glob
+import os
+import random
+from collections import namedtuple
+
+import pytest
+
+import synthetic_pages
+from fidex.fidelity_check import fidelity_detect, layout_tree, js_writes, myers
+
+HOME = os.path.expanduser("~")
+FIXTURE_DIR = f'{HOME}/fidelity-files/writes/test'
+
+
+def _reference_build_layout_tree(elements, writes, writeStacks, include_verbose_writes=False, js_comp=True):
+    """Original quadratic parent lookup, kept as the oracle for build_layout_tree"""
+    stack_map = {w['wid']: w for w in writeStacks}
+    root_e = elements[0]
+    nodes = {root_e['xpath']: layout_tree.LayoutElement(root_e, js_comp=js_comp)}
+
+    def get_parent_xpath(xpath, elements):
+        for e in reversed(elements):
+            if xpath.startswith(e['xpath']):
+                return e['xpath']
+        assert False, 'No parent found'
+
+    for i in range(1, len(elements)):
+        element = elements[i]
+        layout_element = layout_tree.LayoutElement(element, js_comp=js_comp)
+        nodes[element['xpath']] = layout_element
+        nodes[get_parent_xpath(element['xpath'], elements[:i])].add_child(layout_element)
+    writes_obj = [js_writes.JSWrite(w, stack_map[w['wid']]['stackInfo'], nodes)
+                  for w in writes if w['wid'] in stack_map]
+    for w in writes_obj:
+        if not w.effective and not include_verbose_writes:
+            continue
+        for xpath in w.associated_xpaths:
+            if xpath in nodes:
+                nodes[xpath].add_writes([w], effective=w.effective)
+    root_node = nodes[root_e['xpath']]
+    root_node.all_nodes = nodes
+    return root_node
+
+
+def _tree_signature(root):
+    sig = []
+    for xpath, node in root.all_nodes.items():
+        sig.append((
+            xpath,
+            node.parent.xpath if node.parent else None,
+            tuple(c.xpath for c in node.children),
+            tuple(w.wid for w in node.writes),
+            tuple(w.wid for w in node.verbose_writes),
+        ))
+    return sig
+
+
+def _assert_same_tree(elements, writes, stacks):
+    new = layout_tree.build_layout_tree(elements, writes, stacks, include_verbose_writes=True)
+    ref = _reference_build_layout_tree(elements, writes, stacks, include_verbose_writes=True)
+    assert list(new.all_nodes) == list(ref.all_nodes)
+    assert _tree_signature(new) == _tree_signature(ref)
+
+
+def test_build_layout_tree_synthetic():
+    for seed in range(5):
+        elements = synthetic_pages.gen_elements(1500, seed=seed)
+        writes, stacks = synthetic_pages.gen_writes(elements, 200, seed=seed)
+        flat_stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+        _assert_same_tree(elements, writes, flat_stacks)
+
+
+def test_build_layout_tree_fixtures():
+    """Compare against the quadratic builder on every recorded test page available locally"""
+    pages = [(dirr, prefix) for dirr in sorted(glob.glob(f'{FIXTURE_DIR}/*'))[:20] for prefix in ['live', 'archive']
+             if os.path.exists(f'{dirr}/{prefix}_dom.json')]
+    if not pages:
+        pytest.skip(f'No recorded test pages under {FIXTURE_DIR}')
+    for dirr, prefix in pages:
+        info = fidelity_detect.LoadInfo(dirr, prefix)
+        if len(info.elements) == 0:
+            continue
+        _assert_same_tree(info.elements, info.writes, info.write_stacks)
+
+
+def test_parse_start_tag_matches_beautifulsoup():
+    from bs4 import BeautifulSoup, Tag
+    texts = [
+        '<div class="a  b" id="x">', '<DIV Class="a" CLASS=\'b\' data-x>', '<img src="/a.png" srcset="/a.png 1x, /b.png 2x"/>',
+        '<a href="https://x.com/?a=1&amp;b=2" rel="nofollow noopener">', '<a href=/bare/path target=_blank>',
+        '<svg viewBox="0 0 10 10" xmlns:xlink="http://www.w3.org/1999/xlink">', '<path d="M0 0L10 10"/>',
+        '<input value="" disabled>', '<p style="color: red; width: 10px">', '<span =weird>', '<div  / class="x">',
+        '<td headers="h1 h2">', '<div class="x', 'plain text', 'a < b > c', '<3 hearts', 'text <b>bold</b>',
+        '<!-- comment --><b>x</b>', '<br>', '<div title="a>b">', "<div title='it\"s'>", '<button onclick="f(1)" class>',
+    ]
+    elements = synthetic_pages.gen_elements(2000, seed=3)
+    texts += [e['text'] for e in elements]
+    for text in texts:
+        element = layout_tree.LayoutElement({'depth': 0, 'xpath': '/html[1]/body[1]/div[1]', 'text': text})
+        tag = BeautifulSoup(text, 'html.parser').find()
+        if isinstance(tag, Tag):
+            assert element.tagname == tag.name, text
+            assert element.attrs == tag.attrs, text
+        else:
+            assert element.tagname == 'div', text
+            assert element.attrs is None, text
+
+
+def _reference_myers_diff(left_seq, right_seq):
+    """Original history-copying Myers diff, kept as the oracle for myers.myers_diff"""
+    Frontier = namedtuple('Frontier', ['x', 'left_diff', 'right_diff', 'left_common', 'right_common'])
+    frontier = {1: Frontier(0, [], [], [], [])}
+    L = len(left_seq)
+    R = len(right_seq)
+    for d in range(0, L + R + 1):
+        for k in range(-d, d + 1, 2):
+            go_down = (k == -d or
+                    (k != d and frontier[k - 1].x < frontier[k + 1].x))
+            if go_down:
+                x, left_diff, right_diff, left_common, right_common = frontier[k + 1]
+            else:
+                x, left_diff, right_diff, left_common, right_common = frontier[k - 1]
+                x += 1
+            left_diff, right_diff = left_diff.copy(), right_diff.copy()
+            left_common, right_common = left_common.copy(), right_common.copy()
+            y = x - k
+            if 1 <= y <= R and go_down:
+                right_diff.append((right_seq[y-1]))
+            elif 1 <= x <= L:
+                left_diff.append(left_seq[x-1])
+            while x < L and y < R and left_seq[x] == right_seq[y]:
+                left_common.append(left_seq[x])
+                right_common.append(right_seq[y])
+                x += 1
+                y += 1
+            if x >= L and y >= R:
+                return left_diff, right_diff, left_common, right_common
+            else:
+                frontier[k] = Frontier(x, left_diff, right_diff, left_common, right_common)
+
+
+class _Item:
+    """Element that records every comparison made on it"""
+    def __init__(self, idx, value, log):
+        self.idx, self.value, self.log = idx, value, log
+
+    def __eq__(self, other):
+        self.log.append((self.idx, other.idx))
+        return self.value == other.value
+
+    __hash__ = None
+
+
+def test_myers_diff_matches_reference():
+    rnd = random.Random(0)
+    for _ in range(500):
+        alphabet = rnd.randint(1, 6)
+        left = [rnd.randrange(alphabet) for _ in range(rnd.randint(0, 30))]
+        right = [rnd.randrange(alphabet) for _ in range(rnd.randint(0, 30))]
+        ref_log, new_log = [], []
+        ref = _reference_myers_diff([_Item(('l', i), v, ref_log) for i, v in enumerate(left)],
+                                    [_Item(('r', i), v, ref_log) for i, v in enumerate(right)])
+        new = myers.myers_diff([_Item(('l', i), v, new_log) for i, v in enumerate(left)],
+                               [_Item(('r', i), v, new_log) for i, v in enumerate(right)])
+        assert [[e.idx for e in part] for part in new] == [[e.idx for e in part] for part in ref]
+        # Same comparisons in the same order, since __eq__ can tag elements (e.g. dynamic_matched)
+        assert new_log == ref_log
+
+
+def test_myers_diff_budget():
+    rnd = random.Random(0)
+    for _ in range(500):
+        alphabet = rnd.randint(1, 6)
+        left = [rnd.randrange(alphabet) for _ in range(rnd.randint(0, 30))]
+        right = [rnd.randrange(alphabet) for _ in range(rnd.randint(0, 30))]
+        full = myers.myers_diff(left, right)
+        distance = len(full[0]) + len(full[1])
+        # Enough budget: same as the full diff
+        budget = myers.Budget(max_d=distance)
+        assert myers.myers_diff(left, right, budget=budget) == full and not budget.exceeded
+        if distance == 0:
+            continue
+        # Out of budget: a valid (not minimal) edit script
+        budget = myers.Budget(max_d=rnd.randrange(distance))
+        left_diff, right_diff, left_common, right_common = myers.myers_diff(left, right, budget=budget)
+        assert budget.exceeded
+        assert left_common == right_common
+        assert len(left_diff) + len(left_common) == len(left) and len(right_diff) + len(right_common) == len(right)
+        assert len(left_diff) + len(right_diff) >= distance
+
+
+def _reference_js_dynamism_self_eq(e1, e2):
+    """Original js_dynamism_self_eq rebuilding the sibling write sets per call, kept as the oracle"""
+    if len(e1.writes) + len(e2.writes) > 0:
+        e1_related_writes = [w for e in e1.parent.children for w in e.writes] if e1.parent else e1.writes
+        e2_related_writes = [w for e in e2.parent.children for w in e.writes] if e2.parent else e2.writes
+        if set(e1_related_writes).issubset(set(e2_related_writes)) \
+           and set(e2_related_writes).issubset(set(e1_related_writes)):
+            return True
+        e1_related_writes_plain = [w.plain_form for w in e1_related_writes]
+        e2_related_writes_plain = [w.plain_form for w in e2_related_writes]
+        if set(e1_related_writes_plain).issubset(set(e2_related_writes_plain)) \
+           and set(e2_related_writes_plain).issubset(set(e1_related_writes_plain)):
+            return True
+    return False
+
+
+def _reference_eq(e1, e2):
+    """Original LayoutElement.__eq__ running every predicate, kept as the oracle for the fingerprinted one"""
+    from bs4 import Tag
+    if e1.tagname != e2.tagname:
+        return False
+    if layout_tree.features_eq(e1, e2) and layout_tree.dimension_eq(e1, e2):
+        return True
+    if e1.js_comp and _reference_js_dynamism_self_eq(e1, e2):
+        if e1.tagname != 'body':
+            e1.dynamic_matched = True
+        if e2.tagname != 'body':
+            e2.dynamic_matched = True
+        return True
+    # css_dynamism_self_eq on the full BeautifulSoup tags
+    if (e1.parent and e1.parent.tagname == 'svg') and (e2.parent and e2.parent.tagname == 'svg'):
+        if e1.tagname == '#text' and e2.tagname == '#text':
+            return True
+    if e1.tagname in ['path', 'g', 'rect'] and e1.text == e2.text:
+        return True
+    if e1.extraAttr.get('animation') and e2.extraAttr.get('animation'):
+        return True
+    if not isinstance(e1.tag, Tag) or not isinstance(e2.tag, Tag):
+        return False
+    if 'style' in e1.tag.attrs and 'style' in e2.tag.attrs:
+        s1 = layout_tree._filter_style(e1.tag.attrs['style'], filter_keys=layout_tree.CSS_ANIMATION_STYLES)
+        s2 = layout_tree._filter_style(e2.tag.attrs['style'], filter_keys=layout_tree.CSS_ANIMATION_STYLES)
+        return s1 == s2
+    return False
+
+
+def test_layout_element_eq_matches_reference():
+    rnd = random.Random(0)
+    for seed in range(3):
+        elements = synthetic_pages.gen_elements(800, seed=seed)
+        writes, stacks = synthetic_pages.gen_writes(elements, 300, seed=seed, num_stacks=5)
+        flat_stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+        mutated = synthetic_pages.mutate_elements(elements, 40, seed=seed)
+        for js_comp in [True, False]:
+            trees = []
+            for _ in range(2):
+                left = layout_tree.build_layout_tree(elements, writes, flat_stacks, js_comp=js_comp)
+                right = layout_tree.build_layout_tree(mutated, writes, flat_stacks, js_comp=js_comp)
+                trees.append((list(left.all_nodes.values()), list(right.all_nodes.values())))
+            (left_new, right_new), (left_ref, right_ref) = trees
+            for _ in range(20000):
+                i, j = rnd.randrange(len(left_new)), rnd.randrange(len(right_new))
+                assert (left_new[i] == right_new[j]) == _reference_eq(left_ref[i], right_ref[j])
+            for new, ref in [(left_new, left_ref), (right_new, right_ref)]:
+                assert [getattr(e, 'dynamic_matched', False) for e in new] == \
+                       [getattr(e, 'dynamic_matched', False) for e in ref]
+
+
+def test_js_dynamism_self_eq_matches_reference():
+    rnd = random.Random(0)
+    for seed in range(3):
+        elements = synthetic_pages.gen_elements(800, seed=seed)
+        mutated = synthetic_pages.mutate_elements(elements, 40, seed=seed)
+        trees = []
+        # Same writes from different stacks, so some pairs only match by plain form
+        for page, num_stacks in [(elements, 5), (mutated, 3)]:
+            writes, stacks = synthetic_pages.gen_writes(elements, 300, seed=seed, num_stacks=num_stacks)
+            flat_stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+            trees.append(list(layout_tree.build_layout_tree(page, writes, flat_stacks).all_nodes.values()))
+        left, right = trees
+        matched = 0
+        for _ in range(20000):
+            e1, e2 = rnd.choice(left), rnd.choice(right)
+            expected = _reference_js_dynamism_self_eq(e1, e2)
+            assert layout_tree.js_dynamism_self_eq(e1, e2) == expected
+            matched += expected
+        assert matched > 0
+
+
+def test_diff_layout_tree_subtree_jumps():
+    """Jumping over identical subtrees gives the same diff and dynamic matches as plain Myers"""
+    for seed in range(4):
+        elements = synthetic_pages.gen_elements(3000, seed=seed)
+        writes, stacks = synthetic_pages.gen_writes(elements, 300, seed=seed, num_stacks=5)
+        flat_stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+        for changes in [1, 10, 100]:
+            mutated = synthetic_pages.mutate_elements(elements, changes, seed=seed)
+            for layout_order in [False, True]:
+                results = []
+                for jump in [True, False]:
+                    left = layout_tree.build_layout_tree(elements, writes, flat_stacks)
+                    right = layout_tree.build_layout_tree(mutated, writes, flat_stacks)
+                    left_list = left.list_tree(layout_order=layout_order)
+                    right_list = right.list_tree(layout_order=layout_order)
+                    blocks = None
+                    if jump:
+                        interned, blocks = {}, []
+                        for root, tree_list in [(left, left_list), (right, right_list)]:
+                            block_list, keys, spans = [], [], []
+                            layout_tree._list_tree_blocks(root, interned, block_list, keys, spans, layout_order=layout_order)
+                            assert block_list == tree_list
+                            blocks.append((keys, spans))
+                        blocks = (blocks[0][0], blocks[1][0], blocks[0][1])
+                    left_diff, right_diff = layout_tree._myers_diff(left_list, right_list, blocks=blocks)
+                    dynamic = [e.xpath for e in left_list + right_list if getattr(e, 'dynamic_matched', False)]
+                    results.append(([e.xpath for e in left_diff], [e.xpath for e in right_diff], dynamic))
+                assert results[0] == results[1]
+
+
+def test_tree_index_queries():
+    elements = synthetic_pages.gen_elements(3000, seed=1)
+    writes, stacks = synthetic_pages.gen_writes(elements, 100, seed=1)
+    flat_stacks = [{'wid': wid, 'stackInfo': s['stackInfo']} for s in stacks for wid in s['wids']]
+    indexed = layout_tree.build_layout_tree(elements, writes, flat_stacks)
+    plain = _reference_build_layout_tree(elements, writes, flat_stacks)
+    assert plain._preorder is None
+    rnd = random.Random(1)
+    for xpath, node in indexed.all_nodes.items():
+        ref = plain.all_nodes[xpath]
+        assert [n.xpath for n in node.descendants()] == [n.xpath for n in ref.descendants()]
+        assert [n.xpath for n in node.iter_descendants()] == [n.xpath for n in ref.descendants()]
+        assert [n.xpath for n in node.ancestors()] == [n.xpath for n in ref.ancestors()]
+        if node.parent:
+            assert [n.xpath for n in node.next_siblings()] == [n.xpath for n in ref.next_siblings()]
+            assert [n.xpath for n in node.prev_siblings()] == [n.xpath for n in ref.prev_siblings()]
+        other = indexed.all_nodes[rnd.choice(elements)['xpath']]
+        assert node.is_ancestor_of(other) == ref.is_ancestor_of(plain.all_nodes[other.xpath]) \
+            == (other.xpath.startswith(node.xpath + '/'))
+    # Adding a child drops the stale intervals
+    indexed.add_child(layout_tree.LayoutElement({'depth': 1, 'xpath': '/html[1]/div[99]', 'text': '<div>'}))
+    assert indexed.descendants()[-1].xpath == '/html[1]/div[99]'
+
+
+def _reference_filter_style(style, filter_keys=layout_tree.FILTERED_STYLES):
+    """Original uncached _filter_style"""
+    import html, re
+    style = html.unescape(style)
+    style = re.sub(r';\s+', ';', style.strip(';'))
+    new_style = []
+    filter_keys = [re.compile(k) for k in filter_keys]
+    pattern = r';(?=(?:[^\'"]|\'[^\']*\'|"[^"]*")*$)'
+    for s in sorted(re.split(pattern, style)):
+        s = re.sub(r':\s+', ':', s)
+        to_filter = False
+        s_split = s.split(':')
+        for k in filter_keys:
+            if k.match(s_split[0]):
+                to_filter = True
+                break
+        if not to_filter:
+            if len(s_split) > 1:
+                s_split[1] = ' '.join(sorted(s_split[1].split()))
+            new_style.append(': '.join(s_split))
+    return ';'.join(new_style)
+
+
+def test_filter_style_matches_reference():
+    rnd = random.Random(0)
+    props = ['color', 'width', 'max-width', 'transform', 'transform-origin', 'background', 'background-color',
+             'display', 'font-family', 'content', 'top', 'margin', 'opacity', 'clip-path', 'inset']
+    values = ['red', '10px  20px', '"a;b"', "'x: y'", 'url(/a.png)', '', 'rgb(1, 2, 3)', '&quot;q&quot;']
+    styles = [s['text'] for s in synthetic_pages.gen_elements(500, seed=0)]
+    for _ in range(2000):
+        decls = [f'{rnd.choice(props)}:{" " * rnd.randint(0, 2)}{rnd.choice(values)}' for _ in range(rnd.randint(0, 5))]
+        styles.append((';' + ' ' * rnd.randint(0, 1)).join(decls) + rnd.choice(['', ';', '; ']))
+    for style in styles:
+        for keys in [layout_tree.FILTERED_STYLES, layout_tree.CSS_ANIMATION_STYLES, [], ['col.*']]:
+            assert layout_tree._filter_style(style, filter_keys=keys) == _reference_filter_style(style, filter_keys=keys)
+    info = layout_tree.style_cache_info()
+    assert info.hits > 0 and info.misses > 0
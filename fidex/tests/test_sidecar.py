@@ -0,0 +1,73 @@
+import json
+import os
+
+import synthetic_pages
+from fidex.fidelity_check import fidelity_detect, sidecar
+
+
+def _gen_site(dirr, seed=0):
+    elements = synthetic_pages.gen_elements(1500, seed=seed)
+    # Browser dimensions are floats, and some elements have extra attributes
+    elements[5]['dimension'] = {'left': 0.5, 'top': 10, 'width': 33.25, 'height': 1e-3}
+    elements[6]['extraAttr'] = {'currentSrc': 'https://example.com/a.png', 'animation': True}
+    elements[7]['text'] = 'ünïcödé   "quoted"'
+    writes, stacks = synthetic_pages.gen_writes(elements, 400, seed=seed, num_stacks=6)
+    writes[0]['extra'] = [1, None, {'k': 2.5}]
+    # Duplicated stack in different groups
+    stacks.append({'stackInfo': stacks[0]['stackInfo'], 'wids': []})
+    synthetic_pages.write_page(dirr, 'live', elements, writes, stacks)
+    synthetic_pages.write_page(dirr, 'live_0', synthetic_pages.mutate_elements(elements, 20, seed=seed), writes, stacks)
+
+
+def _dumps(obj):
+    return json.dumps(obj, sort_keys=True)
+
+
+def test_sidecar_round_trip(tmp_path):
+    dirr = str(tmp_path / 'site')
+    _gen_site(dirr)
+    for name in ['live_dom.json', 'live_0_dom.json', 'live_writes.json', 'live_writeStacks.json']:
+        json_path = f'{dirr}/{name}'
+        assert sidecar.write_sidecar(json_path)
+        expected = json.load(open(json_path))
+        loaded = sidecar.read_sidecar(json_path)
+        # Same values and same int/float types
+        assert loaded == expected and _dumps(loaded) == _dumps(expected)
+
+
+def test_sidecar_unsupported_and_stale(tmp_path):
+    dirr = str(tmp_path / 'site')
+    _gen_site(dirr)
+    assert not sidecar.write_sidecar(f'{dirr}/live_events.json')
+    elements = json.load(open(f'{dirr}/live_dom.json'))
+    elements[3]['unknown'] = 1
+    json.dump(elements, open(f'{dirr}/live_dom.json', 'w'))
+    assert not sidecar.write_sidecar(f'{dirr}/live_dom.json')
+    assert sidecar.read_sidecar(f'{dirr}/live_dom.json') is None
+
+    del elements[3]['unknown']
+    json.dump(elements, open(f'{dirr}/live_dom.json', 'w'))
+    assert sidecar.write_sidecar(f'{dirr}/live_dom.json')
+    # Rewritten json makes the sidecar stale
+    json.dump(elements[:10], open(f'{dirr}/live_dom.json', 'w'))
+    assert sidecar.read_sidecar(f'{dirr}/live_dom.json') is None
+    assert sidecar.load(f'{dirr}/live_dom.json') == elements[:10]
+
+
+def test_load_info_from_sidecar(tmp_path):
+    dirr = str(tmp_path / 'site')
+    _gen_site(dirr)
+    fidelity_detect.clear_load_cache()
+    expected = {prefix: fidelity_detect.LoadInfo(dirr, prefix) for prefix in ['live', 'live_0']}
+    assert sidecar.convert(str(tmp_path)) == 4
+    assert sidecar.convert(str(tmp_path)) == 0
+    # Only the sidecars are kept
+    for name in ['live_dom.json', 'live_0_dom.json', 'live_writes.json', 'live_writeStacks.json']:
+        os.remove(f'{dirr}/{name}')
+    fidelity_detect.clear_load_cache()
+    for prefix, info in expected.items():
+        loaded = fidelity_detect.LoadInfo(dirr, prefix)
+        assert loaded.elements == info.elements
+        assert loaded.writes == info.writes
+        assert loaded.write_stacks == info.write_stacks
+    fidelity_detect.clear_load_cache()
@@ -31,17 +31,21 @@ def normal_text(text):
     return text.strip()
 
 def get_img_src(img_tag) -> set:
+    """
+    Args:
+        img_tag (Tag | dict): img tag, or its attributes
+    """
     src_terms = [re.compile('^src$'), re.compile('.*lazy.+src'), re.compile('.*data.+src'), re.compile('.*data.+lazy')]
     srcs = []
-    img = img_tag
-    for attr in img.attrs:
+    attrs = img_tag if isinstance(img_tag, dict) else img_tag.attrs
+    for attr in attrs:
         for term in src_terms:
             if term.match(attr):
-                src = img.attrs[attr]
+                src = attrs[attr]
                 srcs.append(src)
     # Parse srcset
-    if 'srcset' in img.attrs:
-        srcset = img.attrs['srcset']
+    if 'srcset' in attrs:
+        srcset = attrs['srcset']
         parts = [src.strip() for src in srcset.split(',')]
         srcs += [part.split(' ')[0] for part in parts]
     srcs = set([url_utils.url_norm(src, ignore_scheme=True, ignore_netloc=True, trim_slash=True, archive=True) for src in srcs])
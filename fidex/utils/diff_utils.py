@@ -4,7 +4,7 @@ import json
 from bs4 import BeautifulSoup
 
 from fidex.utils import common
-from fidex.fidelity_check import fidelity_detect
+from fidex.fidelity_check import dom_delta, fidelity_detect
 
 def num_diffs(fidelity_result: dict):
     """Number of diffs from the diff"""
@@ -64,13 +64,13 @@ def drop_incorrect_left_diff(dirr, left_diffs: "list[str]", left_prefix, right_p
     left_diffs = set(left_diffs)
     l_suffix = '' if stage == 'onload' else f'_{stage.split("_")[1]}'
     stage_num = -1 if stage == 'onload' else int(stage.split('_')[1])
-    left_doms = json.load(open(f'{dirr}/{left_prefix}{l_suffix}_dom.json'))
+    left_doms = dom_delta.load(f'{dirr}/{left_prefix}{l_suffix}_dom.json')
     left_doms = {d['xpath']: d for d in left_doms}
     for idx in range(stage_num, 20):
         r_suffix = '' if idx == -1 else f'_{idx}'
-        if not os.path.exists(f'{dirr}/{right_prefix}{r_suffix}_dom.json'):
+        if not dom_delta.exists(f'{dirr}/{right_prefix}{r_suffix}_dom.json'):
             continue
-        right_doms = json.load(open(f'{dirr}/{right_prefix}{r_suffix}_dom.json'))
+        right_doms = dom_delta.load(f'{dirr}/{right_prefix}{r_suffix}_dom.json')
         right_doms = {d['xpath']: d for d in right_doms}
         
         left_drops = set()
@@ -24,6 +24,7 @@ parser.add_argument('--base', type=str, help='Base file prefix for pinpointing r
 parser.add_argument('--comp', type=str, help='Comp file prefix for pinpointing comparison (archive or fix)')
 parser.add_argument('--collection', type=str, help='Collection name to that writes and warcs are in')
 parser.add_argument('--input_file', type=str, help='Input diff file to run URLs on')
+parser.add_argument('--no_cache', action='store_true', help='Recompute all pages instead of reusing cached results')
 args = parser.parse_args()
 LEFT = args.base
 RIGHT = args.comp
@@ -53,7 +54,7 @@ def pinpoint_issue_wrapper(idx, archive_url, dirr, left_prefix='live', right_pre
                 if active_ids[idx] == False:
                     active_ids[idx] = True
                     break
-        pinpoint_result = pinpoint.pinpoint_issue(dirr, idx, left_prefix, right_prefix)
+        pinpoint_result = pinpoint.pinpoint_issue(dirr, idx, left_prefix, right_prefix, cache=not args.no_cache)
         with active_ids_lock:
             active_ids[idx] = False
         return pinpoint_result
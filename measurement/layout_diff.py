@@ -25,6 +25,8 @@ parser.add_argument('--base', type=str, help='Base file prefix to compare layout
 parser.add_argument('--comp', type=str, help='Comp file prefix to compare layout tree (archive or fix)')
 parser.add_argument('--input_file', type=str, help='Input file to run URLs on')
 parser.add_argument('--collection', type=str, help='Collection name to that writes and warcs are in')
+parser.add_argument('--no_cache', action='store_true', help='Recompute all pages instead of reusing cached results')
+parser.add_argument('--profile', type=str, help='JSONL file to append per-stage timings and counters of each page to')
 parser.add_argument('operation', type=str, help='Operation to perform')
 args = parser.parse_args()
 LEFT = args.base
@@ -55,7 +57,9 @@ def fidelity_issue_wrapper(idx, dirr, url, left_prefix='live', right_prefix='arc
                                                         more_errs=more_errs,
                                                         html_text=html_text, 
                                                         meaningful=meaningful,
-                                                        need_exist=False)
+                                                        need_exist=False,
+                                                        cache=not args.no_cache,
+                                                        profile=args.profile)
     except Exception as e:
         logging.error(f"Error in {idx} {dirr}: {e}")
         logging.error(traceback.format_exc())